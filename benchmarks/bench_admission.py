@@ -0,0 +1,111 @@
+import sys
+import json
+import time
+import random
+import asyncio
+from pathlib import Path
+from argparse import ArgumentParser
+from collections import Counter
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+import aiohttp
+from generator import generate_import, generate_patch
+from report import latency_stats, write_report
+from bench_concurrency import SERVERS, start_server, prepare_import
+
+
+async def run_heavy_client(session, base_url: str, body: bytes, deadline: float, latencies: list,
+                           statuses: Counter):
+    # sends large imports one by one, after 503 it waits for Retry-After like a polite client
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            async with session.post(base_url + '/imports', data=body,
+                                    headers={'Content-Type': 'application/json'}) as response:
+                await response.read()
+                status, retry_after = response.status, response.headers.get('Retry-After')
+        except aiohttp.ClientError as e:
+            statuses[type(e).__name__] += 1
+            continue
+        statuses[str(status)] += 1
+        if status == 201:
+            latencies.append(time.monotonic() - started)
+        elif retry_after is not None:
+            await asyncio.sleep(min(float(retry_after), max(0.0, deadline - time.monotonic())))
+
+
+async def run_cheap_client(session, base_url: str, import_id: int, citizens_num: int, deadline: float,
+                           latencies: list, statuses: Counter, rnd: random.Random):
+    # PATCH of one citizen, which isn't limited by admission control
+    while time.monotonic() < deadline:
+        started = time.monotonic()
+        try:
+            async with session.patch('{}/imports/{}/citizens/{}'.format(base_url, import_id,
+                                                                        rnd.randint(1, citizens_num)),
+                                     json=generate_patch(rnd, citizens_num)) as response:
+                await response.read()
+                status = response.status
+        except aiohttp.ClientError as e:
+            statuses[type(e).__name__] += 1
+            continue
+        statuses[str(status)] += 1
+        if status == 200:
+            latencies.append(time.monotonic() - started)
+
+
+async def run_load(base_url: str, import_id: int, citizens_num: int, body: bytes, heavy: int, cheap: int,
+                   duration: float, seed: int) -> dict:
+    heavy_latencies, cheap_latencies, heavy_statuses, cheap_statuses = [], [], Counter(), Counter()
+    connector = aiohttp.TCPConnector(limit=heavy + cheap)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*[run_heavy_client(session, base_url, body, deadline, heavy_latencies, heavy_statuses)
+                               for _ in range(heavy)],
+                             *[run_cheap_client(session, base_url, import_id, citizens_num, deadline,
+                                                cheap_latencies, cheap_statuses, random.Random(seed + i))
+                               for i in range(cheap)])
+    return {'heavy': {**latency_stats(heavy_latencies, duration), 'statuses': dict(heavy_statuses)},
+            'cheap': {**latency_stats(cheap_latencies, duration), 'statuses': dict(cheap_statuses)}}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="flood a server with large imports and measure cheap PATCH requests "
+                                        "next to them, run it with [admission] enabled = yes and no to compare "
+                                        "(needs the database from config.ini)")
+    parser.add_argument('--server', help="server started with gunicorn", choices=list(SERVERS), default='gthread')
+    parser.add_argument('--url', help="URL of an already running server instead of --server")
+    parser.add_argument('--workers', help="number of gunicorn workers, by default as in the configs", type=int)
+    parser.add_argument('--port', help="port for the server", type=int, default=8090)
+    parser.add_argument('--citizens', help="number of citizens in the import, which is changed", type=int,
+                        default=1000)
+    parser.add_argument('--import-citizens', help="number of citizens in imports sent by heavy clients", type=int,
+                        default=20000)
+    parser.add_argument('--heavy', help="number of clients sending imports", type=int, default=16)
+    parser.add_argument('--cheap', help="number of clients sending PATCH", type=int, default=4)
+    parser.add_argument('--duration', help="seconds of load", type=float, default=30)
+    parser.add_argument('--seed', help="random seed of the data and of the requests", type=int, default=0)
+    parser.add_argument('--output', help="JSON file for the results, "
+                                         "by default benchmarks/results/admission-<commit>.json")
+    args = parser.parse_args()
+
+    citizens = generate_import(args.citizens, args.citizens, seed=args.seed)
+    body = json.dumps(generate_import(args.import_citizens, args.import_citizens, seed=args.seed + 1)).encode()
+
+    server = None if args.url else start_server(args.server, args.port, args.workers)
+    try:
+        base_url = args.url or 'http://127.0.0.1:{}'.format(args.port)
+        import_id = asyncio.run(prepare_import(base_url, citizens))
+        results = asyncio.run(run_load(base_url, import_id, args.citizens, body, args.heavy, args.cheap,
+                                       args.duration, args.seed))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    printing_template = "{:>8}{:>8}{:>12}{:>12}{:>12}  {}"
+    print(printing_template.format("kind", "ok", "p50, ms", "p95, ms", "p99, ms", "statuses"))
+    for kind, stats in results.items():
+        print(printing_template.format(kind, stats['count'], stats.get('p50_ms', '-'), stats.get('p95_ms', '-'),
+                                       stats.get('p99_ms', '-'), json.dumps(stats['statuses'], sort_keys=True)))
+    print("results are written to", write_report('admission', args, results, args.output))
@@ -0,0 +1,96 @@
+import sys
+import timeit
+from pathlib import Path
+from argparse import ArgumentParser
+from collections import defaultdict
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+import config
+from generator import generate_import
+from database import DBHelper, Singleton
+from migrations import migrate
+
+
+def get_presents_num_per_month_python(db_helper: DBHelper, import_id: int) -> dict:
+    # DBHelper.get_presents_num_per_month before the aggregation was moved to PostgreSQL
+    with db_helper._pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT id, citizen_id, birth_date FROM citizens WHERE import_id = %s;", (import_id,))
+            citizens = {
+                citizen_data[0]: {'citizen_id': citizen_data[1], 'birth_date': citizen_data[2], 'relatives': []}
+                for citizen_data in cursor.fetchall()}
+
+            cursor.execute(
+                "SELECT c.id, r.id1 FROM citizens c, relatives r "
+                "WHERE c.id = r.id2 AND c.import_id = %(import_id)s "
+                "UNION "
+                "SELECT c.id, r.id2 FROM citizens c, relatives r "
+                "WHERE c.id = r.id1 AND c.import_id = %(import_id)s AND r.id1 != r.id2;",
+                {"import_id": import_id})
+            for pair in cursor.fetchall():
+                citizens[pair[0]]['relatives'].append(pair[1])
+
+            presents_num_per_month = {month: defaultdict(lambda: 0) for month in range(1, 13)}
+            for citizen_db_id, citizen in citizens.items():
+                for relative_db_id in citizen['relatives']:
+                    relative_birth_date = citizens[relative_db_id]['birth_date']
+                    presents_num_per_month[relative_birth_date.month][citizens[citizen_db_id]['citizen_id']] += 1
+
+    presents_num_per_month_result = dict()
+    for month in presents_num_per_month.keys():
+        presents_num_per_month_result[str(month)] = [{'citizen_id': citizen_id,
+                                                      'presents': presents_num_per_month[month][citizen_id]}
+                                                     for citizen_id in presents_num_per_month[month].keys()]
+    return presents_num_per_month_result
+
+
+def sort_result(presents_num_per_month: dict) -> dict:
+    # the order of citizens inside a month was never defined
+    return {month: sorted(presents, key=lambda x: x['citizen_id'])
+            for month, presents in presents_num_per_month.items()}
+
+
+def make_db_helper(snapshots: bool) -> DBHelper:
+    # without the result cache, otherwise repeated runs only measure its hits. With snapshots the first run builds
+    # the snapshot and the others are answered from it. DBHelper is a singleton, so the instance with other
+    # settings is made after the previous one is forgotten, the previous one still works
+    Singleton._instances.pop(DBHelper, None)
+    return DBHelper(pool_settings=config.get_pool_settings(), cache_settings={'enabled': False},
+                    snapshot_settings={'enabled': snapshots}, **config.get_db_requisites())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="compare birthdays aggregation in Python, in PostgreSQL and on the import "
+                                        "snapshot")
+    parser.add_argument('--citizens', help="number of citizens", type=int, default=10000)
+    parser.add_argument('--relatives', help="number of relations between citizens", type=int, default=50000)
+    parser.add_argument('--repeat', help="number of runs, the best one is reported", type=int, default=5)
+    args = parser.parse_args()
+
+    migrate(**config.get_db_requisites())
+    db_helper = make_db_helper(snapshots=False)
+    snapshot_db_helper = make_db_helper(snapshots=True)
+    import_id = db_helper.import_citizens(generate_import(args.citizens, args.relatives))
+    # fresh statistics, as autovacuum would collect them after a big import
+    with db_helper._pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE citizens, relatives;")
+
+    python_result = get_presents_num_per_month_python(db_helper, import_id)
+    sql_result = db_helper.get_presents_num_per_month(import_id)
+    snapshot_result = snapshot_db_helper.get_presents_num_per_month(import_id)
+    assert sort_result(python_result) == sort_result(sql_result) == sort_result(snapshot_result), "results differ"
+
+    python_time = min(timeit.repeat(lambda: get_presents_num_per_month_python(db_helper, import_id),
+                                    number=1, repeat=args.repeat))
+    sql_time = min(timeit.repeat(lambda: db_helper.get_presents_num_per_month(import_id),
+                                 number=1, repeat=args.repeat))
+    snapshot_time = min(timeit.repeat(lambda: snapshot_db_helper.get_presents_num_per_month(import_id),
+                                      number=1, repeat=args.repeat))
+    print("import_id {}: {} citizens, {} relations".format(import_id, args.citizens, args.relatives))
+    print("{:30}{:.4f} s".format("aggregation in Python", python_time))
+    print("{:30}{:.4f} s".format("aggregation in PostgreSQL", sql_time))
+    print("{:30}{:.4f} s".format("aggregation on the snapshot", snapshot_time))
+    print("{:30}{:.1f}x".format("speedup of PostgreSQL", python_time / sql_time))
+    print("{:30}{:.1f}x".format("speedup of the snapshot", sql_time / snapshot_time))
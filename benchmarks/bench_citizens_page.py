@@ -0,0 +1,65 @@
+import sys
+import timeit
+from pathlib import Path
+from argparse import ArgumentParser
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+import config
+from generator import generate_import
+from database import DBHelper
+from migrations import migrate
+
+
+def read_all_pages(db_helper: DBHelper, import_id: int, revision: str, limit: int, fields: tuple) -> list:
+    citizens, after = [], -1
+    while after is not None:
+        page, after = db_helper.get_citizens_page(import_id, revision, limit, after, fields)
+        citizens.extend(page)
+    return citizens
+
+
+def check_pages(db_helper: DBHelper, import_id: int, limit: int):
+    # pages read one after another must give the whole import, ordered by citizen_id
+    revision = db_helper.get_import_revision(import_id)
+    expected = sorted(db_helper.get_citizens(import_id, revision), key=lambda citizen: citizen['citizen_id'])
+    pages = read_all_pages(db_helper, import_id, revision, limit, DBHelper.CITIZEN_FIELDS)
+    for citizen in expected + pages:
+        citizen['relatives'].sort()
+    assert pages == expected, "pages differ from the whole import"
+    names = read_all_pages(db_helper, import_id, revision, limit, ('citizen_id', 'name'))
+    assert names == [{'citizen_id': citizen['citizen_id'], 'name': citizen['name']} for citizen in expected], \
+        "projection differs from the whole import"
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="time pages of GET /imports/$import_id/citizens at the start and the end "
+                                        "of imports of different sizes")
+    parser.add_argument('--citizens', help="numbers of citizens", type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--limit', help="citizens per page", type=int, default=100)
+    parser.add_argument('--repeat', help="number of runs, the best one is reported", type=int, default=20)
+    args = parser.parse_args()
+
+    migrate(**config.get_db_requisites())
+    db_helper = DBHelper(pool_settings=config.get_pool_settings(), cache_settings={'enabled': False},
+                         **config.get_db_requisites())
+    printing_template = "{:>10}{:>12}{:>16}{:>16}{:>16}"
+    print(printing_template.format("citizens", "whole, s", "first page, s", "last page, s", "id,name page, s"))
+    for citizens_num in args.citizens:
+        import_id = db_helper.import_citizens(generate_import(citizens_num, citizens_num, family_size=10))
+        with db_helper._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("ANALYZE citizens, relatives;")
+        check_pages(db_helper, import_id, args.limit)
+
+        revision = db_helper.get_import_revision(import_id)
+        last_after = citizens_num - args.limit
+        whole_time = min(timeit.repeat(lambda: db_helper.get_citizens(import_id, revision),
+                                       number=1, repeat=max(1, args.repeat // 10)))
+        first_time, last_time, names_time = [
+            min(timeit.repeat(lambda: db_helper.get_citizens_page(import_id, revision, args.limit, after, fields),
+                              number=1, repeat=args.repeat))
+            for after, fields in ((-1, DBHelper.CITIZEN_FIELDS), (last_after, DBHelper.CITIZEN_FIELDS),
+                                  (last_after, ('citizen_id', 'name')))]
+        print(printing_template.format(citizens_num, "{:.4f}".format(whole_time), "{:.5f}".format(first_time),
+                                       "{:.5f}".format(last_time), "{:.5f}".format(names_time)))
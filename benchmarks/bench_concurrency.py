@@ -0,0 +1,138 @@
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import subprocess
+from pathlib import Path
+from argparse import ArgumentParser
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+import aiohttp
+from generator import generate_import
+
+SCRIPTS_DIR = str(Path(__file__).absolute().parent.parent) + '/scripts'
+# name -> gunicorn arguments
+SERVERS = {
+    'gthread': ['-c', 'gunicorn_config.py', 'server:app'],
+    'asyncio': ['-c', 'gunicorn_async_config.py', 'async_server:app'],
+}
+REQUEST_KINDS = ('citizens', 'birthdays', 'towns', 'patch', 'import')
+
+
+def start_server(name: str, port: int, workers: int = None) -> subprocess.Popen:
+    command = [sys.executable, '-m', 'gunicorn', '-b', '127.0.0.1:{}'.format(port)] + SERVERS[name]
+    if workers:
+        command[-1:-1] = ['-w', str(workers)]
+    process = subprocess.Popen(command, cwd=SCRIPTS_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("{} server didn't start on port {}".format(name, port))
+
+
+def percentile(latencies: list, q: float) -> float:
+    return latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))]
+
+
+async def run_client(session, base_url: str, import_id: int, citizens_num: int, small_import: dict,
+                     weights: list, deadline: float, latencies: list, errors: list, rnd: random.Random):
+    # one client sends requests of the routes chosen randomly with weights one by one
+    while time.monotonic() < deadline:
+        kind = rnd.choices(REQUEST_KINDS, weights=weights)[0]
+        started = time.monotonic()
+        if kind == 'import':
+            request = session.post(base_url + '/imports', json=small_import)
+        elif kind == 'patch':
+            request = session.patch('{}/imports/{}/citizens/{}'.format(base_url, import_id,
+                                                                        rnd.randint(1, citizens_num)),
+                                    json={'name': 'Имя {}'.format(rnd.randint(1, 1000))})
+        else:
+            path = {'citizens': 'citizens', 'birthdays': 'citizens/birthdays',
+                    'towns': 'towns/stat/percentile/age'}[kind]
+            request = session.get('{}/imports/{}/{}'.format(base_url, import_id, path))
+        try:
+            async with request as response:
+                await response.read()
+                if response.status >= 300:
+                    errors.append(response.status)
+        except aiohttp.ClientError as e:
+            # e.g. a keep-alive connection closed by a worker restarted after max_requests
+            errors.append(type(e).__name__)
+            continue
+        latencies.append(time.monotonic() - started)
+
+
+async def run_load(base_url: str, import_id: int, citizens_num: int, small_import: dict, weights: list,
+                   concurrency: int, duration: float, seed: int) -> dict:
+    latencies, errors = [], []
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        deadline = time.monotonic() + duration
+        await asyncio.gather(*(run_client(session, base_url, import_id, citizens_num, small_import, weights,
+                                          deadline, latencies, errors, random.Random(seed + i))
+                               for i in range(concurrency)))
+    latencies.sort()
+    return {'requests': len(latencies),
+            'errors': len(errors),
+            'rps': len(latencies) / duration,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99)}
+
+
+async def prepare_import(base_url: str, citizens: dict) -> int:
+    async with aiohttp.ClientSession() as session:
+        async with session.post(base_url + '/imports', json=citizens) as response:
+            return (await response.json())['data']['import_id']
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="compare throughput of the gthread and asyncio servers "
+                                        "under concurrent clients (needs the database from config.ini)")
+    parser.add_argument('--citizens', help="number of citizens in the import, which is read", type=int,
+                        default=1000)
+    parser.add_argument('--relatives', help="number of relations in the import, which is read", type=int,
+                        default=2000)
+    parser.add_argument('--import-citizens', help="number of citizens in imports sent by clients", type=int,
+                        default=200)
+    parser.add_argument('--weights', help="weights of requests: " + ', '.join(REQUEST_KINDS), type=int, nargs=5,
+                        default=[3, 3, 3, 2, 1])
+    parser.add_argument('--duration', help="seconds of load for every concurrency", type=float, default=10)
+    parser.add_argument('--workers', help="number of gunicorn workers, by default as in the configs", type=int)
+    parser.add_argument('--port', help="port for the servers", type=int, default=8090)
+    parser.add_argument('concurrency', help="numbers of concurrent clients", type=int, nargs='*',
+                        default=[1, 8, 32, 128])
+    args = parser.parse_args()
+
+    citizens = generate_import(args.citizens, args.relatives)
+    small_import = generate_import(args.import_citizens, args.import_citizens, seed=1)
+
+    results = dict()
+    for name in SERVERS:
+        server = start_server(name, args.port, args.workers)
+        try:
+            base_url = 'http://127.0.0.1:{}'.format(args.port)
+            import_id = asyncio.run(prepare_import(base_url, citizens))
+            results[name] = {concurrency: asyncio.run(run_load(base_url, import_id, args.citizens, small_import,
+                                                               args.weights, concurrency, args.duration,
+                                                               seed=concurrency))
+                             for concurrency in args.concurrency}
+        finally:
+            server.terminate()
+            server.wait()
+
+    print("{:>10}{:>10}{:>12}{:>12}{:>12}{:>8}".format("server", "clients", "req/s", "p50, ms", "p99, ms", "errors"))
+    for name, server_results in results.items():
+        for concurrency, result in server_results.items():
+            print("{:>10}{:>10}{:>12.1f}{:>12.1f}{:>12.1f}{:>8}".format(name, concurrency, result['rps'],
+                                                                       result['p50'] * 1000, result['p99'] * 1000,
+                                                                       result['errors']))
+    print(json.dumps(results))
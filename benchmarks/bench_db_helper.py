@@ -0,0 +1,97 @@
+import sys
+import time
+import random
+from pathlib import Path
+from argparse import ArgumentParser
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+import config
+from generator import generate_import, generate_patch
+from report import latency_stats, write_report
+from database import DBHelper
+from migrations import migrate
+
+
+def consume(iterable):
+    for _ in iterable:
+        pass
+
+
+# name -> one call of the DBHelper method: (db_helper, import_id of the read import, its size, small import, rnd)
+METHODS = {
+    'import_citizens': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.import_citizens(small_import),
+    'import_citizens_stream': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.import_citizens_stream(iter(small_import['citizens'])),
+    'get_import_revision': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.get_import_revision(import_id),
+    'get_citizens': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.get_citizens(import_id),
+    'get_citizens_json': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.get_citizens_json(import_id),
+    'get_citizens_stream': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        consume(db_helper.get_citizens_stream(import_id)),
+    'get_citizen': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.get_citizen(import_id, rnd.randint(1, citizens_num)),
+    'get_citizen_json': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.get_citizen_json(import_id, rnd.randint(1, citizens_num)),
+    'change_citizen': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.change_citizen(import_id, rnd.randint(1, citizens_num), generate_patch(rnd, citizens_num)),
+    'change_relatives': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.change_relatives(import_id, rnd.randint(1, citizens_num),
+                                   rnd.sample(range(1, citizens_num + 1), rnd.randint(0, 5))),
+    'get_presents_num_per_month': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.get_presents_num_per_month(import_id),
+    'get_town_stat': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.get_town_stat(import_id),
+}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="time every DBHelper method on a generated import "
+                                        "(needs the database from config.ini)")
+    parser.add_argument('--citizens', help="number of citizens in the import, which is read and changed", type=int,
+                        default=10000)
+    parser.add_argument('--relatives', help="number of relations in the import, which is read and changed",
+                        type=int, default=20000)
+    parser.add_argument('--family', help="size of families, relations are drawn inside them", type=int)
+    parser.add_argument('--import-citizens', help="number of citizens in the timed imports", type=int,
+                        default=1000)
+    parser.add_argument('--repeat', help="number of calls of every method", type=int, default=20)
+    parser.add_argument('--seed', help="random seed of the data and of the calls", type=int, default=0)
+    parser.add_argument('--output', help="JSON file for the results, "
+                                         "by default benchmarks/results/db_helper-<commit>.json")
+    parser.add_argument('methods', help="methods to time, all by default: " + ', '.join(METHODS), nargs='*')
+    args = parser.parse_args()
+    unknown_methods = set(args.methods) - set(METHODS)
+    if unknown_methods:
+        parser.error("unknown methods: " + ', '.join(sorted(unknown_methods)))
+
+    migrate(**config.get_db_requisites())
+    # without the result cache, otherwise repeated reads only measure cache hits
+    db_helper = DBHelper(pool_settings=config.get_pool_settings(), cache_settings={'enabled': False},
+                         **config.get_db_requisites())
+    import_id = db_helper.import_citizens(generate_import(args.citizens, args.relatives, seed=args.seed,
+                                                          family_size=args.family))
+    small_import = generate_import(args.import_citizens, args.import_citizens, seed=args.seed + 1)
+    # fresh statistics, as autovacuum would collect them after a big import
+    with db_helper._pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE citizens, relatives;")
+
+    results = dict()
+    print("{:30}{:>10}{:>12}{:>12}{:>12}".format("method", "calls", "p50, ms", "p95, ms", "p99, ms"))
+    for name in args.methods or METHODS:
+        # the same calls on every run with the same seed
+        rnd = random.Random(args.seed)
+        latencies = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            METHODS[name](db_helper, import_id, args.citizens, small_import, rnd)
+            latencies.append(time.perf_counter() - started)
+        results[name] = latency_stats(latencies)
+        print("{:30}{:>10}{:>12.3f}{:>12.3f}{:>12.3f}".format(name, args.repeat, results[name]['p50_ms'],
+                                                              results[name]['p95_ms'], results[name]['p99_ms']))
+
+    print("results are written to", write_report('db_helper', args, results, args.output))
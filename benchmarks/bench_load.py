@@ -0,0 +1,110 @@
+import sys
+import time
+import random
+import asyncio
+from pathlib import Path
+from argparse import ArgumentParser
+from collections import defaultdict, Counter
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+import aiohttp
+from generator import generate_import, generate_patch
+from report import latency_stats, write_report
+from bench_concurrency import SERVERS, REQUEST_KINDS, start_server, prepare_import
+
+
+def make_request(session, base_url: str, kind: str, import_id: int, citizens_num: int, small_import: dict,
+                 rnd: random.Random):
+    if kind == 'import':
+        return session.post(base_url + '/imports', json=small_import)
+    if kind == 'patch':
+        return session.patch('{}/imports/{}/citizens/{}'.format(base_url, import_id, rnd.randint(1, citizens_num)),
+                             json=generate_patch(rnd, citizens_num))
+    path = {'citizens': 'citizens', 'birthdays': 'citizens/birthdays', 'towns': 'towns/stat/percentile/age'}[kind]
+    return session.get('{}/imports/{}/{}'.format(base_url, import_id, path))
+
+
+async def run_client(session, base_url: str, import_id: int, citizens_num: int, small_import: dict,
+                     weights: list, warmup_deadline: float, deadline: float, latencies: dict, statuses: dict,
+                     rnd: random.Random):
+    # requests sent before warmup_deadline aren't counted
+    while time.monotonic() < deadline:
+        kind = rnd.choices(REQUEST_KINDS, weights=weights)[0]
+        started = time.monotonic()
+        try:
+            async with make_request(session, base_url, kind, import_id, citizens_num, small_import, rnd) as response:
+                await response.read()
+                status = response.status
+        except aiohttp.ClientError as e:
+            status = type(e).__name__
+        if started >= warmup_deadline:
+            statuses[kind][str(status)] += 1
+            if status in (200, 201):
+                latencies[kind].append(time.monotonic() - started)
+
+
+async def run_load(base_url: str, import_id: int, citizens_num: int, small_import: dict, weights: list,
+                   concurrency: int, warmup: float, duration: float, seed: int) -> dict:
+    latencies, statuses = defaultdict(list), defaultdict(Counter)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        warmup_deadline = time.monotonic() + warmup
+        await asyncio.gather(*(run_client(session, base_url, import_id, citizens_num, small_import, weights,
+                                          warmup_deadline, warmup_deadline + duration, latencies, statuses,
+                                          random.Random(seed + i))
+                               for i in range(concurrency)))
+
+    # count, rps and percentiles are of successful responses only
+    routes = {kind: {**latency_stats(latencies[kind], duration), 'statuses': dict(statuses[kind]),
+                     'errors': sum(statuses[kind].values()) - len(latencies[kind])}
+              for kind in REQUEST_KINDS if statuses[kind]}
+    total = latency_stats([latency for kind in REQUEST_KINDS for latency in latencies[kind]], duration)
+    total['errors'] = sum(route['errors'] for route in routes.values())
+    return {'total': total, 'routes': routes}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="load all five routes of a server with concurrent clients "
+                                        "and write throughput and latency percentiles to a JSON file "
+                                        "(needs the database from config.ini)")
+    parser.add_argument('--server', help="server started with gunicorn", choices=list(SERVERS), default='gthread')
+    parser.add_argument('--url', help="URL of an already running server instead of --server")
+    parser.add_argument('--workers', help="number of gunicorn workers, by default as in the configs", type=int)
+    parser.add_argument('--port', help="port for the server", type=int, default=8090)
+    parser.add_argument('--citizens', help="number of citizens in the import, which is read and changed", type=int,
+                        default=10000)
+    parser.add_argument('--relatives', help="number of relations in the import, which is read and changed",
+                        type=int, default=20000)
+    parser.add_argument('--family', help="size of families, relations are drawn inside them", type=int)
+    parser.add_argument('--import-citizens', help="number of citizens in imports sent by clients", type=int,
+                        default=200)
+    parser.add_argument('--weights', help="weights of requests: " + ', '.join(REQUEST_KINDS), type=int, nargs=5,
+                        default=[3, 3, 3, 2, 1])
+    parser.add_argument('--concurrency', help="number of concurrent clients", type=int, default=16)
+    parser.add_argument('--warmup', help="seconds of load, which isn't counted", type=float, default=3)
+    parser.add_argument('--duration', help="seconds of counted load", type=float, default=30)
+    parser.add_argument('--seed', help="random seed of the data and of the requests", type=int, default=0)
+    parser.add_argument('--output', help="JSON file for the results, by default benchmarks/results/load-<commit>.json")
+    args = parser.parse_args()
+
+    citizens = generate_import(args.citizens, args.relatives, seed=args.seed, family_size=args.family)
+    small_import = generate_import(args.import_citizens, args.import_citizens, seed=args.seed + 1)
+
+    server = None if args.url else start_server(args.server, args.port, args.workers)
+    try:
+        base_url = args.url or 'http://127.0.0.1:{}'.format(args.port)
+        import_id = asyncio.run(prepare_import(base_url, citizens))
+        results = asyncio.run(run_load(base_url, import_id, args.citizens, small_import, args.weights,
+                                       args.concurrency, args.warmup, args.duration, args.seed))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    printing_template = "{:>10}{:>10}{:>10}{:>12}{:>12}{:>12}{:>12}"
+    print(printing_template.format("route", "ok", "errors", "req/s", "p50, ms", "p95, ms", "p99, ms"))
+    for kind, stats in list(results['routes'].items()) + [('total', results['total'])]:
+        print(printing_template.format(kind, stats['count'], stats['errors'], stats['rps'],
+                                       stats.get('p50_ms', '-'), stats.get('p95_ms', '-'), stats.get('p99_ms', '-')))
+    print("results are written to", write_report('load', args, results, args.output))
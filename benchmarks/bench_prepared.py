@@ -0,0 +1,89 @@
+import sys
+import time
+import random
+import statistics
+from pathlib import Path
+from argparse import ArgumentParser
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+import config
+from generator import generate_import
+from bench_db_helper import METHODS
+from database import DBHelper, Singleton
+from migrations import migrate
+
+# small requests, where planning is a big part of the time
+SMALL_METHODS = {
+    'get_import_revision': METHODS['get_import_revision'],
+    'get_citizen': METHODS['get_citizen'],
+    'get_citizen_json': METHODS['get_citizen_json'],
+    'get_citizens_page': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.get_citizens_page(import_id, db_helper.get_import_revision(import_id), 10,
+                                    rnd.randint(0, citizens_num), DBHelper.CITIZEN_FIELDS),
+    'change_citizen': METHODS['change_citizen'],
+    # PATCH of the same fields, which is a single prepared statement
+    'change_citizen_name': lambda db_helper, import_id, citizens_num, small_import, rnd:
+        db_helper.change_citizen(import_id, rnd.randint(1, citizens_num), {'name': 'Имя {}'.format(rnd.random())}),
+}
+
+
+# column -> [prepared_statements] settings
+SETTINGS = {
+    'not prepared, ms': {'enabled': False},
+    'custom plans, ms': {'enabled': True, 'plan_cache_mode': 'force_custom_plan'},
+    'auto plans, ms': {'enabled': True, 'plan_cache_mode': 'auto'},
+}
+
+
+def make_db_helper(prepared_settings: dict) -> DBHelper:
+    # DBHelper is a singleton, so the instance with other settings is made after the previous one is forgotten,
+    # the previous one still works. A single connection, so every call after the first one finds its statements
+    # prepared
+    Singleton._instances.pop(DBHelper, None)
+    return DBHelper(pool_settings={'min_size': 1, 'max_size': 1}, cache_settings={'enabled': False},
+                    snapshot_settings={'enabled': False}, prepared_settings=prepared_settings,
+                    **config.get_db_requisites())
+
+
+def time_method(db_helpers: dict, method, import_id: int, citizens_num: int, calls: int, batch: int,
+                seed: int) -> dict:
+    # column -> median seconds per call of batches. Batches of the settings alternate with the same requests,
+    # so changes of the load of the machine affect all of them
+    batches = {column: [] for column in db_helpers}
+    for batch_index in range(0, calls, batch):
+        for column, db_helper in db_helpers.items():
+            rnd = random.Random(seed + batch_index)
+            started = time.perf_counter()
+            for _ in range(batch):
+                method(db_helper, import_id, citizens_num, None, rnd)
+            batches[column].append((time.perf_counter() - started) / batch)
+    return {column: statistics.median(seconds) for column, seconds in batches.items()}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="compare small DBHelper requests with and without prepared statements "
+                                        "(needs the database from config.ini)")
+    parser.add_argument('--citizens', help="number of citizens in the import", type=int, default=10000)
+    parser.add_argument('--calls', help="number of calls of each method with each settings", type=int, default=2000)
+    parser.add_argument('--batch', help="number of calls in a batch, the median of batches is reported", type=int,
+                        default=20)
+    parser.add_argument('--seed', help="seed of the random requests", type=int, default=0)
+    args = parser.parse_args()
+
+    migrate(**config.get_db_requisites())
+    db_helper = make_db_helper(SETTINGS['not prepared, ms'])
+    import_id = db_helper.import_citizens(generate_import(args.citizens, args.citizens, family_size=10))
+    with db_helper._pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE citizens, relatives;")
+            cursor.execute("SELECT count(*) FROM pg_inherits WHERE inhparent = 'citizens'::regclass;")
+            partitions_num = cursor.fetchone()[0]
+    print("{} citizens, {} imports in the database, {} calls".format(args.citizens, partitions_num, args.calls))
+
+    db_helpers = {column: make_db_helper(prepared_settings) for column, prepared_settings in SETTINGS.items()}
+    printing_template = "{:>22}" + "{:>18}" * len(SETTINGS)
+    print(printing_template.format("method", *SETTINGS))
+    for name, method in SMALL_METHODS.items():
+        results = time_method(db_helpers, method, import_id, args.citizens, args.calls, args.batch, args.seed)
+        print(printing_template.format(name, *["{:.3f}".format(results[column] * 1000) for column in SETTINGS]))
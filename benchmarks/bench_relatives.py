@@ -0,0 +1,114 @@
+import sys
+import time
+import random
+from pathlib import Path
+from argparse import ArgumentParser
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+import config
+from generator import generate_import
+from report import latency_stats, write_report
+from database import DBHelper
+from migrations import migrate
+
+# queries of DBHelper for relatives stored once per relation, they are run against a copy of relatives
+# in this layout in the schema bench_legacy, which goes before public in search_path
+LEGACY_SCHEMA = 'bench_legacy'
+LEGACY_QUERIES = {
+    'relatives_pairs': ("SELECT c.id, r.id1 FROM citizens c, relatives r "
+                        "WHERE c.id = r.id2 AND c.import_id = %(import_id)s "
+                        "UNION "
+                        "SELECT c.id, r.id2 FROM citizens c, relatives r "
+                        "WHERE c.id = r.id1 AND c.import_id = %(import_id)s AND r.id1 != r.id2;"),
+    'presents_num': ("SELECT EXTRACT(MONTH FROM rc.birth_date)::INT AS month, p.citizen_id, COUNT(*) FROM ("
+                     "SELECT c.citizen_id, r.id1 AS relative_id FROM citizens c, relatives r "
+                     "WHERE c.id = r.id2 AND c.import_id = %(import_id)s "
+                     "UNION "
+                     "SELECT c.citizen_id, r.id2 FROM citizens c, relatives r "
+                     "WHERE c.id = r.id1 AND c.import_id = %(import_id)s AND r.id1 != r.id2"
+                     ") p, citizens rc WHERE rc.id = p.relative_id "
+                     "GROUP BY month, p.citizen_id;"),
+    'citizen_relatives': ("SELECT c.citizen_id FROM citizens c, relatives r "
+                          "WHERE r.id1 = %(id)s AND r.id2 = c.id OR r.id1 = c.id AND r.id2 = %(id)s;"),
+    'citizen_relatives_db_ids': ("SELECT c.id FROM citizens c, relatives r "
+                                 "WHERE r.id1 = %(id)s AND r.id2 = c.id OR r.id1 = c.id AND r.id2 = %(id)s;"),
+}
+QUERIES = {
+    'relatives_pairs': DBHelper.SELECT_RELATIVES_PAIRS,
+    'presents_num': DBHelper.SELECT_PRESENTS_NUM,
+    'citizen_relatives': DBHelper.SELECT_CITIZEN_RELATIVES,
+    'citizen_relatives_db_ids': DBHelper.SELECT_CITIZEN_RELATIVES_DB_IDS,
+}
+# queries of a whole import are run repeat times, queries of a citizen - for citizen_queries random citizens
+IMPORT_QUERIES = ('relatives_pairs', 'presents_num')
+
+
+def run_query(cursor, query: str, params: dict, calls: list) -> tuple:
+    # (latencies, sorted rows of the last call for the comparison of the layouts)
+    latencies, rows = [], []
+    for call_params in calls:
+        started = time.perf_counter()
+        cursor.execute(query, {**params, **call_params})
+        rows = cursor.fetchall()
+        latencies.append(time.perf_counter() - started)
+    return latencies, sorted(rows)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="compare reads of relatives stored in both directions with the primary key "
+                                        "and of relatives stored once (needs the database from config.ini)")
+    parser.add_argument('--citizens', help="number of citizens", type=int, default=10000)
+    parser.add_argument('--relatives', help="number of relations between citizens", type=int, default=50000)
+    parser.add_argument('--family', help="size of families, relations are drawn inside them", type=int)
+    parser.add_argument('--repeat', help="number of runs of queries of the whole import", type=int, default=10)
+    parser.add_argument('--citizen-queries', help="number of runs of queries of a citizen", type=int, default=1000)
+    parser.add_argument('--seed', help="random seed", type=int, default=0)
+    parser.add_argument('--output', help="JSON file for the results, "
+                                         "by default benchmarks/results/relatives-<commit>.json")
+    args = parser.parse_args()
+
+    # tables are created and migrated as by the gunicorn master
+    migrate(**config.get_db_requisites())
+    db_helper = DBHelper(pool_settings=config.get_pool_settings(), cache_settings={'enabled': False},
+                         **config.get_db_requisites())
+    import_id = db_helper.import_citizens(generate_import(args.citizens, args.relatives, seed=args.seed,
+                                                          family_size=args.family))
+    rnd = random.Random(args.seed)
+
+    results = dict()
+    with db_helper._pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT min(id), max(id) FROM citizens WHERE import_id = %s;", (import_id,))
+            first_id, last_id = cursor.fetchone()
+            citizen_calls = [{'id': rnd.randint(first_id, last_id)} for _ in range(args.citizen_queries)]
+
+            cursor.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; "
+                           "CREATE TABLE {0}.relatives AS SELECT id1, id2 FROM public.relatives WHERE id1 <= id2; "
+                           "CREATE INDEX ON {0}.relatives (id1); CREATE INDEX ON {0}.relatives (id2); "
+                           "ANALYZE citizens, relatives, {0}.relatives;".format(LEGACY_SCHEMA))
+            conn.commit()
+            try:
+                for name in QUERIES:
+                    calls = [{}] * args.repeat if name in IMPORT_QUERIES else citizen_calls
+                    cursor.execute("SET search_path TO {}, public;".format(LEGACY_SCHEMA))
+                    legacy_latencies, legacy_rows = run_query(cursor, LEGACY_QUERIES[name], {'import_id': import_id},
+                                                              calls)
+                    cursor.execute("SET search_path TO public;")
+                    latencies, rows = run_query(cursor, QUERIES[name], {'import_id': import_id}, calls)
+                    assert legacy_rows == rows, "results of {} differ".format(name)
+                    results[name] = {'once': latency_stats(legacy_latencies),
+                                     'both_directions': latency_stats(latencies)}
+            finally:
+                conn.rollback()
+                cursor.execute("SET search_path TO public; DROP SCHEMA {} CASCADE;".format(LEGACY_SCHEMA))
+                conn.commit()
+
+    printing_template = "{:26}{:>8}{:>18}{:>18}{:>10}"
+    print("import_id {}: {} citizens, {} relations".format(import_id, args.citizens, args.relatives))
+    print(printing_template.format("query", "calls", "once p50, ms", "both p50, ms", "speedup"))
+    for name, result in results.items():
+        once, both_directions = result['once']['p50_ms'], result['both_directions']['p50_ms']
+        print(printing_template.format(name, result['once']['count'], once, both_directions,
+                                       "{:.1f}x".format(once / both_directions)))
+    print("results are written to", write_report('relatives', args, results, args.output))
@@ -0,0 +1,102 @@
+import sys
+import timeit
+import random
+from pathlib import Path
+from argparse import ArgumentParser
+from numpy import percentile, ceil, array
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+import config
+from generator import generate_import
+from database import DBHelper, Singleton
+from migrations import migrate
+
+
+def get_town_stat_per_town(db_helper: DBHelper, import_id: int) -> list:
+    # DBHelper.get_town_stat before it was made set-based: one query and one numpy.percentile per town
+    with db_helper._pool.connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT town FROM citizens WHERE import_id = %s;", (import_id,))
+            towns = [town[0] for town in cursor.fetchall()]
+            percentiles = (50, 75, 99)
+            town_stat = []
+            for town in towns:
+                cursor.execute("SELECT birth_date FROM citizens WHERE import_id = %s AND town = %s;",
+                               (import_id, town))
+                ages = [db_helper.calculate_age(birth_date[0]) for birth_date in cursor.fetchall()]
+                age_percentiles = ceil(percentile(ages, percentiles)).astype(int).tolist()
+                keys = ["town"] + list(map(lambda x: "p" + str(x), percentiles))
+                values = [town] + age_percentiles
+                town_stat.append(dict(zip(keys, values)))
+
+    return town_stat
+
+
+def check_grouped_percentiles(groups_num: int, seed: int):
+    # DBHelper.grouped_percentiles must give exactly what numpy.percentile gives for each group
+    rnd = random.Random(seed)
+    percentiles = (50, 75, 99) + tuple(rnd.randint(0, 100) for _ in range(5))
+    group_codes, values = [], []
+    for code in range(groups_num):
+        size = rnd.choice((1, 2, 3, rnd.randint(1, 20), rnd.randint(1, 1000)))
+        group_codes.extend([code] * size)
+        values.extend(rnd.randint(0, 100) for _ in range(size))
+    shuffled = list(zip(group_codes, values))
+    rnd.shuffle(shuffled)
+    group_codes, values = map(array, zip(*shuffled))
+
+    result = DBHelper.grouped_percentiles(group_codes, values, percentiles)
+    for code in range(groups_num):
+        expected = percentile(values[group_codes == code], percentiles)
+        assert (result[code] == expected).all(), "group {}: {} != {}".format(code, result[code], expected)
+
+
+def make_db_helper(snapshots: bool) -> DBHelper:
+    # without the result cache, otherwise repeated runs only measure its hits. With snapshots the first run builds
+    # the snapshot and the others are answered from it. DBHelper is a singleton, so the instance with other
+    # settings is made after the previous one is forgotten, the previous one still works
+    Singleton._instances.pop(DBHelper, None)
+    return DBHelper(pool_settings=config.get_pool_settings(), cache_settings={'enabled': False},
+                    snapshot_settings={'enabled': snapshots}, **config.get_db_requisites())
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="check and time the set-based town age percentiles")
+    parser.add_argument('--citizens', help="number of citizens", type=int, default=10000)
+    parser.add_argument('--towns', help="number of towns", type=int, nargs='+', default=[10, 1000, 5000])
+    parser.add_argument('--repeat', help="number of runs, the best one is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    for seed in range(20):
+        check_grouped_percentiles(200, seed)
+    print("grouped percentiles are equal to numpy.percentile")
+
+    migrate(**config.get_db_requisites())
+    db_helper = make_db_helper(snapshots=False)
+    snapshot_db_helper = make_db_helper(snapshots=True)
+    printing_template = "{:>10}{:>10}{:>16}{:>16}{:>10}{:>16}{:>10}"
+    print(printing_template.format("citizens", "towns", "per town, s", "set-based, s", "speedup", "snapshot, s",
+                                   "speedup"))
+    for towns_num in args.towns:
+        import_id = db_helper.import_citizens(generate_import(args.citizens, 0, towns_num))
+        with db_helper._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("ANALYZE citizens;")
+
+        def sort_key(x):
+            return x['town']
+        assert sorted(get_town_stat_per_town(db_helper, import_id), key=sort_key) == \
+            sorted(db_helper.get_town_stat(import_id), key=sort_key) == \
+            sorted(snapshot_db_helper.get_town_stat(import_id), key=sort_key), "results differ"
+
+        per_town_time = min(timeit.repeat(lambda: get_town_stat_per_town(db_helper, import_id),
+                                          number=1, repeat=args.repeat))
+        set_based_time = min(timeit.repeat(lambda: db_helper.get_town_stat(import_id),
+                                           number=1, repeat=args.repeat))
+        snapshot_time = min(timeit.repeat(lambda: snapshot_db_helper.get_town_stat(import_id),
+                                          number=1, repeat=args.repeat))
+        print(printing_template.format(args.citizens, towns_num, "{:.4f}".format(per_town_time),
+                                       "{:.4f}".format(set_based_time),
+                                       "{:.1f}x".format(per_town_time / set_based_time), "{:.4f}".format(snapshot_time),
+                                       "{:.1f}x".format(set_based_time / snapshot_time)))
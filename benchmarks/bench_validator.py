@@ -0,0 +1,66 @@
+import sys
+import timeit
+from pathlib import Path
+from argparse import ArgumentParser
+from fastjsonschema import compile, JsonSchemaException
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent) + '/scripts')
+
+from generator import generate_import
+from database import DBHelper
+from validator import ImportValidator
+
+compiled_import_schema_validator = compile(DBHelper.IMPORT_SCHEMA)
+
+
+def validate_three_passes(citizens: dict) -> bool:
+    # the validation of DBHelper.import_citizens before the fused validator
+    try:
+        compiled_import_schema_validator(citizens)
+    except JsonSchemaException:
+        return False
+
+    citizens = citizens['citizens']
+    for citizen in citizens:
+        if not DBHelper.validate_json_birth_date_format(citizen['birth_date']):
+            return False
+
+    relatives_ids = {citizen['citizen_id']: citizen['relatives'] for citizen in citizens}
+    for citizen_id, citizen_relatives_ids in relatives_ids.items():
+        for relative_id in citizen_relatives_ids:
+            if citizen_id not in relatives_ids[relative_id]:
+                return False
+    return True
+
+
+def validate_single_pass(citizens: dict) -> bool:
+    validator = ImportValidator()
+    validator.validate(citizens)
+    return not validator.errors
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="compare the three-pass and the single-pass import validation")
+    parser.add_argument('--citizens', help="number of citizens", type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--density', help="relations per citizen", type=float, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--family', help="size of families, relations are drawn inside them", type=int,
+                        nargs='+', default=[0, 500])
+    parser.add_argument('--repeat', help="number of runs, the best one is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    printing_template = "{:>10}{:>10}{:>10}{:>16}{:>16}{:>10}"
+    print(printing_template.format("citizens", "family", "density", "three passes, s", "single pass, s", "speedup"))
+    for citizens_num in args.citizens:
+        for family_size in args.family:
+            family_size = min(family_size or citizens_num, citizens_num)
+            for density in args.density:
+                # density can't exceed family_size - 1 relations per citizen
+                relatives_num = int(citizens_num * min(density, family_size - 1) / 2)
+                data = generate_import(citizens_num, relatives_num, family_size=family_size)
+                assert validate_three_passes(data) and validate_single_pass(data)
+                three_passes = min(timeit.repeat(lambda: validate_three_passes(data), number=1,
+                                                 repeat=args.repeat))
+                single_pass = min(timeit.repeat(lambda: validate_single_pass(data), number=1, repeat=args.repeat))
+                print(printing_template.format(citizens_num, family_size, density, "{:.4f}".format(three_passes),
+                                               "{:.4f}".format(single_pass),
+                                               "{:.1f}x".format(three_passes / single_pass)))
@@ -0,0 +1,94 @@
+import json
+import random
+import datetime
+from math import isqrt
+from bisect import bisect_right
+from argparse import ArgumentParser
+
+FIRST_NAMES = ('Иван', 'Мария', 'Петр', 'Анна', 'Сергей', 'Ольга', 'Дмитрий', 'Елена')
+LAST_NAMES = ('Иванов', 'Петрова', 'Сидоров', 'Смирнова', 'Кузнецов', 'Попова')
+STREETS = ('Ленина', 'Пушкина', 'Льва Толстого', 'Гагарина', 'Мира', 'Садовая')
+
+
+FIRST_DAY = datetime.date(1940, 1, 1).toordinal()
+LAST_DAY = datetime.date(2018, 12, 31).toordinal()
+
+
+def make_towns(towns_num: int) -> list:
+    return ['Город {}'.format(i) for i in range(towns_num)]
+
+
+def generate_citizen_fields(rnd: random.Random, towns: list) -> dict:
+    # all fields of a citizen except citizen_id and relatives
+    return {
+        'town': rnd.choice(towns),
+        'street': rnd.choice(STREETS),
+        'building': '{}к{}стр{}'.format(rnd.randint(1, 200), rnd.randint(1, 9), rnd.randint(1, 9)),
+        'apartment': rnd.randint(1, 500),
+        'name': '{} {}'.format(rnd.choice(LAST_NAMES), rnd.choice(FIRST_NAMES)),
+        'birth_date': datetime.date.fromordinal(rnd.randint(FIRST_DAY, LAST_DAY)).strftime('%d.%m.%Y'),
+        'gender': rnd.choice(('male', 'female')),
+    }
+
+
+def generate_patch(rnd: random.Random, citizens_num: int, towns_num: int = 10, max_fields: int = 3,
+                   relatives_share: float = 0.2, max_relatives: int = 5) -> dict:
+    # a valid body of PATCH /imports/$import_id/citizens/$citizen_id for an import of generate_import:
+    # 1..max_fields random fields, and in relatives_share of patches new relatives among citizens 1..citizens_num
+    fields = generate_citizen_fields(rnd, make_towns(towns_num))
+    patch = {field: fields[field] for field in rnd.sample(sorted(fields), rnd.randint(1, max_fields))}
+    if rnd.random() < relatives_share:
+        patch['relatives'] = rnd.sample(range(1, citizens_num + 1), rnd.randint(0, min(max_relatives, citizens_num)))
+    return patch
+
+
+def generate_import(citizens_num: int, relatives_num: int, towns_num: int = 10, seed: int = 0,
+                    family_size: int = None) -> dict:
+    # relatives_num - number of relations between different citizens, each one is listed on both sides,
+    # so the result always satisfies the relatives symmetry rule of DBHelper.import_citizens.
+    # Relations are drawn only inside families - groups of family_size consecutive citizens,
+    # so a small family_size with many relations gives dense relative graphs
+    family_size = max(1, min(family_size or citizens_num, citizens_num))
+    families = [min(family_size, citizens_num - first) for first in range(0, citizens_num, family_size)]
+    family_pairs_offsets = [0]
+    for size in families:
+        family_pairs_offsets.append(family_pairs_offsets[-1] + size * (size - 1) // 2)
+    if relatives_num > family_pairs_offsets[-1]:
+        raise ValueError("Too many relations for {} citizens: {}".format(citizens_num, relatives_num))
+
+    rnd = random.Random(seed)
+    towns = make_towns(towns_num)
+
+    citizens = [{'citizen_id': citizen_id, **generate_citizen_fields(rnd, towns), 'relatives': []}
+                for citizen_id in range(1, citizens_num + 1)]
+
+    for pair_index in rnd.sample(range(family_pairs_offsets[-1]), relatives_num):
+        # decode the index of a pair (first, second), first < second, inside its family
+        family = bisect_right(family_pairs_offsets, pair_index) - 1
+        pair_index -= family_pairs_offsets[family]
+        second = (1 + isqrt(8 * pair_index + 1)) // 2
+        first = pair_index - second * (second - 1) // 2
+        first, second = family * family_size + first, family * family_size + second
+        citizens[first]['relatives'].append(citizens[second]['citizen_id'])
+        citizens[second]['relatives'].append(citizens[first]['citizen_id'])
+
+    return {'citizens': citizens}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="generate a valid import for POST /imports")
+    parser.add_argument('citizens', help="number of citizens", type=int)
+    parser.add_argument('relatives', help="number of relations between citizens", type=int)
+    parser.add_argument('--towns', help="number of towns", type=int, default=10)
+    parser.add_argument('--family', help="size of families, relations are drawn inside them", type=int)
+    parser.add_argument('--seed', help="random seed", type=int, default=0)
+    parser.add_argument('--output', help="file for the import, stdout by default")
+    args = parser.parse_args()
+
+    data = json.dumps(generate_import(args.citizens, args.relatives, args.towns, args.seed, args.family),
+                      ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(data)
+    else:
+        print(data)
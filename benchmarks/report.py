@@ -0,0 +1,60 @@
+import sys
+import json
+import platform
+import datetime
+import subprocess
+from pathlib import Path
+
+ROOT_DIR = str(Path(__file__).absolute().parent.parent)
+RESULTS_DIR = ROOT_DIR + '/benchmarks/results/'
+PERCENTILES = (50, 95, 99)
+
+
+def git_revision() -> dict:
+    # results of different commits are compared by these fields
+    def git(*args) -> str:
+        try:
+            return subprocess.run(['git'] + list(args), cwd=ROOT_DIR, capture_output=True, text=True,
+                                  check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return ''
+
+    return {'commit': git('rev-parse', '--short', 'HEAD'),
+            'subject': git('log', '-1', '--format=%s'),
+            'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+def latency_stats(latencies: list, duration: float = None) -> dict:
+    # latencies - seconds, the result is in milliseconds
+    latencies = sorted(latencies)
+    stats = {'count': len(latencies)}
+    if duration:
+        stats['rps'] = round(len(latencies) / duration, 2)
+    if latencies:
+        stats['mean_ms'] = round(sum(latencies) / len(latencies) * 1000, 3)
+        for q in PERCENTILES:
+            stats['p{}_ms'.format(q)] = round(latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))] * 1000,
+                                              3)
+        stats['max_ms'] = round(latencies[-1] * 1000, 3)
+    return stats
+
+
+def write_report(name: str, args, results: dict, output: str = None) -> str:
+    # one JSON file per run: benchmarks/results/<name>-<commit>.json by default,
+    # so runs on different commits can be diffed
+    revision = git_revision()
+    report = {'benchmark': name,
+              'git': revision,
+              'time': datetime.datetime.now().isoformat(timespec='seconds'),
+              'python': sys.version.split()[0],
+              'platform': platform.platform(),
+              'args': vars(args),
+              'results': results}
+    if output is None:
+        Path(RESULTS_DIR).mkdir(parents=True, exist_ok=True)
+        output = "{}{}-{}{}.json".format(RESULTS_DIR, name, revision['commit'] or 'unknown',
+                                         '-dirty' if revision['dirty'] else '')
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=2, sort_keys=True, ensure_ascii=False)
+        output_file.write('\n')
+    return output
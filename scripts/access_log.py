@@ -0,0 +1,124 @@
+import os
+import json
+import queue
+import atexit
+import datetime
+import threading
+
+FORMATS = ('text', 'json')
+# put to the queue by close(), so the writer thread flushes everything before it and stops
+STOP = object()
+
+
+class AccessLog:
+    # records are put to an in-memory queue by request handlers and written in batches by a background thread,
+    # so no file I/O happens on the request path. Every process writes its own file per day:
+    # <logs_dir_path>YYYY-MM-DD.<pid>.log, or .jsonl for the json format
+    def __init__(self, logs_dir_path: str, log_format: str = 'text', flush_interval: float = 1.0,
+                 queue_size: int = 100000):
+        if log_format not in FORMATS:
+            raise ValueError("Unknown log format: {}".format(log_format))
+
+        self.logs_dir_path = logs_dir_path
+        self.log_format = log_format
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._thread = None
+        atexit.register(self.close)
+
+    def _start(self):
+        # the writer thread belongs to the process, which logs, e.g. to the gunicorn worker and not to the master
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.queue_size)
+            self._stats = {'written': 0, 'dropped': 0}
+            self._file = None
+            self._file_date = None
+            self._closing = threading.Event()
+            self._thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+            # log() checks the pid without the lock, so the pid is set, when the state of this process is ready,
+            # and before the thread, which names the files by it, is started
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def log(self, method: str, path: str, status: int, latency: float):
+        # latency - seconds from the start of the request till the response
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait((datetime.datetime.now(), method, path, status, latency))
+        except queue.Full:
+            # the disk doesn't keep up, requests must not wait for it. Threads of gthread workers drop concurrently
+            with self._lock:
+                self._stats['dropped'] += 1
+
+    def _format(self, record) -> str:
+        time, method, path, status, latency = record
+        if self.log_format == 'json':
+            return json.dumps({'time': time.isoformat(timespec='milliseconds'), 'pid': self._pid, 'method': method,
+                               'path': path, 'status': status, 'latency_ms': round(latency * 1000, 3)}) + '\n'
+        return "*".join(map(str, (time.strftime('%H:%M:%S.%f')[:-3], path, status))) + '\n'
+
+    def _open(self, date: datetime.date):
+        if self._file is not None:
+            self._file.close()
+        extension = 'jsonl' if self.log_format == 'json' else 'log'
+        self._file = open("{}{}.{}.{}".format(self.logs_dir_path, date.strftime("%Y-%m-%d"), self._pid, extension),
+                          'a')
+        self._file_date = date
+
+    def _write(self, records: list):
+        for record in records:
+            # a new file is started by the first record of the next day
+            if record[0].date() != self._file_date:
+                self._open(record[0].date())
+            self._file.write(self._format(record))
+        self._file.flush()
+        with self._lock:
+            self._stats['written'] += len(records)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            # records are collected for flush_interval and written at once, close() wakes the thread up earlier
+            self._closing.wait(self.flush_interval)
+            records = []
+            try:
+                record = self._queue.get_nowait()
+                while record is not STOP:
+                    records.append(record)
+                    record = self._queue.get_nowait()
+                stop = True
+            except queue.Empty:
+                pass
+
+            if records:
+                try:
+                    self._write(records)
+                except OSError as e:
+                    print(e)
+                    with self._lock:
+                        self._stats['dropped'] += len(records)
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        # flush the queued records and stop the writer thread of this process
+        with self._lock:
+            if self._pid != os.getpid() or self._thread is None:
+                return
+            thread, self._thread = self._thread, None
+        self._queue.put(STOP)
+        self._closing.set()
+        thread.join()
+
+    def stats(self) -> dict:
+        if self._pid != os.getpid():
+            return {'queued': 0, 'written': 0, 'dropped': 0}
+        with self._lock:
+            return {'queued': self._queue.qsize(), **self._stats}
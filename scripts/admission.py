@@ -0,0 +1,173 @@
+import os
+import time
+import fcntl
+import asyncio
+import threading
+from metrics import metrics
+
+# admission control of heavy routes: a route has at most limit requests in flight in all workers of the server
+# and at most queue_size requests waiting for them, the others are answered by 503 with Retry-After at once,
+# so a burst of heavy requests can't take all workers and threads from the cheap ones.
+# A slot is a flock()ed file <dir>/<route>.<n>.lock, so slots are shared by the threads and processes, which use
+# the same dir, and the kernel releases the slots of a killed worker. Waiting requests poll for a slot, so they
+# aren't admitted strictly in the order of arrival
+POLL_INTERVAL = 0.01
+
+
+class AdmissionError(Exception):
+    def __init__(self, route: str, reason: str, retry_after: int):
+        super().__init__()
+        self.route = route
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return "Server is busy, retry in {} s".format(self.retry_after)
+
+
+class RequestTooLargeError(Exception):
+    def __init__(self, size: int, max_size: int):
+        super().__init__()
+        self.size = size
+        self.max_size = max_size
+
+    def __str__(self):
+        return "Request body of {} bytes is larger than {} bytes".format(self.size, self.max_size)
+
+
+class SlotFiles:
+    # size slots, a slot is held by one thread of one process at a time. Locks of flock() belong to open files,
+    # so a process opens every file once and threads of it don't take a slot, which is held by another thread
+    def __init__(self, path_prefix: str, size: int):
+        self.paths = ['{}.{}.lock'.format(path_prefix, index) for index in range(size)]
+        self._lock = threading.Lock()
+        self._pid = None
+        self._fds = []
+        self._held = set()
+
+    def _check_pid(self):
+        # open files of the parent share its locks
+        if self._pid != os.getpid():
+            for fd in self._fds:
+                if fd is not None:
+                    os.close(fd)
+            self._pid = os.getpid()
+            self._fds = [None] * len(self.paths)
+            self._held = set()
+
+    def try_acquire(self):
+        # index of a free slot, which is held now, or None
+        with self._lock:
+            self._check_pid()
+            for index, path in enumerate(self.paths):
+                if index in self._held:
+                    continue
+                if self._fds[index] is None:
+                    self._fds[index] = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(self._fds[index], fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                self._held.add(index)
+                return index
+            return None
+
+    def release(self, index: int):
+        with self._lock:
+            if index in self._held and self._pid == os.getpid():
+                fcntl.flock(self._fds[index], fcntl.LOCK_UN)
+                self._held.discard(index)
+
+    def held(self) -> int:
+        with self._lock:
+            return len(self._held) if self._pid == os.getpid() else 0
+
+
+class Admission:
+    def __init__(self, slots_dir: str, limits: dict, queue_size: int = 4, queue_timeout: float = 2.0,
+                 retry_after: int = 1, max_import_bytes: int = 0, enabled: bool = False):
+        # limits - route (name of the view function) -> requests in flight, routes without a limit are always
+        # admitted. max_import_bytes = 0 or disabled admission admit bodies of POST /imports of any size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.max_import_bytes = max_import_bytes if enabled else 0
+        self._slots = dict()
+        self._queues = dict()
+        if enabled:
+            os.makedirs(slots_dir, exist_ok=True)
+            for route, limit in limits.items():
+                self._slots[route] = SlotFiles(os.path.join(slots_dir, route), limit)
+                self._queues[route] = SlotFiles(os.path.join(slots_dir, route + '.queue'), queue_size)
+        metrics.add_collector(self.collect_metrics)
+
+    def check_import_size(self, size):
+        # size is Content-Length, the body isn't read yet. Bodies without it are limited by the server to
+        # max_import_bytes while they are read
+        if self.max_import_bytes and size is not None and size > self.max_import_bytes:
+            metrics.inc('ybs_admission_rejections_total', route='import_data', reason='too_large')
+            raise RequestTooLargeError(size, self.max_import_bytes)
+
+    def _reject(self, route: str, reason: str):
+        metrics.inc('ybs_admission_rejections_total', route=route, reason=reason)
+        raise AdmissionError(route, reason, self.retry_after)
+
+    def _enter(self, route: str):
+        # (slot index, None) of an admitted request or (None, queue ticket) of a request, which must wait for a slot
+        index = self._slots[route].try_acquire()
+        if index is not None:
+            metrics.observe('ybs_admission_wait_seconds', 0.0, route=route)
+            return index, None
+        ticket = self._queues[route].try_acquire()
+        if ticket is None:
+            self._reject(route, 'queue_full')
+        return None, ticket
+
+    def _poll(self, route: str, started: float):
+        # slot index, if it's free now, AdmissionError if the request has waited for queue_timeout
+        index = self._slots[route].try_acquire()
+        if index is not None:
+            metrics.observe('ybs_admission_wait_seconds', time.monotonic() - started, route=route)
+        elif time.monotonic() - started >= self.queue_timeout:
+            self._reject(route, 'timeout')
+        return index
+
+    def acquire(self, route: str):
+        # token for release(), None for routes without a limit. AdmissionError if the request isn't admitted
+        if route not in self._slots:
+            return None
+        index, ticket = self._enter(route)
+        if index is None:
+            started = time.monotonic()
+            try:
+                while index is None:
+                    time.sleep(POLL_INTERVAL)
+                    index = self._poll(route, started)
+            finally:
+                self._queues[route].release(ticket)
+        return route, index
+
+    async def acquire_async(self, route: str):
+        # the same for the event loop, which goes on while the request waits
+        if route not in self._slots:
+            return None
+        index, ticket = self._enter(route)
+        if index is None:
+            started = time.monotonic()
+            try:
+                while index is None:
+                    await asyncio.sleep(POLL_INTERVAL)
+                    index = self._poll(route, started)
+            finally:
+                self._queues[route].release(ticket)
+        return route, index
+
+    def release(self, token):
+        if token is not None:
+            route, index = token
+            self._slots[route].release(index)
+
+    def collect_metrics(self) -> list:
+        # requests of this process, /metrics sums them up for all workers
+        return [('ybs_admission_in_flight', {'route': route}, slots.held())
+                for route, slots in self._slots.items()] + \
+            [('ybs_admission_queue_depth', {'route': route}, queue.held()) for route, queue in self._queues.items()]
@@ -0,0 +1,315 @@
+import asyncio
+import os
+import time
+import datetime
+import psycopg2
+import aiopg
+from itertools import islice
+from contextlib import asynccontextmanager
+from database import BaseDBHelper, DBHelperError, DBHelperJsonSchemaError, DBHelperIDError, DBHelperRelativesError
+from pool import PoolTimeoutError
+from cache import MISSING
+from validator import ImportValidator
+from metrics import metrics, InstrumentedAsyncCursor
+from prepared import statements, PreparingAsyncCursor
+from migrations import SchemaVersionError, SELECT_SCHEMA_VERSION_EXISTS, SELECT_SCHEMA_VERSION, latest_version
+
+
+class AsyncDBHelper(BaseDBHelper):
+    # DBHelper for async_server.py: the same queries and processing of their results, executed by aiopg.
+    # aiopg doesn't support COPY, so imports are written by multi-row INSERT with pre-allocated ids
+    CITIZENS_ROW_TEMPLATE = "({})".format(','.join(['%s'] * len(BaseDBHelper.CITIZENS_COLUMNS)))
+    RELATIVES_ROW_TEMPLATE = "(%s,%s)"
+    # limit of a single query, same as timeout in gunicorn_async_config.py
+    QUERY_TIMEOUT = 120.0
+
+    def __init__(self, pool_settings: dict = None, import_batch_size: int = 5000, cache_settings: dict = None,
+                 prepared_settings: dict = None, **kwargs):
+        self.DB_REQUISITES = kwargs
+        self.pool_settings = pool_settings or {}
+        self.prepared_settings = prepared_settings or {}
+        self.import_batch_size = import_batch_size
+        self._cache = self._make_cache(cache_settings)
+        self._pool = None
+        self._timeouts = 0
+        metrics.add_collector(self.collect_metrics)
+
+    async def open(self):
+        # must be called in the event loop of the worker, which will use the helper
+        self._pool = await aiopg.create_pool(minsize=self.pool_settings.get('min_size', 1),
+                                             maxsize=self.pool_settings.get('max_size', 10),
+                                             pool_recycle=self.pool_settings.get('idle_timeout', 300.0),
+                                             timeout=self.QUERY_TIMEOUT,
+                                             enable_hstore=False,
+                                             **self.DB_REQUISITES,
+                                             **self.prepared_connection_settings(self.prepared_settings))
+        # same as migrations.check_schema_version
+        async with self._cursor() as cursor:
+            await cursor.execute(SELECT_SCHEMA_VERSION_EXISTS)
+            version = 0
+            if (await cursor.fetchone())[0]:
+                await cursor.execute(SELECT_SCHEMA_VERSION)
+                version = (await cursor.fetchone())[0]
+        if version < latest_version():
+            raise SchemaVersionError(version, latest_version())
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+
+    @asynccontextmanager
+    async def _cursor(self):
+        # every statement and checkout is timed for /metrics
+        started = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(self._pool.acquire(), self.pool_settings.get('checkout_timeout', 30.0))
+        except asyncio.TimeoutError:
+            self._timeouts += 1
+            raise PoolTimeoutError
+        metrics.observe('ybs_pool_checkout_duration_seconds', time.perf_counter() - started)
+        try:
+            async with conn.cursor() as cursor:
+                if self.prepared_settings.get('enabled', True):
+                    yield PreparingAsyncCursor(cursor, conn, self.prepared_settings.get('max_statements', 100))
+                else:
+                    yield InstrumentedAsyncCursor(cursor)
+        finally:
+            self._pool.release(conn)
+
+    @asynccontextmanager
+    async def _transaction(self):
+        # aiopg connections are in autocommit mode, queries of one request are wrapped in a transaction explicitly
+        async with self._cursor() as cursor:
+            async with cursor.begin():
+                yield cursor
+
+    def pool_stats(self) -> dict:
+        return {'pid': os.getpid(),
+                'size': self._pool.size,
+                'idle': self._pool.freesize,
+                'in_use': self._pool.size - self._pool.freesize,
+                'min_size': self._pool.minsize,
+                'max_size': self._pool.maxsize}
+
+    def collect_metrics(self) -> list:
+        if self._pool is None:
+            return []
+        return [('ybs_pool_connections', {'state': 'idle'}, self._pool.freesize),
+                ('ybs_pool_connections', {'state': 'in_use'}, self._pool.size - self._pool.freesize),
+                ('ybs_pool_timeouts_total', {}, self._timeouts)] + self.cache_metrics()
+
+    def cache_stats(self) -> dict:
+        return self._cache.stats() if self._cache is not None else {}
+
+    async def _cached(self, endpoint: str, import_id: int, revision, compute, weight):
+        # same as DBHelper._cached, compute is a coroutine function
+        if self._cache is None:
+            return await compute()
+
+        key = (endpoint, import_id, revision)
+        result = self._cache.get(key)
+        if result is MISSING:
+            result = await compute()
+            self._cache.put(key, result, weight(result), group=(endpoint, import_id))
+        return result
+
+    @metrics.timed
+    async def get_import_revision(self, import_id: int) -> str:
+        async with self._cursor() as cursor:
+            await cursor.execute(self.SELECT_IMPORT_REVISION, (import_id,))
+            return self.revision_from_row(await cursor.fetchone())
+
+    @metrics.timed
+    async def import_citizens(self, citizens: dict) -> int:
+        # validation doesn't need the database, so it's done in a thread and doesn't block other requests
+        validator = ImportValidator()
+        relatives_pairs = await asyncio.get_running_loop().run_in_executor(None, validator.validate, citizens)
+        if validator.errors:
+            raise self.validation_error(validator.errors)
+
+        citizens = citizens['citizens']
+
+        try:
+            async with self._transaction() as cursor:
+                # INSERT INTO imports
+                await cursor.execute(self.INSERT_IMPORT, (self.import_time(),))
+                import_id = (await cursor.fetchone())[0]
+                await cursor.execute(self.CREATE_IMPORT_PARTITIONS, (import_id,))
+
+                # INSERT INTO citizens by batches with pre-allocated ids
+                citizen_id_to_citizen_db_id = dict()
+                for start in range(0, len(citizens), self.import_batch_size):
+                    batch = citizens[start:start + self.import_batch_size]
+                    await cursor.execute(self.ALLOCATE_CITIZENS_IDS, (len(batch),))
+                    citizen_id_to_citizen_db_id.update(zip((citizen['citizen_id'] for citizen in batch),
+                                                           (row[0] for row in await cursor.fetchall())))
+                    await self._insert_rows(cursor,
+                                            "citizens_{} ({})".format(import_id, ','.join(self.CITIZENS_COLUMNS)),
+                                            self.CITIZENS_ROW_TEMPLATE,
+                                            self.citizens_rows(import_id, batch, citizen_id_to_citizen_db_id))
+
+                # INSERT INTO relatives
+                await self._insert_rows(cursor, "relatives_{} (id1, id2)".format(import_id),
+                                        self.RELATIVES_ROW_TEMPLATE,
+                                        self.relatives_rows(relatives_pairs, citizen_id_to_citizen_db_id))
+                await cursor.execute(self.ATTACH_IMPORT_PARTITIONS, (import_id,))
+        except (psycopg2.DatabaseError, psycopg2.Warning) as e:
+            print(e)
+            raise DBHelperJsonSchemaError
+        return import_id
+
+    @metrics.timed
+    async def enqueue_import(self, payload: bytes) -> int:
+        # same as DBHelper.enqueue_import, the jobs are run by the processes of import_jobs.py
+        async with self._transaction() as cursor:
+            await cursor.execute(self.INSERT_IMPORT_JOB, (payload, self.import_time()))
+            job_id = (await cursor.fetchone())[0]
+            await cursor.execute(self.NOTIFY_IMPORT_JOBS)
+        metrics.inc('ybs_import_jobs_enqueued_total')
+        return job_id
+
+    @metrics.timed
+    async def get_import_job(self, job_id: int) -> dict:
+        async with self._cursor() as cursor:
+            await cursor.execute(self.SELECT_IMPORT_JOB, (job_id,))
+            return self.import_job_from_row(job_id, await cursor.fetchone())
+
+    async def _insert_rows(self, cursor, table: str, template: str, rows):
+        # INSERT INTO table VALUES with at most import_batch_size rows per query
+        rows = iter(rows)
+        while True:
+            values = b','.join(cursor.mogrify(template, row) for row in islice(rows, self.import_batch_size))
+            if not values:
+                break
+            await cursor.execute("INSERT INTO {} VALUES {};".format(table, values.decode()))
+
+    @metrics.timed
+    async def get_citizens(self, import_id: int, revision: str = None) -> list:
+        if revision is None:
+            revision = await self.get_import_revision(import_id)
+        return await self._cached('citizens', import_id, revision, lambda: self._get_citizens(import_id), len)
+
+    @metrics.timed
+    async def _get_citizens(self, import_id: int) -> list:
+        async with self._transaction() as cursor:
+            await cursor.execute(self.SELECT_CITIZENS, (import_id,))
+            citizens_rows = await cursor.fetchall()
+            await cursor.execute(self.SELECT_RELATIVES_PAIRS, {"import_id": import_id})
+            relatives_pairs = await cursor.fetchall()
+        return self.citizens_from_rows(citizens_rows, relatives_pairs)
+
+    @metrics.timed
+    async def get_citizens_page(self, import_id: int, revision: str, limit, after: int, fields: tuple) -> tuple:
+        # same as DBHelper.get_citizens_page
+        async with self._transaction() as cursor:
+            await cursor.execute(self.SELECT_CITIZENS_PAGE, {'import_id': import_id, 'after': after, 'limit': limit})
+            citizens_rows = await cursor.fetchall()
+            relatives_rows = None
+            if 'relatives' in fields:
+                await cursor.execute(self.SELECT_CITIZENS_PAGE_RELATIVES,
+                                     {'import_id': import_id, 'ids': [row[0] for row in citizens_rows]})
+                relatives_rows = await cursor.fetchall()
+        return self.citizens_page_from_rows(citizens_rows, relatives_rows, fields, limit)
+
+    @metrics.timed
+    async def get_citizens_json(self, import_id: int, revision: str = None) -> str:
+        if revision is None:
+            revision = await self.get_import_revision(import_id)
+        return await self._cached('citizens_json', import_id, revision, lambda: self._get_citizens_json(import_id),
+                                  self.json_citizens_num)
+
+    @metrics.timed
+    async def _get_citizens_json(self, import_id: int) -> str:
+        async with self._cursor() as cursor:
+            await cursor.execute(self.SELECT_CITIZENS_JSON, {"import_id": import_id})
+            return (await cursor.fetchone())[0]
+
+    async def _get_citizen(self, cursor, import_id: int, citizen_id: int) -> dict:
+        await cursor.execute(self.SELECT_CITIZEN, (import_id, citizen_id))
+        citizen_row = await cursor.fetchone()
+        if citizen_row is None:
+            raise DBHelperIDError
+        citizen_data = self.citizen_from_row(citizen_row)
+
+        await cursor.execute(self.SELECT_CITIZEN_RELATIVES, {'import_id': import_id, 'id': citizen_data.pop('id')})
+        citizen_data['relatives'] = [relative[0] for relative in await cursor.fetchall()]
+        return citizen_data
+
+    @metrics.timed
+    async def get_citizen(self, import_id: int, citizen_id: int) -> dict:
+        async with self._transaction() as cursor:
+            return await self._get_citizen(cursor, import_id, citizen_id)
+
+    @metrics.timed
+    async def change_citizen(self, import_id: int, citizen_id: int, patch_citizen_data: dict,
+                             as_json: bool = False):
+        # same as DBHelper.change_citizen, a single statement is atomic without an explicit transaction
+        async with self._cursor() as cursor:
+            try:
+                patch_citizen_data, new_relatives = self.parse_citizen_patch(patch_citizen_data)
+                new_relatives = self.integer_relatives(new_relatives)
+            except DBHelperError:
+                # an unknown citizen is reported before a wrong patch
+                await cursor.execute(self.SELECT_CITIZEN_DB_ID, (import_id, citizen_id))
+                if await cursor.fetchone() is None:
+                    raise DBHelperIDError
+                raise
+
+            query, params = self.change_citizen_statement(import_id, citizen_id, patch_citizen_data, new_relatives,
+                                                          as_json)
+            statements.add('change_citizen', query)
+            await cursor.execute(query, params)
+            row = await cursor.fetchone()
+            if row is None:
+                # nothing is changed, the citizen or one of his new relatives doesn't exist
+                await cursor.execute(self.SELECT_CITIZEN_DB_ID, (import_id, citizen_id))
+                raise DBHelperIDError if await cursor.fetchone() is None else DBHelperRelativesError
+        return self.changed_citizen_from_row(row, as_json)
+
+    @metrics.timed
+    async def delete_import(self, import_id: int):
+        # same as DBHelper.delete_import, connections of aiopg are in autocommit mode already,
+        # so partitions are detached concurrently outside of a transaction
+        async with self._cursor() as cursor:
+            await cursor.execute(self.DELETE_IMPORT, (import_id,))
+            if await cursor.fetchone() is None:
+                raise DBHelperIDError
+            try:
+                await cursor.execute(self.LOCK_PARTITIONS_DETACH)
+                try:
+                    await cursor.execute(self.SELECT_IMPORT_PARTITIONS, {'import_id': import_id})
+                    for statement in self.drop_partitions_statements(await cursor.fetchall()):
+                        await cursor.execute(statement)
+                finally:
+                    await cursor.execute(self.UNLOCK_PARTITIONS_DETACH)
+            except psycopg2.Error as e:
+                print(e)
+
+    @metrics.timed
+    async def get_presents_num_per_month(self, import_id: int, revision: str = None) -> dict:
+        if revision is None:
+            revision = await self.get_import_revision(import_id)
+        return await self._cached('presents_num_per_month', import_id, revision,
+                                  lambda: self._get_presents_num_per_month(import_id),
+                                  lambda result: sum(map(len, result.values())))
+
+    @metrics.timed
+    async def _get_presents_num_per_month(self, import_id: int) -> dict:
+        async with self._cursor() as cursor:
+            await cursor.execute(self.SELECT_PRESENTS_NUM, {"import_id": import_id})
+            return self.presents_from_rows(await cursor.fetchall())
+
+    @metrics.timed
+    async def get_town_stat(self, import_id: int, revision: str = None) -> list:
+        if revision is None:
+            revision = await self.get_import_revision(import_id)
+        # ages depend on the current date too
+        return await self._cached('town_stat', import_id, (revision, datetime.date.today()),
+                                  lambda: self._get_town_stat(import_id), len)
+
+    @metrics.timed
+    async def _get_town_stat(self, import_id: int) -> list:
+        async with self._cursor() as cursor:
+            await cursor.execute(self.SELECT_TOWNS_BIRTH_DATES, (import_id,))
+            return self.town_stat_from_rows(await cursor.fetchall())
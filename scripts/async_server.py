@@ -0,0 +1,272 @@
+import json
+import time
+import config
+from aiohttp import web
+from async_database import AsyncDBHelper
+from database import DBHelperError
+from access_log import AccessLog
+from admission import Admission, AdmissionError, RequestTooLargeError
+from metrics import metrics
+from datetime import date
+
+# the same routes as server.py for the asyncio event loop:
+# python3 async_server.py or gunicorn -c gunicorn_async_config.py async_server:app
+MAX_REQUEST_SIZE = 1024 ** 3
+
+routes = web.RouteTableDef()
+DB_HELPER = web.AppKey('db_helper', AsyncDBHelper)
+read_settings = config.get_read_settings()
+import_jobs_settings = config.get_import_jobs_settings()
+access_log_settings = config.get_access_log_settings()
+access_log = AccessLog(config.get_logs_dir_path(),
+                       log_format=access_log_settings['format'],
+                       flush_interval=access_log_settings['flush_interval'],
+                       queue_size=access_log_settings['queue_size'])
+metrics_settings = config.get_metrics_settings()
+metrics.configure(metrics_settings['dir'], metrics_settings['flush_interval'])
+metrics.add_collector(lambda: [('ybs_access_log_dropped_total', {}, access_log.stats()['dropped'])])
+admission_settings = config.get_admission_settings()
+admission = Admission(admission_settings['dir'], admission_settings['limits'],
+                      queue_size=admission_settings['queue_size'],
+                      queue_timeout=admission_settings['queue_timeout'],
+                      retry_after=admission_settings['retry_after'],
+                      max_import_bytes=admission_settings['max_import_bytes'],
+                      enabled=admission_settings['enabled'])
+
+
+def route_of(request) -> str:
+    # route pattern as a label, so all imports share the same time series
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else 'unknown'
+
+
+def json_response(request, data, status: int = 200) -> web.Response:
+    # keys are sorted like in the responses of Flask
+    with metrics.timer('ybs_json_dumps_duration_seconds', route=route_of(request)):
+        body = json.dumps({"data": data}, sort_keys=True).encode()
+    return web.Response(body=body, status=status, content_type='application/json')
+
+
+def json_text_response(text: str, status: int = 200) -> web.Response:
+    # response body, which is already built by PostgreSQL
+    return web.Response(body=text.encode(), status=status, content_type='application/json')
+
+
+def error_response(e: DBHelperError) -> web.Response:
+    # same as server.error_response
+    if e.errors:
+        return web.Response(body=json.dumps(e.as_dict(), sort_keys=True).encode(), status=400,
+                            content_type='application/json')
+    return web.Response(text=str(e), status=400, content_type='text/html')
+
+
+@routes.post('/imports')
+async def import_data(request):
+    db_helper = request.app[DB_HELPER]
+    if import_jobs_settings['enabled']:
+        # same as server.import_data
+        job_id = await db_helper.enqueue_import(await request.read())
+        response = json_response(request, {"job_id": job_id}, status=202)
+        response.headers['Location'] = '/imports/jobs/{}'.format(job_id)
+        return response
+    try:
+        citizens = json.loads(await request.read())
+    except ValueError:
+        return web.Response(status=400)
+
+    try:
+        import_id = await db_helper.import_citizens(citizens)
+    except DBHelperError as e:
+        return error_response(e)
+    else:
+        return json_response(request, {"import_id": import_id}, status=201)
+
+
+@routes.get(r'/imports/jobs/{job_id:\d+}')
+async def get_import_job(request):
+    try:
+        job = await request.app[DB_HELPER].get_import_job(int(request.match_info['job_id']))
+    except DBHelperError as e:
+        return error_response(e)
+    else:
+        return json_response(request, job)
+
+
+@routes.delete(r'/imports/{import_id:\d+}')
+async def delete_import(request):
+    import_id = int(request.match_info['import_id'])
+    try:
+        await request.app[DB_HELPER].delete_import(import_id)
+    except DBHelperError as e:
+        return error_response(e)
+    else:
+        return json_response(request, {"import_id": import_id})
+
+
+@routes.patch(r'/imports/{import_id:\d+}/citizens/{citizen_id:\d+}')
+async def change_citizen_data(request):
+    db_helper = request.app[DB_HELPER]
+    try:
+        patch_citizen_data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    as_json = read_settings['citizens_mode'] == 'pg_json'
+    try:
+        citizen_data = await db_helper.change_citizen(int(request.match_info['import_id']),
+                                                      int(request.match_info['citizen_id']),
+                                                      patch_citizen_data, as_json=as_json)
+    except DBHelperError as e:
+        return error_response(e)
+    else:
+        return json_text_response(citizen_data) if as_json else json_response(request, citizen_data)
+
+
+async def conditional_get(request, build_response, *etag_parts) -> web.Response:
+    # same as server.conditional_get
+    db_helper = request.app[DB_HELPER]
+    import_id = int(request.match_info['import_id'])
+    try:
+        revision = await db_helper.get_import_revision(import_id)
+        etag = '-'.join(map(str, (import_id, revision) + etag_parts))
+        if_none_match = request.if_none_match or ()
+        if any(tag.value in (etag, '*') for tag in if_none_match):
+            response = web.Response(status=304)
+        else:
+            response = await build_response(db_helper, import_id, revision)
+    except DBHelperError as e:
+        return error_response(e)
+    response.etag = etag
+    return response
+
+
+@routes.get(r'/imports/{import_id:\d+}/citizens')
+async def get_citizens_data(request):
+    try:
+        page_query = AsyncDBHelper.citizens_page_query(request.query, read_settings['max_page_size'])
+    except DBHelperError as e:
+        return error_response(e)
+
+    async def build_response(db_helper, import_id, revision):
+        if page_query is not None:
+            # same as in server.get_citizens_data
+            citizens, next_after = await db_helper.get_citizens_page(import_id, revision, *page_query)
+            response = json_response(request, citizens)
+            if next_after is not None:
+                response.headers['Link'] = '<{}>; rel="next"'.format(request.rel_url.update_query(after=next_after))
+            return response
+        # the stream mode of server.py isn't supported, citizens are sent at once
+        await admit(request)
+        if read_settings['citizens_mode'] == 'pg_json':
+            return json_text_response(await db_helper.get_citizens_json(import_id, revision))
+        return json_response(request, await db_helper.get_citizens(import_id, revision))
+
+    return await conditional_get(request, build_response)
+
+
+@routes.get(r'/imports/{import_id:\d+}/citizens/birthdays')
+async def get_presents_num_per_month(request):
+    async def build_response(db_helper, import_id, revision):
+        await admit(request)
+        return json_response(request, await db_helper.get_presents_num_per_month(import_id, revision))
+
+    return await conditional_get(request, build_response)
+
+
+@routes.get(r'/imports/{import_id:\d+}/towns/stat/percentile/age')
+async def get_town_stat(request):
+    async def build_response(db_helper, import_id, revision):
+        await admit(request)
+        return json_response(request, await db_helper.get_town_stat(import_id, revision))
+
+    # ages change with the date, so it's a part of the ETag too
+    return await conditional_get(request, build_response, date.today().isoformat())
+
+
+@routes.get('/stats')
+async def get_stats(request):
+    # statistics of this worker process
+    db_helper = request.app[DB_HELPER]
+    return json_response(request, {'pool': db_helper.pool_stats(),
+                          'cache': db_helper.cache_stats(),
+                          'access_log': access_log.stats()})
+
+
+@routes.get('/metrics')
+async def get_metrics(request):
+    # metrics of all workers in the Prometheus text format
+    return web.Response(body=metrics.render().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+@web.middleware
+async def save_logs(request, handler):
+    # the record is only queued, it's written to the file by the access log thread
+    request_started = time.perf_counter()
+    metrics.start_request()
+    try:
+        response = await handler(request)
+    except web.HTTPException as e:
+        response = e
+    latency = time.perf_counter() - request_started
+    metrics.finish_request(request.method, route_of(request), response.status, latency,
+                           len(response.body) if isinstance(response.body, bytes) else None)
+    access_log.log(request.method, request.path, response.status, latency)
+    if isinstance(response, web.HTTPException):
+        raise response
+    return response
+
+
+async def admit(request):
+    # same as server.admit
+    request['admission_token'] = await admission.acquire_async(request.match_info.handler.__name__)
+
+
+@web.middleware
+async def admit_request(request, handler):
+    # POST /imports over the limits is rejected before the body is read, heavy reads take their slots by admit().
+    # The slot is released after the response
+    try:
+        if request.match_info.handler.__name__ == 'import_data':
+            admission.check_import_size(request.content_length)
+            if admission.max_import_bytes:
+                # bodies without Content-Length are cut by aiohttp while they are read
+                request = request.clone(client_max_size=admission.max_import_bytes)
+            await admit(request)
+        return await handler(request)
+    except RequestTooLargeError as e:
+        return web.Response(text=str(e), status=413, content_type='text/html')
+    except AdmissionError as e:
+        return web.Response(text=str(e), status=503, headers={'Retry-After': str(e.retry_after)},
+                            content_type='text/html')
+    finally:
+        admission.release(request.pop('admission_token', None))
+
+
+async def open_db_helper(app):
+    # the pool is created in the event loop of the worker
+    import_settings = config.get_import_settings()
+    app[DB_HELPER] = AsyncDBHelper(pool_settings=config.get_pool_settings(),
+                                   import_batch_size=import_settings['batch_size'],
+                                   cache_settings=config.get_cache_settings(),
+                                   prepared_settings=config.get_prepared_settings(),
+                                   **config.get_db_requisites())
+    await app[DB_HELPER].open()
+
+
+async def close_db_helper(app):
+    await app[DB_HELPER].close()
+
+
+def make_app() -> web.Application:
+    application = web.Application(client_max_size=MAX_REQUEST_SIZE, middlewares=[save_logs, admit_request])
+    application.add_routes(routes)
+    application.on_startup.append(open_db_helper)
+    application.on_cleanup.append(close_db_helper)
+    return application
+
+
+app = make_app()
+
+if __name__ == '__main__':
+    web.run_app(app, host='0.0.0.0', port=8080)
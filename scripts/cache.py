@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class ResultCache:
+    # LRU cache bounded by the number of entries and by their total weight (e.g. number of rows).
+    # Entries of one group (e.g. one endpoint of one import) replace each other on put,
+    # so results for outdated versions don't wait for eviction
+    def __init__(self, max_entries: int = 256, max_weight: int = 1000000):
+        self.max_entries = max_entries
+        self.max_weight = max_weight
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, weight, group)
+        self._groups = dict()  # group -> key
+        self._weight = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'rejections': 0}
+
+    def _remove(self, key):
+        # must be called with self._lock acquired
+        value, weight, group = self._entries.pop(key)
+        self._weight -= weight
+        if group is not None and self._groups.get(group) == key:
+            del self._groups[group]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value, weight: int = 1, group=None):
+        with self._lock:
+            if weight > self.max_weight:
+                self._stats['rejections'] += 1
+                return
+
+            if key in self._entries:
+                self._remove(key)
+            if group is not None and group in self._groups:
+                self._remove(self._groups[group])
+
+            self._entries[key] = (value, weight, group)
+            self._weight += weight
+            if group is not None:
+                self._groups[group] = key
+
+            while len(self._entries) > self.max_entries or self._weight > self.max_weight:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+            self._weight = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'weight': self._weight,
+                    'max_entries': self.max_entries,
+                    'max_weight': self.max_weight,
+                    **self._stats}
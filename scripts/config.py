@@ -3,9 +3,86 @@ import psycopg2
 from configparser import ConfigParser
 from pathlib import Path
 from argparse import ArgumentParser
+from pool import ConnectionPool, PoolError
+from migrations import migrate, schema_version, latest_version
 
 CONFIG_FILE_PATH = str(Path(__file__).absolute().parent.parent) + '/config.ini'
 
+POOL_DEFAULTS = {
+    'min_size': 1,
+    'max_size': 10,
+    'idle_timeout': 300.0,
+    'checkout_timeout': 30.0,
+    'health_check_interval': 30.0,
+}
+
+IMPORT_DEFAULTS = {
+    'method': 'copy',
+    'streaming': False,
+    'batch_size': 5000,
+}
+
+CACHE_DEFAULTS = {
+    'enabled': True,
+    'max_entries': 256,
+    'max_items': 1000000,
+}
+
+SNAPSHOT_DEFAULTS = {
+    'enabled': True,
+    'max_entries': 64,
+    'max_bytes': 268435456,
+}
+
+PREPARED_DEFAULTS = {
+    'enabled': True,
+    'max_statements': 100,
+    'plan_cache_mode': 'force_custom_plan',
+}
+
+READ_DEFAULTS = {
+    'citizens_mode': 'default',
+    'stream_batch_size': 1000,
+    'max_page_size': 10000,
+}
+
+ACCESS_LOG_DEFAULTS = {
+    'format': 'text',
+    'flush_interval': 1.0,
+    'queue_size': 100000,
+}
+
+METRICS_DEFAULTS = {
+    'dir': '',
+    'flush_interval': 5.0,
+}
+
+RETENTION_DEFAULTS = {
+    'max_age_days': 0,
+}
+
+REPLICAS_DEFAULTS = {
+    'hosts': '',
+    'retry_interval': 30.0,
+}
+
+ADMISSION_DEFAULTS = {
+    'enabled': False,
+    'limits': 'import_data:2, get_town_stat:4, get_presents_num_per_month:4, get_citizens_data:4',
+    'queue_size': 4,
+    'queue_timeout': 2.0,
+    'retry_after': 1,
+    'max_import_bytes': 1073741824,
+    'dir': '',
+}
+
+IMPORT_JOBS_DEFAULTS = {
+    'enabled': False,
+    'workers': 2,
+    'poll_interval': 5.0,
+    'max_attempts': 3,
+}
+
 
 def make_config_file():
     config = ConfigParser()
@@ -18,6 +95,19 @@ def make_config_file():
     config['main']['database'] = 'null'
     config['main']['logs_dir_path'] = 'null'
 
+    config['pool'] = {key: str(value) for key, value in POOL_DEFAULTS.items()}
+    config['import'] = {key: str(value) for key, value in IMPORT_DEFAULTS.items()}
+    config['read'] = {key: str(value) for key, value in READ_DEFAULTS.items()}
+    config['cache'] = {key: str(value) for key, value in CACHE_DEFAULTS.items()}
+    config['snapshot'] = {key: str(value) for key, value in SNAPSHOT_DEFAULTS.items()}
+    config['prepared_statements'] = {key: str(value) for key, value in PREPARED_DEFAULTS.items()}
+    config['access_log'] = {key: str(value) for key, value in ACCESS_LOG_DEFAULTS.items()}
+    config['metrics'] = {key: str(value) for key, value in METRICS_DEFAULTS.items()}
+    config['retention'] = {key: str(value) for key, value in RETENTION_DEFAULTS.items()}
+    config['import_jobs'] = {key: str(value) for key, value in IMPORT_JOBS_DEFAULTS.items()}
+    config['replicas'] = {key: str(value) for key, value in REPLICAS_DEFAULTS.items()}
+    config['admission'] = {key: str(value) for key, value in ADMISSION_DEFAULTS.items()}
+
     with open(CONFIG_FILE_PATH, 'w') as config_file:
         config.write(config_file)
 
@@ -30,6 +120,26 @@ def get_config() -> dict:
     return config_dict
 
 
+def get_section(section: str, defaults: dict) -> dict:
+    # missing options fall back to defaults, so old config.ini files keep working
+    config = ConfigParser()
+    config.read(CONFIG_FILE_PATH)
+    if not config.has_section(section):
+        return dict(defaults)
+
+    section_dict = dict()
+    for key, default in defaults.items():
+        if isinstance(default, bool):
+            section_dict[key] = config.getboolean(section, key, fallback=default)
+        elif isinstance(default, int):
+            section_dict[key] = config.getint(section, key, fallback=default)
+        elif isinstance(default, float):
+            section_dict[key] = config.getfloat(section, key, fallback=default)
+        else:
+            section_dict[key] = config.get(section, key, fallback=default)
+    return section_dict
+
+
 def get_db_requisites() -> dict:
     config_dict = get_config()
     keys = ('user', 'password', 'host', 'port', 'database')
@@ -42,6 +152,78 @@ def get_logs_dir_path() -> str:
     return config_dict['logs_dir_path']
 
 
+def get_pool_settings() -> dict:
+    return get_section('pool', POOL_DEFAULTS)
+
+
+def get_import_settings() -> dict:
+    return get_section('import', IMPORT_DEFAULTS)
+
+
+def get_read_settings() -> dict:
+    return get_section('read', READ_DEFAULTS)
+
+
+def get_cache_settings() -> dict:
+    return get_section('cache', CACHE_DEFAULTS)
+
+
+def get_snapshot_settings() -> dict:
+    return get_section('snapshot', SNAPSHOT_DEFAULTS)
+
+
+def get_prepared_settings() -> dict:
+    return get_section('prepared_statements', PREPARED_DEFAULTS)
+
+
+def get_access_log_settings() -> dict:
+    return get_section('access_log', ACCESS_LOG_DEFAULTS)
+
+
+def get_metrics_settings() -> dict:
+    # snapshots of workers are kept in logs_dir_path/metrics/ by default
+    metrics_settings = get_section('metrics', METRICS_DEFAULTS)
+    if not metrics_settings['dir']:
+        metrics_settings['dir'] = get_logs_dir_path() + 'metrics/'
+    return metrics_settings
+
+
+def get_retention_settings() -> dict:
+    # max_age_days = 0 keeps imports forever
+    return get_section('retention', RETENTION_DEFAULTS)
+
+
+def get_import_jobs_settings() -> dict:
+    # enabled = yes: POST /imports only stages the body, it's imported by the processes of import_jobs.py
+    return get_section('import_jobs', IMPORT_JOBS_DEFAULTS)
+
+
+def get_replica_settings() -> dict:
+    # hosts - comma separated host:port of read replicas of the database in [main], they have the same
+    # user, password and database. No hosts - everything is read from [main]
+    replica_settings = get_section('replicas', REPLICAS_DEFAULTS)
+    hosts = []
+    for host in filter(None, map(str.strip, replica_settings['hosts'].split(','))):
+        host, _, port = host.rpartition(':') if ':' in host else (host, ':', '5432')
+        hosts.append((host, int(port)))
+    replica_settings['hosts'] = hosts
+    return replica_settings
+
+
+def get_admission_settings() -> dict:
+    # limits - comma separated route:requests, route is the name of the view function of server.py and
+    # async_server.py. Servers with the same dir (logs_dir_path/admission/ by default) share the limits
+    admission_settings = get_section('admission', ADMISSION_DEFAULTS)
+    limits = dict()
+    for limit in filter(None, map(str.strip, admission_settings['limits'].split(','))):
+        route, _, requests = limit.partition(':')
+        limits[route.strip()] = int(requests)
+    admission_settings['limits'] = limits
+    if not admission_settings['dir']:
+        admission_settings['dir'] = get_logs_dir_path() + 'admission/'
+    return admission_settings
+
+
 def test_ini_file():
     return os.path.exists(CONFIG_FILE_PATH)
 
@@ -56,6 +238,41 @@ def test_db_connection(**kwargs) -> bool:
         return True
 
 
+def test_pool(pool_settings: dict, **kwargs) -> bool:
+    try:
+        pool = ConnectionPool(**pool_settings, **kwargs)
+        # the same connection must come back from the pool and still be usable
+        with pool.connection() as first_conn:
+            pass
+        with pool.connection() as second_conn:
+            with second_conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+        pool.close()
+    except (psycopg2.Error, PoolError, ValueError):
+        return False
+    else:
+        return first_conn is second_conn
+
+
+def test_schema_version(**kwargs) -> bool:
+    try:
+        conn = psycopg2.connect(**kwargs)
+    except psycopg2.Error:
+        return False
+    try:
+        with conn.cursor() as cursor:
+            return schema_version(cursor) >= latest_version()
+    finally:
+        conn.close()
+
+
+def migrate_database():
+    applied = migrate(**get_db_requisites())
+    for version, name in applied:
+        print("Applied migration {} {}".format(version, name))
+    print("Schema version: {}".format(latest_version()))
+
+
 def test_logs_dir_path(logs_dir_path: str) -> bool:
     return os.path.exists(logs_dir_path)
 
@@ -73,6 +290,23 @@ def test_config():
         else:
             print(printing_template.format("Test database connection", "FAIL"))
 
+        if test_pool(get_pool_settings(), **get_db_requisites()):
+            print(printing_template.format("Test connection pool", "OK"))
+        else:
+            print(printing_template.format("Test connection pool", "FAIL"))
+
+        if test_schema_version(**get_db_requisites()):
+            print(printing_template.format("Test schema version", "OK"))
+        else:
+            print(printing_template.format("Test schema version", "FAIL"))
+
+        for host, port in get_replica_settings()['hosts']:
+            replica_requisites = {**get_db_requisites(), 'host': host, 'port': port}
+            if test_db_connection(**replica_requisites):
+                print(printing_template.format("Test replica {}:{}".format(host, port), "OK"))
+            else:
+                print(printing_template.format("Test replica {}:{}".format(host, port), "FAIL"))
+
         if test_logs_dir_path(get_logs_dir_path()):
             print(printing_template.format("Found path for logs dir", "OK"))
         else:
@@ -81,12 +315,15 @@ def test_config():
 
 if __name__ == '__main__':
     parser = ArgumentParser()
-    parser.add_argument('mode', help="mode of script: c - create config.ini, t - test config.ini", type=str)
+    parser.add_argument('mode', help="mode of script: c - create config.ini, t - test config.ini, "
+                                     "m - apply migrations of the database schema", type=str)
     args = parser.parse_args()
 
     if args.mode == 'c':
         make_config_file()
     elif args.mode == 't':
         test_config()
+    elif args.mode == 'm':
+        migrate_database()
     else:
         print("Unknown mode: {}".format(args.mode))
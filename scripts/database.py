@@ -1,16 +1,34 @@
+import io
+import json
 import datetime
+import functools
 import psycopg2
-from collections import defaultdict
-from numpy import percentile, array, ceil
-from fastjsonschema import validate, compile, JsonSchemaException
 from psycopg2 import extras
-from pathlib import Path
+from contextlib import contextmanager
+from pool import ConnectionPool, ReplicaSet, PoolError
+from cache import ResultCache, MISSING
+from validator import ImportValidator
+from json_stream import iter_import_citizens
+from metrics import metrics, InstrumentedCursor
+from prepared import statements, PreparingConnection, PreparingCursor
+from migrations import check_schema_version
+
+# NumPy, fastjsonschema and snapshot.py are imported on first use, so workers start without them
 
 
 class DBHelperError(Exception):
+    def __init__(self, errors: list = None):
+        super().__init__()
+        # structured errors, e.g. validator.ValidationError tuples
+        self.errors = errors or []
+
     def __str__(self):
         return "Error"
 
+    def as_dict(self) -> dict:
+        # body of the 400 response, which lists structured errors
+        return {'error': str(self), 'errors': [error._asdict() for error in self.errors]}
+
 
 class DBHelperJsonSchemaError(DBHelperError):
     def __str__(self):
@@ -27,6 +45,21 @@ class DBHelperRelativesError(DBHelperError):
         return "Error with relations"
 
 
+class DBHelperJobIDError(DBHelperError):
+    def __str__(self):
+        return "Unknown job_id"
+
+
+class DBHelperJobAttemptsError(DBHelperError):
+    def __str__(self):
+        return "Import was interrupted too many times"
+
+
+class DBHelperQueryError(DBHelperError):
+    def __str__(self):
+        return "Wrong query parameters"
+
+
 class Singleton(type):
     _instances = {}
 
@@ -36,7 +69,9 @@ class Singleton(type):
         return cls._instances[cls]
 
 
-class DBHelper(metaclass=Singleton):
+class BaseDBHelper:
+    # SQL and processing of query results, shared by DBHelper and async_database.AsyncDBHelper:
+    # the helpers differ only in the driver, which executes the queries
     IMPORT_CITIZEN_SCHEMA = {
         "type": "object",
         "properties": {
@@ -81,6 +116,8 @@ class DBHelper(metaclass=Singleton):
         "additionalProperties": False,
         "minProperties": 1
     }
+    # compiled once, PATCH is validated on every request
+    _change_citizen_validator = None
     IMPORT_SCHEMA = {
         "type": "object",
         "properties": {
@@ -92,24 +129,195 @@ class DBHelper(metaclass=Singleton):
         "required": ["citizens"],
         "additionalProperties": False
     }
-    SQL_FILES_DIR = str(Path(__file__).parent.parent.absolute()) + '/sql_files/'
+    # copy - COPY FROM STDIN with pre-allocated ids, values - multi-row INSERT with read back of ids
+    IMPORT_METHODS = ('copy', 'values')
     CITIZENS_COLUMNS = tuple(['id', 'import_id'] +
                              list(filter(lambda x: x != 'relatives', IMPORT_CITIZEN_SCHEMA['properties'])))
+    # columns of citizens in responses
+    CITIZEN_COLUMNS = tuple(filter(lambda x: x != 'import_id', CITIZENS_COLUMNS))
+    # keys of citizens in responses, which can be selected by fields of GET /imports/$import_id/citizens
+    CITIZEN_FIELDS = tuple(IMPORT_CITIZEN_SCHEMA['properties'])
+    MAX_CITIZEN_ID = 2 ** 31 - 1
+
+    SELECT_IMPORT_EXISTS = "SELECT 1 FROM imports WHERE import_id = %s;"
+    SELECT_IMPORT_REVISION = "SELECT import_time, version FROM imports WHERE import_id = %s;"
+    INSERT_IMPORT = "INSERT INTO imports (import_time) VALUES (%s) RETURNING import_id;"
+    # must be executed in the transaction, which changes the import
+    BUMP_IMPORT_VERSION = "UPDATE imports SET version = version + 1 WHERE import_id = %s;"
+    ALLOCATE_CITIZENS_IDS = "SELECT nextval('citizens_id_seq') FROM generate_series(1, %s);"
+    # an import is written to its own partitions, which are attached to citizens and relatives
+    # at the end of its transaction, see migrations/0001_create_tables.sql
+    CREATE_IMPORT_PARTITIONS = "SELECT create_import_partitions(%s);"
+    ATTACH_IMPORT_PARTITIONS = "SELECT attach_import_partitions(%s);"
+    COPY_CITIZENS = "COPY citizens_{import_id} (" + ','.join(CITIZENS_COLUMNS) + ") FROM STDIN;"
+    COPY_RELATIVES = "COPY relatives_{import_id} (id1, id2) FROM STDIN;"
+    # the import disappears for readers with its row, its partitions are dropped after that
+    DELETE_IMPORT = "DELETE FROM imports WHERE import_id = %s RETURNING import_id;"
+    DELETE_EXPIRED_IMPORTS = ("DELETE FROM imports WHERE import_time < LOCALTIMESTAMP - make_interval(days => %s) "
+                              "RETURNING import_id;")
+    # a table can have only one partition, which is detached concurrently, so deletes of imports wait for each other
+    LOCK_PARTITIONS_DETACH = "SELECT pg_advisory_lock(hashtext('detach_partitions'));"
+    UNLOCK_PARTITIONS_DETACH = "SELECT pg_advisory_unlock(hashtext('detach_partitions'));"
+    # (name, attached, detach pending) of the partitions of an import, relatives go first
+    SELECT_IMPORT_PARTITIONS = ("SELECT c.relname, i.inhrelid IS NOT NULL, COALESCE(i.inhdetachpending, FALSE) "
+                                "FROM pg_class c LEFT JOIN pg_inherits i ON i.inhrelid = c.oid "
+                                "WHERE c.oid IN (to_regclass('relatives_' || %(import_id)s), "
+                                "to_regclass('citizens_' || %(import_id)s)) ORDER BY c.relname DESC;")
+    # import ids of partitions left without their import by interrupted deletes
+    SELECT_ORPHAN_PARTITIONS = ("SELECT DISTINCT substring(relname FROM '_(\\d+)$')::INT AS import_id FROM pg_class "
+                                "WHERE relnamespace = current_schema()::regnamespace AND relkind = 'r' "
+                                "AND relname ~ '^(citizens|relatives)_\\d+$' "
+                                "AND substring(relname FROM '_(\\d+)$')::INT NOT IN (SELECT import_id FROM imports);")
+    # import jobs: bodies of POST /imports are staged in import_jobs and imported by the processes of import_jobs.py,
+    # NOTIFY wakes them up when the transaction is committed
+    INSERT_IMPORT_JOB = "INSERT INTO import_jobs (payload, created_time) VALUES (%s, %s) RETURNING job_id;"
+    NOTIFY_IMPORT_JOBS = "NOTIFY import_jobs;"
+    # a job is claimed by its row lock till the end of the import, SKIP LOCKED lets processes take different jobs.
+    # The attempt is counted and committed first, then the row is locked again for the import.
+    # The advisory lock is only visible to other sessions, so the job is shown as running
+    CLAIM_IMPORT_JOB = ("UPDATE import_jobs SET attempts = attempts + 1 WHERE job_id = "
+                        "(SELECT job_id FROM import_jobs WHERE status = 'queued' "
+                        "ORDER BY job_id LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING job_id, attempts;")
+    LOCK_CLAIMED_IMPORT_JOB = ("SELECT payload, created_time FROM import_jobs WHERE job_id = %s AND status = 'queued' "
+                               "FOR UPDATE SKIP LOCKED;")
+    LOCK_IMPORT_JOB = "SELECT pg_advisory_xact_lock(hashtext('import_jobs'), %s);"
+    FINISH_IMPORT_JOB = ("UPDATE import_jobs SET status = %(status)s, import_id = %(import_id)s, error = %(error)s, "
+                         "payload = NULL, started_time = %(started_time)s, finished_time = LOCALTIMESTAMP "
+                         "WHERE job_id = %(job_id)s;")
+    SELECT_IMPORT_JOB = ("SELECT j.status, j.import_id, j.error, EXISTS(SELECT 1 FROM pg_locks l "
+                         "WHERE l.locktype = 'advisory' AND l.classid = hashtext('import_jobs')::oid "
+                         "AND l.objid = j.job_id::oid AND l.objsubid = 2) FROM import_jobs j WHERE j.job_id = %s;")
+    COUNT_QUEUED_IMPORT_JOBS = "SELECT count(*) FROM import_jobs WHERE status = 'queued';"
+    DELETE_EXPIRED_IMPORT_JOBS = ("DELETE FROM import_jobs "
+                                  "WHERE finished_time < LOCALTIMESTAMP - make_interval(days => %s);")
+    SELECT_CITIZEN_DB_ID = "SELECT id FROM citizens WHERE import_id = %s AND citizen_id = %s;"
+    SELECT_CITIZENS = "SELECT {} FROM citizens WHERE import_id = %s;".format(','.join(CITIZEN_COLUMNS))
+    # relatives are stored in both directions: (id1, id2) and (id2, id1), a citizen related to himself - once,
+    # so relatives of a citizen are the rows with his id1, read from the primary key index.
+    # Every query filters citizens and relatives by import_id, so PostgreSQL reads only the partitions of the import
+    # pairs (citizen db id, relative db id) of the import
+    SELECT_RELATIVES_PAIRS = ("SELECT r.id1 AS id, r.id2 AS relative_id FROM relatives r "
+                              "WHERE r.import_id = %(import_id)s;")
+    SELECT_CITIZEN = "SELECT {} FROM citizens WHERE import_id = %s AND citizen_id = %s;".format(
+        ','.join(CITIZENS_COLUMNS))
+    SELECT_CITIZEN_RELATIVES = ("SELECT c.citizen_id FROM citizens c, relatives r "
+                                "WHERE r.import_id = %(import_id)s AND r.id1 = %(id)s "
+                                "AND c.import_id = %(import_id)s AND c.id = r.id2;")
+    # responses of GET /imports/$import_id/citizens and of PATCH as JSON documents {"data": ...} built by PostgreSQL,
+    # keys are sorted like in the responses of Flask. A changed citizen has import_id too, like SELECT_CITIZEN
+    CITIZEN_JSON_OBJECT = ("json_build_object('apartment', c.apartment, "
+                           "'birth_date', to_char(c.birth_date, 'DD.MM.YYYY'), 'building', c.building, "
+                           "'citizen_id', c.citizen_id, 'gender', c.gender, {import_id}'name', c.name, "
+                           "'relatives', {relatives}, 'street', c.street, 'town', c.town)")
+    SELECT_CITIZENS_JSON = ("SELECT json_build_object('data', COALESCE(json_agg({} ORDER BY c.id), '[]'))::text "
+                            "FROM citizens c LEFT JOIN ("
+                            "SELECT p.id, json_agg(rc.citizen_id) AS relatives FROM ({}) p, citizens rc "
+                            "WHERE rc.import_id = %(import_id)s AND rc.id = p.relative_id GROUP BY p.id"
+                            ") r ON r.id = c.id "
+                            "WHERE c.import_id = %(import_id)s;").format(
+        CITIZEN_JSON_OBJECT.format(import_id='', relatives="COALESCE(r.relatives, '[]')"),
+        SELECT_RELATIVES_PAIRS.rstrip(';'))
+    # pages of GET /imports/$import_id/citizens?limit=&after= are read by the key (import_id, citizen_id): partitions
+    # are pruned by import_id, and the page is a range of the unique index citizens_$import_id_uk, so it costs
+    # the same wherever it is in an import of any size. LIMIT NULL reads till the end of the import.
+    # Relatives are selected only if they are requested, by the array of db ids of the page: with a subquery
+    # PostgreSQL may hash join it with all relatives of a small import
+    SELECT_CITIZENS_PAGE = ("SELECT {} FROM citizens WHERE import_id = %(import_id)s AND citizen_id > %(after)s "
+                            "ORDER BY citizen_id LIMIT %(limit)s;").format(','.join(CITIZEN_COLUMNS))
+    SELECT_CITIZENS_PAGE_RELATIVES = ("SELECT r.id1, rc.citizen_id FROM relatives r, citizens rc "
+                                      "WHERE r.import_id = %(import_id)s AND r.id1 = ANY(%(ids)s) "
+                                      "AND rc.import_id = %(import_id)s AND rc.id = r.id2;")
+    SELECT_CITIZEN_JSON = ("SELECT json_build_object('data', {})::text FROM citizens c "
+                           "WHERE c.import_id = %(import_id)s AND c.citizen_id = %(citizen_id)s;").format(
+        CITIZEN_JSON_OBJECT.format(
+            import_id="'import_id', c.import_id, ",
+            relatives="(SELECT COALESCE(json_agg(rc.citizen_id), '[]') FROM citizens rc, relatives r "
+                      "WHERE r.import_id = %(import_id)s AND r.id1 = c.id "
+                      "AND rc.import_id = %(import_id)s AND rc.id = r.id2)"))
+    SELECT_CITIZEN_RELATIVES_DB_IDS = "SELECT id2 FROM relatives WHERE import_id = %(import_id)s AND id1 = %(id)s;"
+    # presents are counted by PostgreSQL, only non-zero counts per month and citizen are fetched
+    SELECT_PRESENTS_NUM = ("SELECT EXTRACT(MONTH FROM rc.birth_date)::INT AS month, c.citizen_id, COUNT(*) "
+                           "FROM citizens c, relatives r, citizens rc "
+                           "WHERE c.import_id = %(import_id)s AND r.import_id = %(import_id)s AND r.id1 = c.id "
+                           "AND rc.import_id = %(import_id)s AND rc.id = r.id2 "
+                           "GROUP BY month, c.citizen_id;")
+    SELECT_TOWNS_BIRTH_DATES = ("SELECT town, EXTRACT(YEAR FROM birth_date)::INT, "
+                                "(EXTRACT(MONTH FROM birth_date) * 100 + EXTRACT(DAY FROM birth_date))::INT "
+                                "FROM citizens WHERE import_id = %s;")
+    # rows of ImportSnapshot.from_rows
+    SELECT_SNAPSHOT_CITIZENS = ("SELECT id, citizen_id, town, EXTRACT(YEAR FROM birth_date)::INT, "
+                                "(EXTRACT(MONTH FROM birth_date) * 100 + EXTRACT(DAY FROM birth_date))::INT "
+                                "FROM citizens WHERE import_id = %s ORDER BY id;")
+    SELECT_SNAPSHOT_RELATIVES = "SELECT id1, id2 FROM relatives WHERE import_id = %s ORDER BY id1;"
+    # citizens and their relatives ordered by the citizen db id for the server-side cursors of the stream mode
+    SELECT_CITIZENS_ORDERED = "SELECT {} FROM citizens WHERE import_id = %s ORDER BY id;".format(
+        ','.join(CITIZEN_COLUMNS))
+    SELECT_RELATIVES_ORDERED = ("SELECT r.id1, rc.citizen_id FROM relatives r, citizens rc "
+                                "WHERE r.import_id = %(import_id)s AND rc.import_id = %(import_id)s AND rc.id = r.id2 "
+                                "ORDER BY r.id1;")
+    # statements of small requests, which are prepared once per connection, see prepared.py.
+    # PATCH statements are added to them when they are built. Reads of whole imports aren't there:
+    # their planning is a small part of the time, and a generic plan can't use statistics of the import partitions
+    PREPARED_STATEMENTS = ('SELECT_IMPORT_EXISTS', 'SELECT_IMPORT_REVISION', 'SELECT_CITIZEN_DB_ID', 'SELECT_CITIZEN',
+                           'SELECT_CITIZEN_RELATIVES', 'SELECT_CITIZEN_JSON', 'SELECT_CITIZENS_PAGE',
+                           'SELECT_CITIZENS_PAGE_RELATIVES', 'SELECT_IMPORT_JOB')
+    PERCENTILES = (50, 75, 99)
 
-    def __init__(self, **kwargs):
-        self.DB_REQUISITES = kwargs
+    @staticmethod
+    def _make_cache(cache_settings: dict = None):
+        # results of read requests are cached until the import is changed
+        cache_settings = cache_settings or {}
+        if cache_settings.get('enabled', True):
+            return ResultCache(cache_settings.get('max_entries', 256), cache_settings.get('max_items', 1000000))
+        return None
+
+    def cache_metrics(self) -> list:
+        if self._cache is None:
+            return []
+        cache_stats = self._cache.stats()
+        return [('ybs_cache_hits_total', {}, cache_stats['hits']),
+                ('ybs_cache_misses_total', {}, cache_stats['misses']),
+                ('ybs_cache_evictions_total', {}, cache_stats['evictions']),
+                ('ybs_cache_entries', {}, cache_stats['entries'])]
 
-        with psycopg2.connect(**self.DB_REQUISITES) as conn:
-            with conn.cursor() as cursor:
-                with open(self.SQL_FILES_DIR + 'create_tables.sql', 'r') as create_tables_sql_file:
-                    cursor.execute(create_tables_sql_file.read())
+    @staticmethod
+    def prepared_connection_settings(prepared_settings: dict = None) -> dict:
+        # parameters of psycopg2.connect for prepared statements. A generic plan of a statement on citizens or
+        # relatives is built for all their partitions: on the sixth execution it takes tens of milliseconds with
+        # hundreds of imports and then loses to custom plans anyway. So by default prepared statements are planned
+        # every time, and only parsing is saved
+        prepared_settings = prepared_settings or {}
+        if not prepared_settings.get('enabled', True):
+            return {}
+        return {'options': '-c plan_cache_mode={}'.format(prepared_settings.get('plan_cache_mode',
+                                                                                'force_custom_plan'))}
 
-        self._compiled_import_schema_validator = compile(self.IMPORT_SCHEMA)
+    @staticmethod
+    def _make_snapshots(snapshot_settings: dict = None):
+        # snapshots of imports for the analytic endpoints: import_id -> ImportSnapshot, bounded by their size
+        snapshot_settings = snapshot_settings or {}
+        if snapshot_settings.get('enabled', True):
+            return ResultCache(snapshot_settings.get('max_entries', 64), snapshot_settings.get('max_bytes', 268435456))
+        return None
+
+    def snapshot_metrics(self) -> list:
+        if self._snapshots is None:
+            return []
+        snapshots_stats = self._snapshots.stats()
+        return [('ybs_snapshot_entries', {}, snapshots_stats['entries']),
+                ('ybs_snapshot_bytes', {}, snapshots_stats['weight']),
+                ('ybs_snapshot_evictions_total', {}, snapshots_stats['evictions'])]
 
     @staticmethod
     def json_date_to_postrgesql_date(date: str) -> str:
         return datetime.datetime.strptime(date, "%d.%m.%Y").strftime("%Y-%m-%d")
 
+    @staticmethod
+    def valid_json_date_to_postgresql_date(date: str) -> str:
+        # fast path for dates, which have already passed validation
+        day, month, year = date.split('.')
+        return "{}-{}-{}".format(year, month, day)
+
     @staticmethod
     def postgresql_date_to_json_date(date: datetime.date) -> str:
         return date.strftime("%d.%m.%Y")
@@ -123,79 +331,531 @@ class DBHelper(metaclass=Singleton):
         else:
             return True
 
+    @staticmethod
+    def import_time() -> str:
+        return datetime.datetime.now().isoformat(' ', 'milliseconds')
+
+    @staticmethod
+    def revision_from_row(row) -> str:
+        # row - (import_time, version) of SELECT_IMPORT_REVISION
+        if row is None:
+            raise DBHelperIDError
+        return "{}.{}".format(row[0].strftime('%Y%m%d%H%M%S%f'), row[1])
+
+    @staticmethod
+    def import_job_from_row(job_id: int, row) -> dict:
+        # row - (status, import_id, error, locked) of SELECT_IMPORT_JOB
+        if row is None:
+            raise DBHelperJobIDError
+        status, import_id, error, locked = row
+        return {'job_id': job_id,
+                'status': 'running' if status == 'queued' and locked else status,
+                'import_id': import_id,
+                'error': error}
+
+    @staticmethod
+    def validation_error(errors: list) -> DBHelperError:
+        if any(error.kind == 'relatives' for error in errors):
+            return DBHelperRelativesError(errors)
+        return DBHelperJsonSchemaError(errors)
+
+    @classmethod
+    def citizens_rows(cls, import_id: int, citizens: list, citizen_id_to_citizen_db_id: dict):
+        # rows of validated citizens in the order of CITIZENS_COLUMNS
+        for citizen in citizens:
+            yield (citizen_id_to_citizen_db_id[citizen['citizen_id']],
+                   import_id,
+                   citizen['citizen_id'],
+                   citizen['town'],
+                   citizen['street'],
+                   citizen['building'],
+                   citizen['apartment'],
+                   citizen['name'],
+                   cls.valid_json_date_to_postgresql_date(citizen['birth_date']),
+                   citizen['gender'])
+
+    @staticmethod
+    def relatives_rows(relatives_pairs: list, citizen_id_to_citizen_db_id: dict):
+        # rows of relatives in both directions for the pairs of ImportValidator, each pair is there once
+        for citizen_id, relative_id in relatives_pairs:
+            citizen_db_id = citizen_id_to_citizen_db_id[citizen_id]
+            relative_db_id = citizen_id_to_citizen_db_id[relative_id]
+            yield citizen_db_id, relative_db_id
+            if citizen_db_id != relative_db_id:
+                yield relative_db_id, citizen_db_id
+
+    @classmethod
+    @metrics.timed
+    def citizens_from_rows(cls, citizens_rows: list, relatives_pairs: list) -> list:
+        # citizens_rows - rows of SELECT_CITIZENS, relatives_pairs - rows of SELECT_RELATIVES_PAIRS
+        citizens = [dict(zip(cls.CITIZEN_COLUMNS, values)) for values in citizens_rows]
+
+        for citizen in citizens:
+            citizen['relatives'] = []
+            citizen['birth_date'] = cls.postgresql_date_to_json_date(citizen['birth_date'])
+        keys = [citizen.pop('id') for citizen in citizens]
+        citizen_by_db_id = dict(zip(keys, citizens))
+
+        for pair in relatives_pairs:
+            citizen_by_db_id[pair[0]]['relatives'].append(citizen_by_db_id[pair[1]]['citizen_id'])
+        return citizens
+
+    @classmethod
+    def citizens_page_query(cls, args, max_limit: int):
+        # (limit, after, fields) of the query string args of GET /imports/$import_id/citizens or None without them,
+        # then the whole import is returned. limit None - till the end of the import, after - citizen_id of the last
+        # citizen of the previous page, fields - keys of citizens in the response
+        if not any(key in args for key in ('limit', 'after', 'fields')):
+            return None
+        try:
+            limit = int(args['limit']) if 'limit' in args else None
+            after = int(args['after']) if 'after' in args else -1
+        except ValueError:
+            raise DBHelperQueryError
+        fields = tuple(args['fields'].split(',')) if 'fields' in args else cls.CITIZEN_FIELDS
+        if limit is not None and not 0 < limit <= max_limit:
+            raise DBHelperQueryError
+        if not -1 <= after <= cls.MAX_CITIZEN_ID or not set(fields) <= set(cls.CITIZEN_FIELDS):
+            raise DBHelperQueryError
+        return limit, after, fields
+
+    @classmethod
+    def citizens_page_from_rows(cls, citizens_rows: list, relatives_rows, fields: tuple, limit) -> tuple:
+        # citizens_rows - rows of SELECT_CITIZENS_PAGE, relatives_rows - rows of SELECT_CITIZENS_PAGE_RELATIVES
+        # or None, if relatives aren't in fields. Return citizens with fields only and citizen_id of the last one
+        # if the page is full, so the next page is requested after it, otherwise None
+        citizens = []
+        relatives_by_db_id = {}
+        for values in citizens_rows:
+            row = dict(zip(cls.CITIZEN_COLUMNS, values))
+            citizen = {field: row[field] for field in fields if field != 'relatives'}
+            if 'birth_date' in citizen:
+                citizen['birth_date'] = cls.postgresql_date_to_json_date(citizen['birth_date'])
+            if relatives_rows is not None:
+                citizen['relatives'] = relatives_by_db_id[row['id']] = []
+            citizens.append(citizen)
+
+        for citizen_db_id, relative_id in relatives_rows or ():
+            relatives_by_db_id[citizen_db_id].append(relative_id)
+        full = limit is not None and len(citizens_rows) == limit
+        return citizens, citizens_rows[-1][cls.CITIZEN_COLUMNS.index('citizen_id')] if full else None
+
+    @classmethod
+    def citizen_from_row(cls, citizen_row) -> dict:
+        # citizen_row - row of SELECT_CITIZEN, id is left in the result to select the relatives
+        citizen_data = dict(zip(cls.CITIZENS_COLUMNS, citizen_row))
+        citizen_data['birth_date'] = cls.postgresql_date_to_json_date(citizen_data['birth_date'])
+        return citizen_data
+
+    @staticmethod
+    def drop_partitions_statements(partitions: list) -> list:
+        # partitions - rows of SELECT_IMPORT_PARTITIONS. Attached partitions are detached first: DETACH PARTITION
+        # CONCURRENTLY waits for queries to them without blocking other imports, DROP TABLE of a partition would lock
+        # the whole table. A detach, which was interrupted, is finalized
+        statements = ["ALTER TABLE {} DETACH PARTITION {} {};".format(name.rsplit('_', 1)[0], name,
+                                                                      'FINALIZE' if pending else 'CONCURRENTLY')
+                      for name, attached, pending in partitions if attached]
+        if partitions:
+            statements.append("DROP TABLE {};".format(', '.join(partition[0] for partition in partitions)))
+        return statements
+
+    @staticmethod
+    def json_from_row(row) -> str:
+        # row of SELECT_CITIZEN_JSON, there is no row for an unknown citizen
+        if row is None:
+            raise DBHelperIDError
+        return row[0]
+
+    @staticmethod
+    def json_citizens_num(citizens_json: str) -> int:
+        # weight of SELECT_CITIZENS_JSON results in the cache
+        return citizens_json.count('"citizen_id"')
+
+    @classmethod
+    def change_citizen_validator(cls):
+        # compiled by the first PATCH
+        if BaseDBHelper._change_citizen_validator is None:
+            from fastjsonschema import compile
+            BaseDBHelper._change_citizen_validator = compile(cls.CHANGE_CITIZEN_SCHEMA)
+        return BaseDBHelper._change_citizen_validator
+
+    @classmethod
+    def parse_citizen_patch(cls, patch_citizen_data: dict) -> tuple:
+        # validate the body of PATCH and return (fields to update in PostgreSQL format, new relatives or None)
+        from fastjsonschema import JsonSchemaException
+        try:
+            cls.change_citizen_validator()(patch_citizen_data)
+        except JsonSchemaException:
+            raise DBHelperJsonSchemaError
+
+        patch_citizen_data = dict(patch_citizen_data)
+        new_relatives = patch_citizen_data.pop('relatives', None)
+
+        # the fields are checked by the same rules as in imports, birth_date is changed to postgresql format
+        validator = ImportValidator()
+        validator.check_values(None, patch_citizen_data)
+        validator.check_relatives(None, new_relatives)
+        if validator.errors:
+            raise DBHelperJsonSchemaError(validator.errors)
+        if 'birth_date' in patch_citizen_data:
+            patch_citizen_data['birth_date'] = ImportValidator.parse_date(patch_citizen_data['birth_date']).isoformat()
+        return patch_citizen_data, new_relatives
+
+    @classmethod
+    def change_citizen_statement(cls, import_id: int, citizen_id: int, patch_citizen_data: dict, new_relatives,
+                                 as_json: bool = False) -> tuple:
+        # (query, parameters) of the whole PATCH in one statement. The citizen is locked, his new relatives are
+        # checked, relatives are replaced in both directions, fields are updated and the import version is bumped,
+        # but only if the citizen and all new relatives exist, otherwise nothing is changed and no row is returned.
+        # patch_citizen_data, new_relatives - result of parse_citizen_patch, new_relatives must be integers.
+        # The row is a changed citizen like SELECT_CITIZEN with relatives or the response body, if as_json
+        parts = ["citizen AS (SELECT id FROM citizens "
+                 "WHERE import_id = %(import_id)s AND citizen_id = %(citizen_id)s FOR UPDATE)"]
+        if new_relatives is not None:
+            # all parts of the statement see the relatives before it, so the new ones are returned from parameters
+            relatives = "%(relatives)s::INT[]"
+            parts += ["new_relatives AS (SELECT id FROM citizens "
+                      "WHERE import_id = %(import_id)s AND citizen_id = ANY(%(relatives)s::INT[]))",
+                      "checked AS (SELECT id FROM citizen "
+                      "WHERE (SELECT count(*) FROM new_relatives) = cardinality(%(relatives)s::INT[]))",
+                      "deleted AS (DELETE FROM relatives r USING checked WHERE r.import_id = %(import_id)s "
+                      "AND (r.id1 = checked.id AND r.id2 NOT IN (SELECT id FROM new_relatives) "
+                      "OR r.id2 = checked.id AND r.id1 NOT IN (SELECT id FROM new_relatives)))",
+                      "inserted AS (INSERT INTO relatives (import_id, id1, id2) "
+                      "SELECT %(import_id)s, checked.id, n.id FROM checked, new_relatives n UNION "
+                      "SELECT %(import_id)s, n.id, checked.id FROM checked, new_relatives n "
+                      "ON CONFLICT DO NOTHING)"]
+        else:
+            relatives = ("ARRAY(SELECT rc.citizen_id FROM relatives r, citizens rc "
+                         "WHERE r.import_id = %(import_id)s AND r.id1 = c.id "
+                         "AND rc.import_id = %(import_id)s AND rc.id = r.id2)")
+            parts.append("checked AS (SELECT id FROM citizen)")
+
+        if patch_citizen_data:
+            parts.append("updated AS (UPDATE citizens SET {} FROM checked "
+                         "WHERE citizens.import_id = %(import_id)s AND citizens.id = checked.id "
+                         "RETURNING citizens.*)".format(",".join(map("{0}=%({0})s".format,
+                                                                     sorted(patch_citizen_data)))))
+            source = "updated c"
+        else:
+            source = "citizens c, checked WHERE c.import_id = %(import_id)s AND c.id = checked.id"
+        parts.append("bumped AS (UPDATE imports SET version = version + 1 "
+                     "WHERE import_id = %(import_id)s AND EXISTS(SELECT 1 FROM checked))")
+
+        if as_json:
+            columns = "json_build_object('data', {})::text".format(
+                cls.CITIZEN_JSON_OBJECT.format(import_id="'import_id', c.import_id, ",
+                                               relatives="to_json({})".format(relatives)))
+        else:
+            columns = ",".join(["c." + column for column in cls.CITIZENS_COLUMNS] + [relatives])
+        query = "WITH {} SELECT {} FROM {};".format(", ".join(parts), columns, source)
+        return query, {**patch_citizen_data, 'import_id': import_id, 'citizen_id': citizen_id,
+                       'relatives': new_relatives}
+
+    @classmethod
+    def changed_citizen_from_row(cls, row, as_json: bool = False):
+        # row of change_citizen_statement
+        if as_json:
+            return row[0]
+        citizen_data = cls.citizen_from_row(row[:-1])
+        citizen_data.pop('id')
+        citizen_data['relatives'] = row[-1]
+        return citizen_data
+
+    @staticmethod
+    def integer_relatives(new_relatives):
+        # relatives of PATCH are checked by parse_citizen_patch, a too big one can't be a citizen_id
+        if new_relatives is None:
+            return None
+        if any(abs(relative_id) > ImportValidator.MAX_INTEGER for relative_id in new_relatives):
+            raise DBHelperRelativesError
+        return new_relatives
+
+    @staticmethod
+    @metrics.timed
+    def presents_from_rows(presents_num: list) -> dict:
+        # presents_num - rows of SELECT_PRESENTS_NUM
+        presents_num_per_month_result = {str(month): [] for month in range(1, 13)}
+        for month, citizen_id, presents in sorted(presents_num):
+            presents_num_per_month_result[str(month)].append({'citizen_id': citizen_id, 'presents': presents})
+        return presents_num_per_month_result
+
+    @staticmethod
+    def calculate_age(born: datetime.date) -> int:
+        today = datetime.date.today()
+        if (today.month, today.day) < (born.month, born.day):
+            return today.year - born.year - 1
+        else:
+            return today.year - born.year
+
+    @staticmethod
+    def calculate_ages(birth_years, birth_month_days, today: datetime.date):
+        # vectorized calculate_age, birth_month_days - month * 100 + day
+        return today.year - birth_years - (today.month * 100 + today.day < birth_month_days)
+
+    @staticmethod
+    def grouped_percentiles(group_codes, values, percentiles: tuple):
+        # numpy.percentile with the default linear method for every group at once:
+        # row i of the result holds the percentiles of values[group_codes == i].
+        # The arithmetic is the same as in numpy (virtual index (n - 1) * q and _lerp),
+        # so the results are equal up to the last bit
+        from numpy import array, lexsort, bincount, cumsum, true_divide, floor, intp, minimum, subtract
+        order = lexsort((values, group_codes))
+        sorted_values = values[order]
+        counts = bincount(group_codes)
+        starts = (cumsum(counts) - counts)[:, None]
+        counts = counts[:, None]
+
+        virtual_indexes = (counts - 1) * true_divide(array(percentiles), 100)[None, :]
+        previous_indexes = floor(virtual_indexes).astype(intp)
+        next_indexes = minimum(previous_indexes + 1, counts - 1)
+        previous_indexes = minimum(previous_indexes, counts - 1)
+        gamma = virtual_indexes - previous_indexes
+
+        previous_values = sorted_values[starts + previous_indexes]
+        next_values = sorted_values[starts + next_indexes]
+        diff = next_values - previous_values
+        result = previous_values + diff * gamma
+        subtract(next_values, diff * (1 - gamma), out=result, where=gamma >= 0.5)
+        return result
+
+    @classmethod
+    @metrics.timed
+    def town_stat_from_rows(cls, rows: list) -> list:
+        # rows - rows of SELECT_TOWNS_BIRTH_DATES
+        if not rows:
+            return []
+
+        from numpy import array, unique
+        towns, birth_years, birth_month_days = zip(*rows)
+        town_names, town_codes = unique(array(towns, dtype=object), return_inverse=True)
+        return cls.town_stat(town_names.tolist(), town_codes, array(birth_years), array(birth_month_days))
+
+    @classmethod
+    def town_stat(cls, town_names: list, town_codes, birth_years, birth_month_days) -> list:
+        # town_codes - indexes of town_names, towns without citizens are skipped, the result is ordered by town
+        if not len(town_codes):
+            return []
+
+        from numpy import ceil, unique
+        town_indexes, town_codes = unique(town_codes, return_inverse=True)
+        ages = cls.calculate_ages(birth_years, birth_month_days, datetime.date.today())
+        age_percentiles = ceil(cls.grouped_percentiles(town_codes, ages, cls.PERCENTILES)).astype(int).tolist()
+        keys = ["town"] + list(map(lambda x: "p" + str(x), cls.PERCENTILES))
+        return [dict(zip(keys, [town] + town_age_percentiles))
+                for town, town_age_percentiles in sorted(zip([town_names[index] for index in town_indexes.tolist()],
+                                                             age_percentiles))]
+
+    @classmethod
+    @metrics.timed
+    def town_stat_from_snapshot(cls, snapshot) -> list:
+        return cls.town_stat(snapshot.town_names, snapshot.town_codes, snapshot.birth_years,
+                             snapshot.birth_month_days)
+
+    @staticmethod
+    @metrics.timed
+    def presents_from_snapshot(snapshot) -> dict:
+        # same as presents_from_rows: presents of a citizen in a month are his relatives born in the month.
+        # (month, citizen_id) pairs are counted as month << 32 | citizen_id + 2 ** 31, which sorts like the pairs
+        from numpy import unique, int64
+        months = snapshot.birth_month_days[snapshot.relative_indexes].astype(int64) // 100
+        keys, presents = unique((months << 32) | (snapshot.citizen_ids[snapshot.relative_sources()] + 2 ** 31),
+                                return_counts=True)
+        presents_num_per_month_result = {str(month): [] for month in range(1, 13)}
+        for key, citizen_presents in zip(keys.tolist(), presents.tolist()):
+            presents_num_per_month_result[str(key >> 32)].append({'citizen_id': (key & 0xFFFFFFFF) - 2 ** 31,
+                                                                   'presents': citizen_presents})
+        return presents_num_per_month_result
+
+
+metrics.register_statements({name: value for name, value in vars(BaseDBHelper).items()
+                              if name.isupper() and isinstance(value, str)})
+statements.register({name: getattr(BaseDBHelper, name) for name in BaseDBHelper.PREPARED_STATEMENTS})
+
+
+class DBHelper(BaseDBHelper, metaclass=Singleton):
+    def __init__(self, pool_settings: dict = None, import_method: str = 'copy', import_batch_size: int = 5000,
+                 stream_batch_size: int = 1000, cache_settings: dict = None, replica_settings: dict = None,
+                 snapshot_settings: dict = None, prepared_settings: dict = None, **kwargs):
+        if import_method not in self.IMPORT_METHODS:
+            raise ValueError("Unknown import method: {}".format(import_method))
+
+        self.DB_REQUISITES = kwargs
+        self.import_method = import_method
+        self.import_batch_size = import_batch_size
+        self.stream_batch_size = stream_batch_size
+        self._cache = self._make_cache(cache_settings)
+        self._snapshots = self._make_snapshots(snapshot_settings)
+        # every statement and checkout is timed for /metrics, statements of the registry are prepared
+        connection_settings = {'cursor_factory': InstrumentedCursor}
+        prepared_settings = prepared_settings or {}
+        if prepared_settings.get('enabled', True):
+            max_statements = prepared_settings.get('max_statements', 100)
+            connection_settings = {'cursor_factory': PreparingCursor,
+                                   'connection_factory': functools.partial(PreparingConnection,
+                                                                           max_statements=max_statements),
+                                   **self.prepared_connection_settings(prepared_settings)}
+        self._pool = ConnectionPool(**(pool_settings or {}),
+                                    on_checkout=lambda seconds: metrics.observe('ybs_pool_checkout_duration_seconds',
+                                                                                seconds),
+                                    **connection_settings,
+                                    **self.DB_REQUISITES)
+        # reads of imports go to replicas, everything else and the revisions of imports - to the primary
+        replica_settings = replica_settings or {}
+        self._replicas = ReplicaSet(replica_settings.get('hosts', []), replica_settings.get('retry_interval', 30.0),
+                                    **(pool_settings or {}),
+                                    **connection_settings,
+                                    **{key: value for key, value in self.DB_REQUISITES.items()
+                                       if key not in ('host', 'port')})
+        metrics.add_collector(self.collect_metrics)
+
+        # the schema is migrated by the gunicorn master or python3 config.py m, see migrations.py
+        with self._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                check_schema_version(cursor)
+
+    def pool_stats(self) -> dict:
+        return {**self._pool.stats(), 'replicas': self._replicas.stats()}
+
+    @contextmanager
+    def _read_connection(self, import_id: int, revision: str):
+        # connection of a replica, which has replayed the import up to revision, otherwise of the primary.
+        # revision is read from the primary, so a client reads its own writes and never an older state
+        # than a previous response. Errors after the connection is chosen aren't retried
+        for index, pool in self._replicas.candidates():
+            chosen = False
+            try:
+                with pool.connection() as conn:
+                    with conn.cursor() as cursor:
+                        cursor.execute(self.SELECT_IMPORT_REVISION, (import_id,))
+                        row = cursor.fetchone()
+                    if row is None or self.revision_from_row(row) != revision:
+                        metrics.inc('ybs_replica_skips_total', replica=self._replicas.names[index], reason='lagging')
+                        continue
+                    chosen = True
+                    metrics.inc('ybs_db_reads_total', target=self._replicas.names[index])
+                    yield conn
+                    return
+            except (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError) as e:
+                if chosen:
+                    raise
+                print(e)
+                self._replicas.failed(index)
+                metrics.inc('ybs_replica_skips_total', replica=self._replicas.names[index], reason='error')
+
+        if self._replicas.pools:
+            metrics.inc('ybs_db_reads_total', target='primary')
+        with self._pool.connection() as conn:
+            yield conn
+
+    def collect_metrics(self) -> list:
+        pool_stats = self._pool.stats()
+        return [('ybs_pool_connections', {'state': 'idle'}, pool_stats['idle']),
+                ('ybs_pool_connections', {'state': 'in_use'}, pool_stats['in_use']),
+                ('ybs_pool_timeouts_total', {}, pool_stats['timeouts'])] + self.cache_metrics() + \
+            self.snapshot_metrics()
+
     def import_exists(self, import_id: int) -> bool:
         # validate if import_id exists
-        with psycopg2.connect(**self.DB_REQUISITES) as conn:
+        with self._pool.connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT * FROM imports WHERE import_id = %s;", (import_id,))
+                cursor.execute(self.SELECT_IMPORT_EXISTS, (import_id,))
                 result = cursor.fetchone()
         return result is not None
 
+    @metrics.timed
+    def get_import_revision(self, import_id: int) -> str:
+        # revision of an import changes with every change of its citizens: it's the import time and
+        # the version, which is bumped by PATCH. Raise DBHelperIDError for unknown import
+        with self._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.SELECT_IMPORT_REVISION, (import_id,))
+                return self.revision_from_row(cursor.fetchone())
+
+    def _cached(self, endpoint: str, import_id: int, revision, compute, weight):
+        # results are cached by (endpoint, import_id, revision), weight(result) is its size for the cache budget
+        if self._cache is None:
+            return compute()
+
+        key = (endpoint, import_id, revision)
+        result = self._cache.get(key)
+        if result is MISSING:
+            result = compute()
+            self._cache.put(key, result, weight(result), group=(endpoint, import_id))
+        return result
+
+    def cache_stats(self) -> dict:
+        return self._cache.stats() if self._cache is not None else {}
+
+    def _snapshot(self, import_id: int, revision: str):
+        # the snapshot is built once per revision, PATCH changes it in place of rebuilding, see change_citizen
+        from snapshot import ImportSnapshot
+        snapshot = self._snapshots.get(import_id)
+        if snapshot is MISSING or snapshot.revision != revision:
+            with self._read_connection(import_id, revision) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(self.SELECT_SNAPSHOT_CITIZENS, (import_id,))
+                    citizens_rows = cursor.fetchall()
+                    cursor.execute(self.SELECT_SNAPSHOT_RELATIVES, (import_id,))
+                    relatives_rows = cursor.fetchall()
+            with metrics.timer('ybs_snapshot_build_duration_seconds'):
+                snapshot = ImportSnapshot.from_rows(revision, citizens_rows, relatives_rows)
+            self._snapshots.put(import_id, snapshot, snapshot.nbytes)
+        return snapshot
+
+    def _update_snapshot(self, import_id: int, revision_row, citizen_data: dict):
+        # revision_row - (import_time, version) made by a committed PATCH of citizen_data. The snapshot is changed
+        # only if it has the previous version, otherwise it's left to be rebuilt by the next read
+        snapshot = self._snapshots.get(import_id)
+        if snapshot is MISSING:
+            return
+        import_time, version = revision_row
+        if snapshot.revision == self.revision_from_row((import_time, version - 1)):
+            snapshot = snapshot.with_citizen(self.revision_from_row(revision_row), citizen_data)
+            self._snapshots.put(import_id, snapshot, snapshot.nbytes)
+            metrics.inc('ybs_snapshot_updates_total')
+
     def citizen_exists(self, import_id: int, citizen_id: int) -> bool:
         # validate if citizen_id with import_id exists
-        with psycopg2.connect(**self.DB_REQUISITES) as conn:
+        with self._pool.connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT * FROM citizens WHERE import_id = %s AND citizen_id = %s;",
-                               (import_id, citizen_id))
+                cursor.execute(self.SELECT_CITIZEN_DB_ID, (import_id, citizen_id))
                 result = cursor.fetchone()
         return result is not None
 
+    @metrics.timed
     def import_citizens(self, citizens: dict) -> int:
-        # check citizens
-        try:
-            self._compiled_import_schema_validator(citizens)
-        except JsonSchemaException:
-            raise DBHelperJsonSchemaError
-
-        citizens = citizens['citizens']
+        # check citizens, birth_date and relatives in a single pass
+        validator = ImportValidator()
+        relatives_pairs = validator.validate(citizens)
+        if validator.errors:
+            raise self.validation_error(validator.errors)
 
-        # check birth_date
-        for citizen in citizens:
-            if not self.validate_json_birth_date_format(citizen['birth_date']):
-                raise DBHelperJsonSchemaError
-
-        # check relatives
-        relatives_ids = {citizen['citizen_id']: citizen['relatives'] for citizen in citizens}
-        for citizen_id, citizen_relatives_ids in relatives_ids.items():
-            for relative_id in citizen_relatives_ids:
-                if citizen_id not in relatives_ids[relative_id]:
-                    raise DBHelperRelativesError
+        with self._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                try:
+                    import_id = self._write_import(cursor, citizens['citizens'], relatives_pairs)
+                except (psycopg2.DatabaseError, psycopg2.Warning) as e:
+                    conn.rollback()
+                    print(e)
+                    raise DBHelperJsonSchemaError
+                else:
+                    conn.commit()
+                    return import_id
 
-        with psycopg2.connect(**self.DB_REQUISITES) as conn:
+    @metrics.timed
+    def import_citizens_stream(self, citizens) -> int:
+        # citizens - iterable of citizens, e.g. parsed from the request body on the fly.
+        # Every citizen is validated as it arrives and written with COPY in batches of import_batch_size,
+        # so only ids and unmatched relations are kept in memory, not the whole import
+        with self._pool.connection() as conn:
             with conn.cursor() as cursor:
                 try:
-                    # INSERT INTO imports
-                    cursor.execute("INSERT INTO imports (import_time) VALUES (%s) RETURNING import_id;",
-                                   (datetime.datetime.now().isoformat(' ', 'milliseconds'),))
-                    import_id = cursor.fetchone()[0]
-
-                    # INSERT INTO citizens
-                    for citizen in citizens:
-                        citizen['import_id'] = import_id
-                        citizen['birth_date'] = self.json_date_to_postrgesql_date(citizen['birth_date'])
-                    columns = tuple(filter(lambda x: x != 'id', self.CITIZENS_COLUMNS))
-                    extras.execute_values(cursor,
-                                          "INSERT INTO citizens ({}) VALUES %s;".format(','.join(columns)),
-                                          citizens,
-                                          "({})".format(','.join(map(lambda x: "%({})s".format(x), columns))))
-
-                    # INSERT INTO relatives
-                    cursor.execute("SELECT id, citizen_id FROM citizens WHERE import_id = %s;", (import_id,))
-                    query_result = array(cursor.fetchall())
-                    citizen_id_to_citizen_db_id = dict(zip(query_result[:, 1].tolist(), query_result[:, 0].tolist()))
-
-                    worked_relatives = set()
-                    relatives_db_ids = []
-                    for citizen_id, citizen_relatives_ids in relatives_ids.items():
-                        for relative_id in citizen_relatives_ids:
-                            if relative_id not in worked_relatives:
-                                relatives_db_ids.append((citizen_id_to_citizen_db_id[citizen_id],
-                                                         citizen_id_to_citizen_db_id[relative_id]))
-                        worked_relatives.add(citizen_id)
-                    extras.execute_values(cursor,
-                                          "INSERT INTO relatives (id1, id2) VALUES %s;",
-                                          relatives_db_ids,
-                                          "(%s, %s)")
+                    import_id = self._write_import_stream(cursor, citizens)
+                except ValueError:
+                    # malformed or not UTF-8 request body
+                    conn.rollback()
+                    raise DBHelperJsonSchemaError
                 except (psycopg2.DatabaseError, psycopg2.Warning) as e:
                     conn.rollback()
                     print(e)
@@ -204,222 +864,389 @@ class DBHelper(metaclass=Singleton):
                     conn.commit()
                     return import_id
 
-    def get_citizens(self, import_id: int) -> list:
-        # check import_id
-        if not self.import_exists(import_id):
-            raise DBHelperIDError
+    def _write_import(self, cursor, citizens: list, relatives_pairs: list) -> int:
+        # citizens are validated already, the caller commits or rolls back
+        # INSERT INTO imports
+        cursor.execute(self.INSERT_IMPORT, (self.import_time(),))
+        import_id = cursor.fetchone()[0]
+        cursor.execute(self.CREATE_IMPORT_PARTITIONS, (import_id,))
 
-        with psycopg2.connect(**self.DB_REQUISITES) as conn:
+        # INSERT INTO citizens and relatives
+        if self.import_method == 'copy':
+            self._copy_citizens(cursor, import_id, citizens, relatives_pairs, dict())
+        else:
+            self._insert_citizens_values(cursor, import_id, citizens, relatives_pairs)
+        cursor.execute(self.ATTACH_IMPORT_PARTITIONS, (import_id,))
+        return import_id
+
+    def _write_import_stream(self, cursor, citizens) -> int:
+        # citizens are validated on the way, the caller commits or rolls back
+        validator = ImportValidator()
+
+        # INSERT INTO imports
+        cursor.execute(self.INSERT_IMPORT, (self.import_time(),))
+        import_id = cursor.fetchone()[0]
+        cursor.execute(self.CREATE_IMPORT_PARTITIONS, (import_id,))
+
+        # INSERT INTO citizens and relatives by batches
+        citizen_id_to_citizen_db_id = dict()
+        batch, relatives_pairs = [], []
+        for citizen in citizens:
+            relatives_pairs.extend(validator.feed(citizen))
+            if validator.errors:
+                raise self.validation_error(validator.errors)
+            batch.append(citizen)
+            if len(batch) >= self.import_batch_size:
+                self._copy_citizens(cursor, import_id, batch, relatives_pairs, citizen_id_to_citizen_db_id)
+                batch, relatives_pairs = [], []
+
+        if validator.finish():
+            raise self.validation_error(validator.errors)
+        self._copy_citizens(cursor, import_id, batch, relatives_pairs, citizen_id_to_citizen_db_id)
+        cursor.execute(self.ATTACH_IMPORT_PARTITIONS, (import_id,))
+        return import_id
+
+    @metrics.timed
+    def enqueue_import(self, payload: bytes) -> int:
+        # the request body is stored as is, it's validated and imported later by run_import_job
+        with self._pool.connection() as conn:
             with conn.cursor() as cursor:
-                columns = tuple(filter(lambda x: x != 'import_id', self.CITIZENS_COLUMNS))
-                cursor.execute("SELECT {} "
-                               "FROM citizens WHERE import_id = %s;".format(','.join(columns)), (import_id,))
-                citizens = [dict(zip(columns, values)) for values in cursor.fetchall()]
-
-                for citizen in citizens:
-                    citizen['relatives'] = []
-                    citizen['birth_date'] = self.postgresql_date_to_json_date(citizen['birth_date'])
-                keys = [citizen.pop('id') for citizen in citizens]
-                citizen_by_db_id = dict(zip(keys, citizens))
-
-                cursor.execute(
-                    "SELECT c.id, r.id1 FROM citizens c, relatives r "
-                    "WHERE c.id = r.id2 AND c.import_id = %(import_id)s "
-                    "UNION "
-                    "SELECT c.id, r.id2 FROM citizens c, relatives r "
-                    "WHERE c.id = r.id1 AND c.import_id = %(import_id)s AND r.id1 != r.id2;",
-                    {"import_id": import_id})
-                for pair in cursor.fetchall():
-                    citizen_by_db_id[pair[0]]['relatives'].append(citizen_by_db_id[pair[1]]['citizen_id'])
+                cursor.execute(self.INSERT_IMPORT_JOB, (payload, self.import_time()))
+                job_id = cursor.fetchone()[0]
+                cursor.execute(self.NOTIFY_IMPORT_JOBS)
+        metrics.inc('ybs_import_jobs_enqueued_total')
+        return job_id
+
+    @metrics.timed
+    def get_import_job(self, job_id: int) -> dict:
+        with self._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.SELECT_IMPORT_JOB, (job_id,))
+                return self.import_job_from_row(job_id, cursor.fetchone())
 
-        return citizens
+    def count_queued_import_jobs(self) -> int:
+        with self._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.COUNT_QUEUED_IMPORT_JOBS)
+                return cursor.fetchone()[0]
+
+    def run_import_job(self, streaming: bool = False, max_attempts: int = 3):
+        # import the oldest queued job, return its job_id or None if there are no queued jobs.
+        # The job row stays locked till the import is committed, if the process dies the job stays queued.
+        # A job taken max_attempts times, e.g. one which kills the process, is failed without importing it
+        with self._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.CLAIM_IMPORT_JOB)
+                row = cursor.fetchone()
+                conn.commit()
+                if row is None:
+                    return None
+                job_id, attempts = row
+                cursor.execute(self.LOCK_CLAIMED_IMPORT_JOB, (job_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    # another process has taken it between the transactions
+                    conn.rollback()
+                    return job_id
+                payload, created_time = row
+                started_time = datetime.datetime.now()
+                metrics.observe('ybs_import_job_wait_seconds', (started_time - created_time).total_seconds())
+                cursor.execute(self.LOCK_IMPORT_JOB, (job_id,))
+
+                job = {'job_id': job_id, 'status': 'done', 'import_id': None, 'error': None,
+                       'started_time': started_time}
+                cursor.execute("SAVEPOINT import_job;")
+                try:
+                    if attempts > max_attempts:
+                        raise DBHelperJobAttemptsError
+                    if streaming:
+                        job['import_id'] = self._write_import_stream(cursor, iter_import_citizens(io.BytesIO(payload)))
+                    else:
+                        citizens = json.loads(bytes(payload))
+                        validator = ImportValidator()
+                        relatives_pairs = validator.validate(citizens)
+                        if validator.errors:
+                            raise self.validation_error(validator.errors)
+                        job['import_id'] = self._write_import(cursor, citizens['citizens'], relatives_pairs)
+                except DBHelperError as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT import_job;")
+                    job.update(status='failed', error=str(e))
+                except (ValueError, psycopg2.DatabaseError, psycopg2.Warning) as e:
+                    # malformed body or an error of the database, reported as by POST /imports
+                    cursor.execute("ROLLBACK TO SAVEPOINT import_job;")
+                    if not isinstance(e, ValueError):
+                        print(e)
+                    job.update(status='failed', error=str(DBHelperJsonSchemaError()))
+                cursor.execute(self.FINISH_IMPORT_JOB, job)
+            conn.commit()
 
-    def get_citizen(self, import_id: int, citizen_id: int) -> dict:
-        # check if citizen exists
-        if not self.citizen_exists(import_id, citizen_id):
-            raise DBHelperIDError
+        metrics.inc('ybs_import_jobs_finished_total', status=job['status'])
+        metrics.observe('ybs_import_job_duration_seconds', (datetime.datetime.now() - started_time).total_seconds(),
+                        status=job['status'])
+        return job_id
 
-        with psycopg2.connect(**self.DB_REQUISITES) as conn:
+    @staticmethod
+    def _copy_value(value) -> str:
+        # escaping for the text format of COPY
+        return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def _copy_citizens(self, cursor, import_id: int, citizens: list, relatives_pairs: list,
+                       citizen_id_to_citizen_db_id: dict):
+        # relatives_pairs may also refer to citizens of previous batches, which are in citizen_id_to_citizen_db_id
+
+        # pre-allocate ids, so the inserted citizens don't have to be read back
+        cursor.execute(self.ALLOCATE_CITIZENS_IDS, (len(citizens),))
+        citizen_id_to_citizen_db_id.update(zip((citizen['citizen_id'] for citizen in citizens),
+                                               (row[0] for row in cursor.fetchall())))
+
+        # COPY citizens
+        buffer = io.StringIO()
+        for row in self.citizens_rows(import_id, citizens, citizen_id_to_citizen_db_id):
+            buffer.write('\t'.join(map(self._copy_value, row)) + '\n')
+        buffer.seek(0)
+        cursor.copy_expert(self.COPY_CITIZENS.format(import_id=import_id), buffer)
+
+        # COPY relatives
+        buffer = io.StringIO()
+        for row in self.relatives_rows(relatives_pairs, citizen_id_to_citizen_db_id):
+            buffer.write("{}\t{}\n".format(*row))
+        buffer.seek(0)
+        cursor.copy_expert(self.COPY_RELATIVES.format(import_id=import_id), buffer)
+
+    def _insert_citizens_values(self, cursor, import_id: int, citizens: list, relatives_pairs: list):
+        # INSERT INTO the partitions of the import
+        for citizen in citizens:
+            citizen['import_id'] = import_id
+            citizen['birth_date'] = self.json_date_to_postrgesql_date(citizen['birth_date'])
+        columns = tuple(filter(lambda x: x != 'id', self.CITIZENS_COLUMNS))
+        extras.execute_values(cursor,
+                              "INSERT INTO citizens_{} ({}) VALUES %s;".format(import_id, ','.join(columns)),
+                              citizens,
+                              "({})".format(','.join(map(lambda x: "%({})s".format(x), columns))))
+
+        # INSERT INTO relatives
+        from numpy import array
+        cursor.execute("SELECT id, citizen_id FROM citizens_{};".format(import_id))
+        query_result = array(cursor.fetchall())
+        citizen_id_to_citizen_db_id = dict(zip(query_result[:, 1].tolist(), query_result[:, 0].tolist()))
+
+        extras.execute_values(cursor,
+                              "INSERT INTO relatives_{} (id1, id2) VALUES %s;".format(import_id),
+                              list(self.relatives_rows(relatives_pairs, citizen_id_to_citizen_db_id)),
+                              "(%s, %s)")
+
+    @metrics.timed
+    def get_citizens(self, import_id: int, revision: str = None) -> list:
+        # revision - result of get_import_revision, if it's already known
+        if revision is None:
+            revision = self.get_import_revision(import_id)
+        return self._cached('citizens', import_id, revision, lambda: self._get_citizens(import_id, revision), len)
+
+    @metrics.timed
+    def _get_citizens(self, import_id: int, revision: str) -> list:
+        with self._read_connection(import_id, revision) as conn:
             with conn.cursor() as cursor:
-                columns = self.CITIZENS_COLUMNS
-                cursor.execute("SELECT {} "
-                               "FROM citizens WHERE import_id = %s AND citizen_id = %s;".format(','.join(columns)),
-                               (import_id, citizen_id))
-                citizen_data = dict(zip(columns, cursor.fetchone()))
-
-                citizen_data['birth_date'] = self.postgresql_date_to_json_date(citizen_data['birth_date'])
+                cursor.execute(self.SELECT_CITIZENS, (import_id,))
+                citizens_rows = cursor.fetchall()
+                cursor.execute(self.SELECT_RELATIVES_PAIRS, {"import_id": import_id})
+                relatives_pairs = cursor.fetchall()
+        return self.citizens_from_rows(citizens_rows, relatives_pairs)
+
+    @metrics.timed
+    def get_citizens_page(self, import_id: int, revision: str, limit, after: int, fields: tuple) -> tuple:
+        # (citizens, citizen_id of the next page or None) for citizens_page_query, pages aren't cached
+        with self._read_connection(import_id, revision) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.SELECT_CITIZENS_PAGE, {'import_id': import_id, 'after': after, 'limit': limit})
+                citizens_rows = cursor.fetchall()
+                relatives_rows = None
+                if 'relatives' in fields:
+                    cursor.execute(self.SELECT_CITIZENS_PAGE_RELATIVES,
+                                   {'import_id': import_id, 'ids': [row[0] for row in citizens_rows]})
+                    relatives_rows = cursor.fetchall()
+        return self.citizens_page_from_rows(citizens_rows, relatives_rows, fields, limit)
+
+    @metrics.timed
+    def get_citizens_json(self, import_id: int, revision: str = None) -> str:
+        # the whole response body built by PostgreSQL, it's passed to the client without decoding
+        if revision is None:
+            revision = self.get_import_revision(import_id)
+        return self._cached('citizens_json', import_id, revision,
+                            lambda: self._get_citizens_json(import_id, revision), self.json_citizens_num)
+
+    @metrics.timed
+    def _get_citizens_json(self, import_id: int, revision: str) -> str:
+        with self._read_connection(import_id, revision) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.SELECT_CITIZENS_JSON, {"import_id": import_id})
+                return cursor.fetchone()[0]
+
+    def get_citizens_stream(self, import_id: int, revision: str = None):
+        # check import_id before the first citizen is requested, so an error can still be returned
+        if revision is None:
+            revision = self.get_import_revision(import_id)
+
+        return self._iter_citizens(import_id, revision)
+
+    def _iter_citizens(self, import_id: int, revision: str):
+        # citizens and their relatives are read by server-side cursors ordered by the citizen db id
+        # and merged on the fly, so only stream_batch_size rows of each query are held in memory
+        with self._read_connection(import_id, revision) as conn:
+            with conn.cursor('citizens_stream') as citizens_cursor, \
+                    conn.cursor('relatives_stream') as relatives_cursor:
+                citizens_cursor.itersize = self.stream_batch_size
+                relatives_cursor.itersize = self.stream_batch_size
+
+                columns = self.CITIZEN_COLUMNS
+                citizens_cursor.execute(self.SELECT_CITIZENS_ORDERED, (import_id,))
+                relatives_cursor.execute(self.SELECT_RELATIVES_ORDERED, {"import_id": import_id})
+
+                relatives = iter(relatives_cursor)
+                relative = next(relatives, None)
+                for values in citizens_cursor:
+                    citizen = dict(zip(columns, values))
+                    citizen_db_id = citizen.pop('id')
+                    citizen['birth_date'] = self.postgresql_date_to_json_date(citizen['birth_date'])
+                    citizen['relatives'] = []
+                    while relative is not None and relative[0] == citizen_db_id:
+                        citizen['relatives'].append(relative[1])
+                        relative = next(relatives, None)
+                    yield citizen
 
-                cursor.execute("SELECT c.citizen_id FROM citizens c, relatives r "
-                               "WHERE r.id1 = %(id)s AND r.id2 = c.id OR r.id1 = c.id AND r.id2 = %(id)s;",
-                               {'id': citizen_data.pop('id')})
+    @metrics.timed
+    def get_citizen(self, import_id: int, citizen_id: int) -> dict:
+        with self._read_connection(import_id, self.get_import_revision(import_id)) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.SELECT_CITIZEN, (import_id, citizen_id))
+                citizen_row = cursor.fetchone()
+                # check if citizen exists
+                if citizen_row is None:
+                    raise DBHelperIDError
+                citizen_data = self.citizen_from_row(citizen_row)
+
+                cursor.execute(self.SELECT_CITIZEN_RELATIVES, {'import_id': import_id, 'id': citizen_data.pop('id')})
                 citizen_data['relatives'] = [relative[0] for relative in cursor.fetchall()]
 
         return citizen_data
 
-    def change_relatives(self, import_id: int, citizen_id: int, new_relatives: list):
-        # check if citizen is exists
-        if not self.citizen_exists(import_id, citizen_id):
-            raise DBHelperIDError
-
-        # check if relatives are exist
-        for relative_id in new_relatives:
-            if not self.citizen_exists(import_id, relative_id):
-                raise DBHelperRelativesError
-
-        with psycopg2.connect(**self.DB_REQUISITES) as conn:
+    @metrics.timed
+    def get_citizen_json(self, import_id: int, citizen_id: int) -> str:
+        with self._read_connection(import_id, self.get_import_revision(import_id)) as conn:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT id FROM citizens WHERE import_id = %s AND citizen_id = %s;",
-                               (import_id, citizen_id))
-                citizen_db_id = cursor.fetchone()
-
-                cursor.execute("SELECT c.id FROM citizens c, relatives r "
-                               "WHERE r.id1 = %(id)s AND r.id2 = c.id OR r.id1 = c.id AND r.id2 = %(id)s;",
-                               {'id': citizen_db_id})
-                try:
-                    old_relatives_db_id = [relative[0] for relative in cursor.fetchall()]
-                except psycopg2.ProgrammingError:
-                    old_relatives_db_id = []
-
-                if new_relatives:
-                    cursor.execute("SELECT id FROM citizens WHERE import_id = %s AND citizen_id IN %s;",
-                                   (import_id, tuple(new_relatives)))
-                    new_relatives_db_id = [relative_db_id[0] for relative_db_id in cursor.fetchall()]
-                else:
-                    new_relatives_db_id = []
-
-                # delete old relatives
-                delete_relatives_db_ids = [{'citizen_db_id': citizen_db_id,
-                                            'relative_db_id': relative_db_id}
-                                           for relative_db_id in set(old_relatives_db_id) - (
-                                                   set(new_relatives_db_id) & set(old_relatives_db_id))]
-                if delete_relatives_db_ids:
-                    extras.execute_batch(cursor,
-                                         "DELETE FROM relatives WHERE "
-                                         "id1 = %(citizen_db_id)s AND id2 = %(relative_db_id)s OR "
-                                         "id1 = %(relative_db_id)s AND id2 = %(citizen_db_id)s;",
-                                         delete_relatives_db_ids)
-
-                # insert new relatives
-                insert_relatives_db_ids = [{'citizen_db_id': citizen_db_id,
-                                            'relative_db_id': relative_db_id}
-                                           for relative_db_id in set(new_relatives_db_id) - (
-                                                   set(new_relatives_db_id) & set(old_relatives_db_id))]
-                if insert_relatives_db_ids:
-                    extras.execute_values(cursor,
-                                          "INSERT INTO relatives VALUES %s;",
-                                          insert_relatives_db_ids,
-                                          "(%(citizen_db_id)s, %(relative_db_id)s)")
-
-            # commit changes
-            conn.commit()
-
-    def change_citizen(self, import_id: int, citizen_id: int, patch_citizen_data: dict) -> dict:
-        # check if citizen exists
-        if not self.citizen_exists(import_id, citizen_id):
-            raise DBHelperIDError
-
-        # check patch_citizen_data
-        try:
-            validate(self.CHANGE_CITIZEN_SCHEMA, patch_citizen_data)
-        except JsonSchemaException:
-            raise DBHelperJsonSchemaError
+                cursor.execute(self.SELECT_CITIZEN_JSON, {"import_id": import_id, "citizen_id": citizen_id})
+                return self.json_from_row(cursor.fetchone())
 
-        # check if patch_citizen_data have field "citizen_id" or not
-        if 'citizen_id' in patch_citizen_data.keys():
-            raise DBHelperJsonSchemaError
+    @metrics.timed
+    def change_relatives(self, import_id: int, citizen_id: int, new_relatives: list):
+        self.change_citizen(import_id, citizen_id, {'relatives': new_relatives})
 
-        # get and change relatives, if patch_citizen_data contains relatives
+    @metrics.timed
+    def change_citizen(self, import_id: int, citizen_id: int, patch_citizen_data: dict, as_json: bool = False):
+        # as_json - return the response body built by PostgreSQL instead of the dict.
+        # The whole PATCH is one statement of change_citizen_statement in one transaction
         try:
-            new_relatives = patch_citizen_data.pop('relatives')
-        except KeyError:
-            pass
-        else:
-            self.change_relatives(import_id, citizen_id, new_relatives)
+            patch_citizen_data, new_relatives = self.parse_citizen_patch(patch_citizen_data)
+            new_relatives = self.integer_relatives(new_relatives)
+        except DBHelperError:
+            # an unknown citizen is reported before a wrong patch
+            if not self.citizen_exists(import_id, citizen_id):
+                raise DBHelperIDError
+            raise
+
+        query, params = self.change_citizen_statement(import_id, citizen_id, patch_citizen_data, new_relatives,
+                                                      as_json)
+        statements.add('change_citizen', query)
+        with self._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(query, params)
+                row = cursor.fetchone()
+                if row is None:
+                    # nothing is changed, the citizen or one of his new relatives doesn't exist
+                    cursor.execute(self.SELECT_CITIZEN_DB_ID, (import_id, citizen_id))
+                    raise DBHelperIDError if cursor.fetchone() is None else DBHelperRelativesError
+                citizen_data = self.changed_citizen_from_row(row, as_json)
+                # the revision made by this PATCH, the snapshot is changed after the commit
+                revision_row = None
+                if self._snapshots is not None and self._snapshots.get(import_id) is not MISSING:
+                    cursor.execute(self.SELECT_IMPORT_REVISION, (import_id,))
+                    revision_row = cursor.fetchone()
+
+        if revision_row is not None:
+            changed_citizen = json.loads(citizen_data)['data'] if as_json else dict(citizen_data)
+            if new_relatives is None:
+                changed_citizen.pop('relatives')
+            self._update_snapshot(import_id, revision_row, changed_citizen)
+        return citizen_data
 
-        # check birth_date and change to postgresql format, if patch_citizen_data contains birth_date
+    @metrics.timed
+    def delete_import(self, import_id: int):
+        with self._pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.DELETE_IMPORT, (import_id,))
+                if cursor.fetchone() is None:
+                    raise DBHelperIDError
         try:
-            patch_citizen_data['birth_date'] = self.json_date_to_postrgesql_date(patch_citizen_data['birth_date'])
-        except KeyError:
-            pass
-        # same as validate_birth_date
-        except ValueError:
-            raise DBHelperJsonSchemaError
-
-        # if patch_citizen_data is not empty, change citizen data in database
-        if patch_citizen_data:
-            with psycopg2.connect(**self.DB_REQUISITES) as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute("SELECT id FROM citizens WHERE import_id = %s AND citizen_id = %s;",
-                                   (import_id, citizen_id))
-                    citizen_db_id = cursor.fetchone()[0]
-
-                    update_text = "UPDATE citizens SET " + \
-                                  ",".join(map(lambda key: "{0}=%({0})s".format(key), patch_citizen_data.keys())) + \
-                                  "WHERE id = %(id)s;"
-                    cursor.execute(update_text, {**patch_citizen_data, **{"id": citizen_db_id}})
-                conn.commit()
-
-        return self.get_citizen(import_id, citizen_id)
-
-    def get_presents_num_per_month(self, import_id: int) -> dict:
-        if not self.import_exists(import_id):
-            raise DBHelperIDError
-
-        with psycopg2.connect(**self.DB_REQUISITES) as conn:
+            self._drop_import_partitions([import_id])
+        except psycopg2.Error as e:
+            # the import is deleted anyway, its partitions are left to delete_expired_imports
+            print(e)
+
+    @metrics.timed
+    def delete_expired_imports(self, max_age_days: int) -> list:
+        # delete imports older than max_age_days and partitions left by interrupted deletes, return deleted import ids
+        with self._pool.connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT id, citizen_id, birth_date FROM citizens WHERE import_id = %s;", (import_id,))
-                citizens = {
-                    citizen_data[0]: {'citizen_id': citizen_data[1], 'birth_date': citizen_data[2], 'relatives': []}
-                    for citizen_data in cursor.fetchall()}
-
-                cursor.execute(
-                    "SELECT c.id, r.id1 FROM citizens c, relatives r "
-                    "WHERE c.id = r.id2 AND c.import_id = %(import_id)s "
-                    "UNION "
-                    "SELECT c.id, r.id2 FROM citizens c, relatives r "
-                    "WHERE c.id = r.id1 AND c.import_id = %(import_id)s AND r.id1 != r.id2;",
-                    {"import_id": import_id})
-                for pair in cursor.fetchall():
-                    citizens[pair[0]]['relatives'].append(pair[1])
-
-                presents_num_per_month = {month: defaultdict(lambda: 0) for month in range(1, 13)}
-                for citizen_db_id, citizen in citizens.items():
-                    for relative_db_id in citizen['relatives']:
-                        relative_birth_date = citizens[relative_db_id]['birth_date']
-                        presents_num_per_month[relative_birth_date.month][citizens[citizen_db_id]['citizen_id']] += 1
-
-        presents_num_per_month_result = dict()
-        for month in presents_num_per_month.keys():
-            presents_num_per_month_result[str(month)] = [{'citizen_id': citizen_id,
-                                                          'presents': presents_num_per_month[month][citizen_id]}
-                                                         for citizen_id in presents_num_per_month[month].keys()]
-        return presents_num_per_month_result
-
-    @staticmethod
-    def calculate_age(born: datetime.date) -> int:
-        today = datetime.date.today()
-        if (today.month, today.day) < (born.month, born.day):
-            return today.year - born.year - 1
-        else:
-            return today.year - born.year
-
-    def get_town_stat(self, import_id: int) -> list:
-        if not self.import_exists(import_id):
-            raise DBHelperIDError
-
-        with psycopg2.connect(**self.DB_REQUISITES) as conn:
+                cursor.execute(self.DELETE_EXPIRED_IMPORTS, (max_age_days,))
+                import_ids = sorted(row[0] for row in cursor.fetchall())
+                cursor.execute(self.SELECT_ORPHAN_PARTITIONS)
+                orphan_import_ids = [row[0] for row in cursor.fetchall()]
+                # finished import jobs are kept as long as imports
+                cursor.execute(self.DELETE_EXPIRED_IMPORT_JOBS, (max_age_days,))
+        self._drop_import_partitions(sorted(set(import_ids + orphan_import_ids)))
+        return import_ids
+
+    def _drop_import_partitions(self, import_ids: list):
+        with self._pool.autocommit_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.LOCK_PARTITIONS_DETACH)
+                try:
+                    for import_id in import_ids:
+                        cursor.execute(self.SELECT_IMPORT_PARTITIONS, {'import_id': import_id})
+                        for statement in self.drop_partitions_statements(cursor.fetchall()):
+                            cursor.execute(statement)
+                finally:
+                    cursor.execute(self.UNLOCK_PARTITIONS_DETACH)
+
+    @metrics.timed
+    def get_presents_num_per_month(self, import_id: int, revision: str = None) -> dict:
+        if revision is None:
+            revision = self.get_import_revision(import_id)
+        return self._cached('presents_num_per_month', import_id, revision,
+                            lambda: self._get_presents_num_per_month(import_id, revision),
+                            lambda result: sum(map(len, result.values())))
+
+    @metrics.timed
+    def _get_presents_num_per_month(self, import_id: int, revision: str) -> dict:
+        if self._snapshots is not None:
+            return self.presents_from_snapshot(self._snapshot(import_id, revision))
+        with self._read_connection(import_id, revision) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(self.SELECT_PRESENTS_NUM, {"import_id": import_id})
+                return self.presents_from_rows(cursor.fetchall())
+
+    @metrics.timed
+    def get_town_stat(self, import_id: int, revision: str = None) -> list:
+        if revision is None:
+            revision = self.get_import_revision(import_id)
+        # ages depend on the current date too
+        return self._cached('town_stat', import_id, (revision, datetime.date.today()),
+                            lambda: self._get_town_stat(import_id, revision), len)
+
+    @metrics.timed
+    def _get_town_stat(self, import_id: int, revision: str) -> list:
+        if self._snapshots is not None:
+            return self.town_stat_from_snapshot(self._snapshot(import_id, revision))
+        with self._read_connection(import_id, revision) as conn:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT DISTINCT town FROM citizens WHERE import_id = %s;", (import_id,))
-                towns = [town[0] for town in cursor.fetchall()]
-                percentiles = (50, 75, 99)
-                town_stat = []
-                for town in towns:
-                    cursor.execute("SELECT birth_date FROM citizens WHERE import_id = %s AND town = %s;",
-                                   (import_id, town))
-                    ages = [self.calculate_age(birth_date[0]) for birth_date in cursor.fetchall()]
-                    age_percentiles = ceil(percentile(ages, percentiles)).astype(int).tolist()
-                    keys = ["town"] + list(map(lambda x: "p" + str(x), percentiles))
-                    values = [town] + age_percentiles
-                    town_stat.append(dict(zip(keys, values)))
-
-        return town_stat
+                cursor.execute(self.SELECT_TOWNS_BIRTH_DATES, (import_id,))
+                return self.town_stat_from_rows(cursor.fetchall())
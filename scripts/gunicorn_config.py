@@ -1,3 +1,4 @@
+import time
 import multiprocessing
 
 bind = "0.0.0.0:8080"
@@ -5,3 +6,49 @@ workers = multiprocessing.cpu_count() * 2 + 1
 worker_class = 'gthread'
 timeout = 120
 max_requests = 1000
+
+
+def on_starting(arbiter):
+    # the schema is migrated once here, workers only check its version
+    import config
+    from migrations import migrate
+    from metrics import clear_snapshots
+    for version, name in migrate(**config.get_db_requisites()):
+        arbiter.log.info("Applied migration %s %s", version, name)
+    # metrics of the previous run of the server aren't added to the new ones
+    clear_snapshots(config.get_metrics_settings()['dir'])
+
+
+def post_fork(arbiter, worker):
+    worker.boot_started = time.monotonic()
+
+
+def post_worker_init(worker):
+    # time from fork till the application is loaded, every max_requests requests it's paid again
+    from metrics import metrics
+    boot_seconds = time.monotonic() - worker.boot_started
+    metrics.observe('ybs_worker_boot_duration_seconds', boot_seconds)
+    worker.log.info("Worker %s booted in %.3f s", worker.pid, boot_seconds)
+
+
+def worker_exit(arbiter, worker):
+    # write the access log records and metrics, which are still in memory
+    from server import access_log
+    from metrics import metrics
+    access_log.close()
+    metrics.flush()
+
+
+# processes of import jobs, see import_jobs.py
+import_jobs_pool = None
+
+
+def when_ready(arbiter):
+    global import_jobs_pool
+    from import_jobs import start_pool
+    import_jobs_pool = start_pool()
+
+
+def on_exit(arbiter):
+    from import_jobs import stop_pool
+    stop_pool(import_jobs_pool)
@@ -0,0 +1,88 @@
+import sys
+import time
+import signal
+import select
+import psycopg2
+import multiprocessing
+import config
+from database import DBHelper
+from metrics import metrics
+
+# processes, which import bodies of POST /imports staged in import_jobs when [import_jobs] enabled = yes.
+# The gunicorn master starts a supervising process (see gunicorn_config.py), it keeps `workers` processes alive.
+# Jobs are taken from the table, so processes of several servers may share the queue
+
+
+def run_worker(index: int):
+    import_settings = config.get_import_settings()
+    import_jobs_settings = config.get_import_jobs_settings()
+    metrics_settings = config.get_metrics_settings()
+    metrics.configure(metrics_settings['dir'], metrics_settings['flush_interval'])
+
+    db_helper = DBHelper(pool_settings={'min_size': 1, 'max_size': 1},
+                         import_method=import_settings['method'],
+                         import_batch_size=import_settings['batch_size'],
+                         cache_settings={'enabled': False},
+                         prepared_settings=config.get_prepared_settings(),
+                         **config.get_db_requisites())
+
+    listen_conn = None
+    while True:
+        try:
+            if listen_conn is None or listen_conn.closed:
+                listen_conn = psycopg2.connect(**config.get_db_requisites())
+                listen_conn.autocommit = True
+                with listen_conn.cursor() as cursor:
+                    cursor.execute("LISTEN import_jobs;")
+
+            while db_helper.run_import_job(import_settings['streaming'],
+                                           import_jobs_settings['max_attempts']) is not None:
+                pass
+            # the gauge is summed over processes, so only one of them reports it
+            if index == 0:
+                metrics.set('ybs_import_jobs_queued', db_helper.count_queued_import_jobs())
+
+            # NOTIFY of a new job wakes the process up, the queue is checked every poll_interval seconds anyway
+            if select.select([listen_conn], [], [], import_jobs_settings['poll_interval'])[0]:
+                listen_conn.poll()
+                listen_conn.notifies.clear()
+        except psycopg2.Error as e:
+            print(e)
+            time.sleep(import_jobs_settings['poll_interval'])
+
+
+def supervise(workers: int):
+    # processes are started by spawn, so they don't inherit threads and connections of the parent
+    context = multiprocessing.get_context('spawn')
+    processes = [None] * workers
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            for index, process in enumerate(processes):
+                if process is None or not process.is_alive():
+                    processes[index] = context.Process(target=run_worker, args=(index,),
+                                                       name='import-jobs-{}'.format(index), daemon=True)
+                    processes[index].start()
+            time.sleep(1.0)
+    finally:
+        for process in processes:
+            if process is not None:
+                process.terminate()
+                process.join()
+
+
+def start_pool():
+    # the supervising process or None if import jobs are disabled
+    import_jobs_settings = config.get_import_jobs_settings()
+    if not import_jobs_settings['enabled']:
+        return None
+    process = multiprocessing.get_context('spawn').Process(target=supervise, args=(import_jobs_settings['workers'],),
+                                                           name='import-jobs')
+    process.start()
+    return process
+
+
+def stop_pool(process):
+    if process is not None:
+        process.terminate()
+        process.join()
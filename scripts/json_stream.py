@@ -0,0 +1,102 @@
+import json
+import codecs
+
+# a value, which isn't decoded from this many buffered characters, is malformed or too big for a citizen,
+# e.g. a citizen with 100000 relatives takes about 1 MB
+MAX_VALUE_SIZE = 1024 * 1024
+
+
+class JsonStreamError(ValueError):
+    def __str__(self):
+        return "Malformed import document"
+
+
+class CitizensStreamParser:
+    # incremental parser of the import document {"citizens": [{...}, {...}, ...]}:
+    # only the current citizen object and one chunk of the body are kept in memory
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, stream, chunk_size: int = 64 * 1024, max_value_size: int = MAX_VALUE_SIZE):
+        self._stream = stream
+        self._chunk_size = chunk_size
+        self._max_value_size = max_value_size
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+
+    def _read(self) -> bool:
+        if self._eof:
+            return False
+        chunk = self._stream.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            self._buffer = self._buffer[self._position:] + self._decoder.decode(b'', final=True)
+        else:
+            self._buffer = self._buffer[self._position:] + self._decoder.decode(chunk)
+        self._position = 0
+        return True
+
+    def _peek(self) -> str:
+        # skip whitespace and return the next significant character or '' at the end of the stream
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in self.WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._read():
+                return ''
+
+    def _expect(self, char: str):
+        if self._peek() != char:
+            raise JsonStreamError
+        self._position += 1
+
+    def _decode(self):
+        # decode one complete value starting at the current position, reading more data while it's truncated
+        required_length = 0
+        while True:
+            if self._eof or len(self._buffer) - self._position >= required_length:
+                try:
+                    value, end = self._json_decoder.raw_decode(self._buffer, self._position)
+                except json.JSONDecodeError:
+                    available = len(self._buffer) - self._position
+                    if self._eof or available > self._max_value_size:
+                        raise JsonStreamError
+                    # retry only after the buffered data has doubled, so big values aren't decoded quadratically,
+                    # but not later than at max_value_size, so a malformed value doesn't read the rest of the body
+                    required_length = min(2 * available, self._max_value_size + 1)
+                else:
+                    self._position = end
+                    return value
+            self._read()
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() != '"' or self._decode() != 'citizens':
+            raise JsonStreamError
+        self._expect(':')
+        self._expect('[')
+
+        if self._peek() == ']':
+            self._position += 1
+        else:
+            while True:
+                if self._peek() != '{':
+                    raise JsonStreamError
+                yield self._decode()
+                char = self._peek()
+                self._position += 1
+                if char == ']':
+                    break
+                if char != ',':
+                    raise JsonStreamError
+
+        self._expect('}')
+        if self._peek() != '':
+            raise JsonStreamError
+
+
+def iter_import_citizens(stream, chunk_size: int = 64 * 1024, max_value_size: int = MAX_VALUE_SIZE):
+    return iter(CitizensStreamParser(stream, chunk_size, max_value_size))
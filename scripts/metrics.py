@@ -0,0 +1,386 @@
+import os
+import re
+import glob
+import json
+import time
+import fcntl
+import atexit
+import asyncio
+import threading
+import contextvars
+from bisect import bisect_left
+from functools import wraps
+from contextlib import contextmanager
+from psycopg2 import extensions
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+JOB_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+# tables of one import, e.g. citizens_15, are named like citizens_{import_id} in statement templates
+PARTITION_RE = re.compile(r'\b(citizens|relatives)_\d+\b')
+
+# name -> (type, help, buckets of histograms)
+METRICS = {
+    'ybs_http_request_duration_seconds': ('histogram', "Time from the start of the request till the response",
+                                          LATENCY_BUCKETS),
+    'ybs_http_response_size_bytes': ('histogram', "Size of response bodies, streamed responses aren't counted",
+                                     SIZE_BUCKETS),
+    'ybs_json_dumps_duration_seconds': ('histogram', "Time of serialization of response bodies", LATENCY_BUCKETS),
+    'ybs_db_helper_duration_seconds': ('histogram', "Time of DBHelper methods", LATENCY_BUCKETS),
+    'ybs_db_queries_per_request': ('histogram', "Number of SQL statements executed by one request",
+                                   QUERIES_BUCKETS),
+    'ybs_db_time_per_request_seconds': ('histogram', "Total time of SQL statements of one request",
+                                        LATENCY_BUCKETS),
+    'ybs_db_statement_calls_total': ('counter', "Number of executions of SQL statements", None),
+    'ybs_db_statement_seconds_total': ('counter', "Total time of executions of SQL statements", None),
+    'ybs_worker_boot_duration_seconds': ('histogram', "Time from the fork of a gunicorn worker till its application "
+                                                      "is loaded", LATENCY_BUCKETS),
+    'ybs_pool_checkout_duration_seconds': ('histogram', "Time of waiting for a database connection",
+                                           LATENCY_BUCKETS),
+    'ybs_pool_connections': ('gauge', "Open database connections", None),
+    'ybs_pool_timeouts_total': ('counter', "Checkouts timed out waiting for a connection", None),
+    'ybs_cache_hits_total': ('counter', "Read results taken from the cache", None),
+    'ybs_cache_misses_total': ('counter', "Read results computed and put to the cache", None),
+    'ybs_cache_evictions_total': ('counter', "Read results evicted from the cache", None),
+    'ybs_cache_entries': ('gauge', "Read results in the cache", None),
+    'ybs_snapshot_entries': ('gauge', "Imports with a snapshot for the analytic endpoints", None),
+    'ybs_snapshot_bytes': ('gauge', "Size of the arrays of snapshots of imports", None),
+    'ybs_snapshot_evictions_total': ('counter', "Snapshots of imports evicted on the memory budget", None),
+    'ybs_snapshot_updates_total': ('counter', "Snapshots of imports changed by PATCH instead of rebuilding", None),
+    'ybs_snapshot_build_duration_seconds': ('histogram', "Time of building snapshots from the rows of an import",
+                                            LATENCY_BUCKETS),
+    'ybs_access_log_dropped_total': ('counter', "Access log records dropped on a full queue", None),
+    'ybs_db_reads_total': ('counter', "Reads of imports by the database, which served them", None),
+    'ybs_replica_skips_total': ('counter', "Replicas skipped by reads, because they lag behind or fail", None),
+    'ybs_import_jobs_enqueued_total': ('counter', "Import jobs accepted by POST /imports", None),
+    'ybs_import_jobs_finished_total': ('counter', "Import jobs done or failed", None),
+    'ybs_import_jobs_queued': ('gauge', "Import jobs waiting for a process, running jobs included", None),
+    'ybs_import_job_wait_seconds': ('histogram', "Time of import jobs in the queue", JOB_BUCKETS),
+    'ybs_import_job_duration_seconds': ('histogram', "Time of validation and import of import jobs", JOB_BUCKETS),
+    'ybs_admission_in_flight': ('gauge', "Requests of limited routes holding a slot", None),
+    'ybs_admission_queue_depth': ('gauge', "Requests of limited routes waiting for a slot", None),
+    'ybs_admission_wait_seconds': ('histogram', "Time of admitted requests in the queue", LATENCY_BUCKETS),
+    'ybs_admission_rejections_total': ('counter', "Requests rejected by admission control before they are handled",
+                                       None),
+}
+
+# (queries, seconds) of SQL statements of the current request
+_request_queries = contextvars.ContextVar('request_queries', default=None)
+
+
+def process_token(pid: int) -> str:
+    # boot id and start time of the process, so a pid reused by another process or after a reboot gets
+    # another token. Without /proc it's empty and processes are told apart by pids only
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as boot_id_file:
+            boot_id = boot_id_file.read().strip()
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            stat = stat_file.read()
+    except OSError:
+        return ''
+    # starttime is the 22nd field, the name of the process in parentheses may contain spaces
+    return '{}-{}'.format(boot_id, stat[stat.rindex(')') + 2:].split()[19])
+
+
+def clear_snapshots(metrics_dir: str):
+    # called by the gunicorn master before workers start, so snapshots of the previous run of the server
+    # aren't taken for live processes and counters start from zero like in any restarted process
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')) + glob.glob(os.path.join(metrics_dir, '*.tmp')):
+        os.remove(path)
+
+
+class Metrics:
+    # counters, gauges and histograms of one process. Every process writes its snapshot to
+    # <metrics_dir>/<pid>.<start time>.json every flush_interval seconds and at exit, render() merges
+    # the snapshots of all processes, so /metrics of any gunicorn worker shows the totals of all of them.
+    # Snapshots of finished processes are folded into archive.json, their gauges are dropped
+    def __init__(self):
+        self.metrics_dir = None
+        self.flush_interval = 5.0
+        self._lock = threading.Lock()
+        self._collectors = []
+        self._statements = dict()
+        self._pid = None
+        self._reset()
+        atexit.register(self.flush)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._snapshot_path = None
+        self._thread = None
+        # (name, labels) -> value for counters and gauges, [bucket counts..., +Inf count, sum] for histograms
+        self._values = dict()
+
+    def _check_pid(self):
+        # values recorded before fork belong to the parent
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def configure(self, metrics_dir: str, flush_interval: float = 5.0):
+        os.makedirs(metrics_dir, exist_ok=True)
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+
+    def add_collector(self, collector):
+        # collector() returns (name, labels, value) of counters and gauges, which are kept by other objects
+        self._collectors.append(collector)
+
+    def register_statements(self, statements: dict):
+        # SQL text -> name for ybs_db_statement_* labels
+        self._statements.update({query: name for name, query in statements.items()})
+
+    def statement_name(self, query) -> str:
+        if isinstance(query, bytes):
+            query = query.decode()
+        name = self._statements.get(query)
+        if name is None:
+            # dynamic statements are named by the first words
+            query = PARTITION_RE.sub(r'\1_{import_id}', query)
+            name = self._statements.get(query) or ' '.join(query.split()[:3])
+        return name
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._check_pid()
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+        self._start()
+
+    def set(self, name: str, value: float, **labels):
+        self._check_pid()
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+        self._start()
+
+    def observe(self, name: str, value: float, **labels):
+        self._check_pid()
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = [0] * (len(buckets) + 2)
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-1] += value
+        self._start()
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, func):
+        # decorator for methods of DBHelper and AsyncDBHelper
+        method = func.__qualname__
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with self.timer('ybs_db_helper_duration_seconds', method=method):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.timer('ybs_db_helper_duration_seconds', method=method):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def record_query(self, query, seconds: float):
+        statement = self.statement_name(query)
+        self.inc('ybs_db_statement_calls_total', statement=statement)
+        self.inc('ybs_db_statement_seconds_total', seconds, statement=statement)
+        request_queries = _request_queries.get()
+        if request_queries is not None:
+            request_queries[0] += 1
+            request_queries[1] += seconds
+
+    def start_request(self):
+        _request_queries.set([0, 0.0])
+
+    def finish_request(self, method: str, route: str, status: int, seconds: float, size: int = None):
+        # route - the rule, e.g. /imports/<int:import_id>/citizens, so the number of labels is bounded
+        self.observe('ybs_http_request_duration_seconds', seconds, method=method, route=route, status=str(status))
+        if size is not None:
+            self.observe('ybs_http_response_size_bytes', size, route=route)
+        request_queries = _request_queries.get()
+        if request_queries is not None:
+            self.observe('ybs_db_queries_per_request', request_queries[0], route=route)
+            self.observe('ybs_db_time_per_request_seconds', request_queries[1], route=route)
+            _request_queries.set(None)
+
+    def _collect(self):
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                self.set(name, value, **labels)
+
+    def snapshot(self) -> list:
+        self._check_pid()
+        self._collect()
+        with self._lock:
+            return [[name, list(labels), value] for (name, labels), value in self._values.items()]
+
+    def _start(self):
+        # the thread writing snapshots is started by the first value recorded in the process
+        if self._thread is not None or self.metrics_dir is None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            # <pid>.<process token>.json
+            self._snapshot_path = os.path.join(self.metrics_dir, '{}.{}.json'.format(self._pid,
+                                                                                 process_token(self._pid)))
+            self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        if self._snapshot_path is None or self._pid != os.getpid():
+            return
+        temporary_path = self._snapshot_path + '.tmp'
+        with open(temporary_path, 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file)
+        os.replace(temporary_path, self._snapshot_path)
+
+    @staticmethod
+    def _merge(values: dict, snapshot: list, gauges: bool = True):
+        for name, labels, value in snapshot:
+            if name not in METRICS or (not gauges and METRICS[name][0] == 'gauge'):
+                continue
+            key = (name, tuple(map(tuple, labels)))
+            if isinstance(value, list):
+                total = values.setdefault(key, [0] * len(value))
+                for index, item in enumerate(value):
+                    total[index] += item
+            else:
+                values[key] = values.get(key, 0) + value
+
+    @staticmethod
+    def _is_alive(pid: int, token: str) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return process_token(pid) == token
+
+    def _read_snapshots(self) -> dict:
+        # merge snapshots of all processes, the current process is taken as is
+        values = dict()
+        self._merge(values, self.snapshot())
+        if self.metrics_dir is None:
+            return values
+
+        with open(os.path.join(self.metrics_dir, 'archive.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            archive_path = os.path.join(self.metrics_dir, 'archive.json')
+            try:
+                with open(archive_path) as archive_file:
+                    archive = json.load(archive_file)
+            except FileNotFoundError:
+                archive = []
+
+            archive_values = dict()
+            self._merge(archive_values, archive)
+            folded = False
+            for path in glob.glob(os.path.join(self.metrics_dir, '*.*.json')):
+                if path == self._snapshot_path:
+                    continue
+                pid, token = os.path.basename(path)[:-len('.json')].split('.', 1)
+                try:
+                    with open(path) as snapshot_file:
+                        snapshot = json.load(snapshot_file)
+                except (OSError, ValueError):
+                    continue
+                if self._is_alive(int(pid), token):
+                    self._merge(values, snapshot)
+                else:
+                    self._merge(archive_values, snapshot, gauges=False)
+                    os.remove(path)
+                    folded = True
+
+            if folded:
+                with open(archive_path + '.tmp', 'w') as archive_file:
+                    json.dump([[name, list(labels), value] for (name, labels), value in archive_values.items()],
+                              archive_file)
+                os.replace(archive_path + '.tmp', archive_path)
+
+        self._merge(values, [[name, list(labels), value] for (name, labels), value in archive_values.items()])
+        return values
+
+    @staticmethod
+    def _format_labels(labels, extra: tuple = ()) -> str:
+        labels = tuple(labels) + extra
+        if not labels:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                              for key, value in labels) + '}'
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        values = self._read_snapshots()
+        lines = []
+        for name, (metric_type, help_text, buckets) in METRICS.items():
+            series = sorted((labels, value) for (series_name, labels), value in values.items() if series_name == name)
+            if not series:
+                continue
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in series:
+                if metric_type != 'histogram':
+                    lines.append('{}{} {}'.format(name, self._format_labels(labels), value))
+                    continue
+                cumulative = 0
+                for bucket, count in zip(buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, self._format_labels(labels, (('le', bucket),)),
+                                                         cumulative))
+                lines.append('{}_sum{} {}'.format(name, self._format_labels(labels), value[-1]))
+                lines.append('{}_count{} {}'.format(name, self._format_labels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class InstrumentedCursor(extensions.cursor):
+    # cursor_factory of psycopg2 connections, which records time of every statement
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_query(query, time.perf_counter() - started)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            metrics.record_query(sql, time.perf_counter() - started)
+
+
+class InstrumentedAsyncCursor:
+    # wrapper of aiopg cursors, which records time of every statement like InstrumentedCursor
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    async def execute(self, operation, parameters=None):
+        started = time.perf_counter()
+        try:
+            return await self._cursor.execute(operation, parameters)
+        finally:
+            metrics.record_query(operation, time.perf_counter() - started)
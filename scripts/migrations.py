@@ -0,0 +1,87 @@
+import re
+import psycopg2
+from pathlib import Path
+
+# versioned schema migrations: sql_files/migrations/<version>_<name>.sql are applied in the order of versions,
+# every file in its own transaction, and recorded in schema_version. They are applied once by the gunicorn master
+# (on_starting in gunicorn_config.py) or by python3 config.py m, workers only check the version
+MIGRATIONS_DIR = str(Path(__file__).parent.parent.absolute()) + '/sql_files/migrations/'
+MIGRATION_FILE_RE = re.compile(r'(\d+)_(\w+)\.sql\Z')
+
+# concurrent runs, e.g. of several servers, wait for each other
+LOCK_MIGRATIONS = "SELECT pg_advisory_xact_lock(hashtext('migrations'));"
+CREATE_SCHEMA_VERSION = ("CREATE TABLE IF NOT EXISTS schema_version ("
+                         "version INT PRIMARY KEY, "
+                         "name VARCHAR NOT NULL, "
+                         "applied_time TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP);")
+INSERT_SCHEMA_VERSION = "INSERT INTO schema_version (version, name) VALUES (%s, %s);"
+# a database without schema_version has version 0
+SELECT_SCHEMA_VERSION_EXISTS = "SELECT to_regclass('schema_version') IS NOT NULL;"
+SELECT_SCHEMA_VERSION = "SELECT COALESCE(max(version), 0) FROM schema_version;"
+
+
+class SchemaVersionError(Exception):
+    def __init__(self, version: int, latest_version: int):
+        super().__init__()
+        self.version = version
+        self.latest_version = latest_version
+
+    def __str__(self):
+        return "Database schema version {} is older than {}, apply migrations: python3 config.py m".format(
+            self.version, self.latest_version)
+
+
+def migration_files() -> list:
+    # (version, name, path) in the order of versions
+    migrations = []
+    for path in sorted(Path(MIGRATIONS_DIR).glob('*.sql')):
+        match = MIGRATION_FILE_RE.match(path.name)
+        if match is None:
+            raise ValueError("Wrong name of migration: {}".format(path.name))
+        migrations.append((int(match.group(1)), match.group(2), str(path)))
+    migrations.sort()
+    versions = [version for version, _, _ in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError("Duplicate versions of migrations: {}".format(versions))
+    return migrations
+
+
+def latest_version() -> int:
+    migrations = migration_files()
+    return migrations[-1][0] if migrations else 0
+
+
+def schema_version(cursor) -> int:
+    cursor.execute(SELECT_SCHEMA_VERSION_EXISTS)
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute(SELECT_SCHEMA_VERSION)
+    return cursor.fetchone()[0]
+
+
+def check_schema_version(cursor):
+    # raise SchemaVersionError, if migrations aren't applied. A newer schema is fine: it's being rolled out
+    version, latest = schema_version(cursor), latest_version()
+    if version < latest:
+        raise SchemaVersionError(version, latest)
+
+
+def migrate(**db_requisites) -> list:
+    # apply migrations newer than the schema version, return (version, name) of the applied ones
+    applied = []
+    conn = psycopg2.connect(**db_requisites)
+    try:
+        for version, name, path in migration_files():
+            with conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(LOCK_MIGRATIONS)
+                    cursor.execute(CREATE_SCHEMA_VERSION)
+                    if schema_version(cursor) >= version:
+                        continue
+                    with open(path, 'r') as migration_file:
+                        cursor.execute(migration_file.read())
+                    cursor.execute(INSERT_SCHEMA_VERSION, (version, name))
+                    applied.append((version, name))
+    finally:
+        conn.close()
+    return applied
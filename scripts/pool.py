@@ -0,0 +1,279 @@
+import os
+import time
+import threading
+import psycopg2
+from psycopg2 import extensions
+from contextlib import contextmanager
+
+
+class PoolError(Exception):
+    def __str__(self):
+        return "Connection pool error"
+
+
+class PoolTimeoutError(PoolError):
+    def __str__(self):
+        return "Timed out waiting for a free database connection"
+
+
+class ConnectionPool:
+    def __init__(self, min_size: int = 1, max_size: int = 10, idle_timeout: float = 300.0,
+                 checkout_timeout: float = 30.0, health_check_interval: float = 30.0, on_checkout=None,
+                 **db_requisites):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Wrong pool size: min_size={}, max_size={}".format(min_size, max_size))
+
+        self.DB_REQUISITES = db_requisites
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        # on_checkout(seconds) is called with the time getconn took, e.g. to collect metrics
+        self.on_checkout = on_checkout
+
+        self._reset()
+
+    def _reset(self):
+        # state is per process: connections inherited through fork() are owned by the parent
+        # and must be neither used nor closed here, otherwise both processes share one socket.
+        # They are kept referenced, so garbage collection doesn't close them either
+        self._inherited = [conn for conn, _ in getattr(self, '_idle', [])]
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []  # stack of (connection, last_used) pairs, the most recently used on top
+        self._size = 0
+        self._prefilled = False
+        self._stats = {'created': 0, 'closed': 0, 'checkouts': 0, 'waits': 0, 'timeouts': 0,
+                       'health_check_failures': 0}
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.DB_REQUISITES)
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _close(self, conn):
+        self._close_quietly(conn)
+        with self._cond:
+            self._size -= 1
+            self._stats['closed'] += 1
+            self._cond.notify()
+
+    def _pop_expired(self) -> list:
+        # must be called with self._cond acquired
+        expired = []
+        if self.idle_timeout > 0:
+            now = time.monotonic()
+            keep = []
+            surplus = self._size - self.min_size
+            # the oldest connections are at the bottom of the stack
+            for conn, last_used in self._idle:
+                if surplus > 0 and now - last_used > self.idle_timeout:
+                    expired.append(conn)
+                    surplus -= 1
+                else:
+                    keep.append((conn, last_used))
+            self._idle = keep
+            self._size -= len(expired)
+            self._stats['closed'] += len(expired)
+        return expired
+
+    def _is_alive(self, conn, last_used: float) -> bool:
+        if conn.closed or conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _prefill(self):
+        with self._cond:
+            if self._prefilled:
+                return
+            self._prefilled = True
+            missing = max(0, self.min_size - self._size)
+            self._size += missing
+
+        for _ in range(missing):
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                continue
+            self.putconn(conn)
+
+    def getconn(self):
+        self._check_pid()
+        self._prefill()
+
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        while True:
+            conn, last_used = None, None
+            with self._cond:
+                expired = self._pop_expired()
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                else:
+                    for expired_conn in expired:
+                        self._close_quietly(expired_conn)
+                    self._stats['waits'] += 1
+                    while not self._idle and self._size >= self.max_size:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._stats['timeouts'] += 1
+                            raise PoolTimeoutError
+                        self._cond.wait(remaining)
+                    continue
+            for expired_conn in expired:
+                self._close_quietly(expired_conn)
+
+            if conn is None:
+                # a slot was reserved above, open a new connection for it
+                try:
+                    conn = self._connect()
+                except psycopg2.Error:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_alive(conn, last_used):
+                with self._cond:
+                    self._stats['health_check_failures'] += 1
+                self._close(conn)
+                continue
+
+            with self._cond:
+                self._stats['checkouts'] += 1
+            if self.on_checkout is not None:
+                self.on_checkout(time.monotonic() - started)
+            return conn
+
+    def putconn(self, conn, discard: bool = False):
+        if self._pid != os.getpid():
+            # connection borrowed before fork, leave it to the parent
+            return
+
+        if not discard and not conn.closed:
+            status = conn.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                discard = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+
+        if discard or conn.closed:
+            self._close(conn)
+        else:
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        # borrow a connection for one transaction: commit on success, rollback on error
+        conn = self.getconn()
+        broken = False
+        try:
+            with conn:
+                yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, discard=broken)
+
+    @contextmanager
+    def autocommit_connection(self):
+        # borrow a connection for statements, which can't be run in a transaction block,
+        # e.g. DETACH PARTITION CONCURRENTLY
+        conn = self.getconn()
+        broken = False
+        try:
+            conn.autocommit = True
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not broken and not conn.closed:
+                conn.autocommit = False
+            self.putconn(conn, discard=broken)
+
+    def close(self):
+        self._check_pid()
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
+
+    def stats(self) -> dict:
+        self._check_pid()
+        with self._cond:
+            return {'pid': self._pid,
+                    'size': self._size,
+                    'idle': len(self._idle),
+                    'in_use': self._size - len(self._idle),
+                    'min_size': self.min_size,
+                    'max_size': self.max_size,
+                    **self._stats}
+
+
+class ReplicaSet:
+    # pools of read replicas, which are taken in turn. A replica, which failed, is skipped for retry_interval
+    # seconds, so reads don't wait for its connection timeout on every request
+    def __init__(self, hosts: list, retry_interval: float = 30.0, **pool_settings):
+        # hosts - (host, port) pairs, pool_settings - arguments of ConnectionPool except host and port
+        self.pools = [ConnectionPool(host=host, port=port, **pool_settings) for host, port in hosts]
+        self.names = ['{}:{}'.format(host, port) for host, port in hosts]
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._next = 0
+        self._failed_until = [0.0] * len(self.pools)
+
+    def candidates(self) -> list:
+        # (index, pool) of available replicas, every call starts with the next replica
+        if not self.pools:
+            return []
+        with self._lock:
+            start = self._next
+            self._next = (self._next + 1) % len(self.pools)
+        now = time.monotonic()
+        indexes = list(range(start, len(self.pools))) + list(range(start))
+        return [(index, self.pools[index]) for index in indexes if self._failed_until[index] <= now]
+
+    def failed(self, index: int):
+        with self._lock:
+            self._failed_until[index] = time.monotonic() + self.retry_interval
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+    def stats(self) -> list:
+        now = time.monotonic()
+        return [{'replica': name, 'available': failed_until <= now, **pool.stats()}
+                for name, pool, failed_until in zip(self.names, self.pools, self._failed_until)]
@@ -0,0 +1,118 @@
+import re
+from collections import OrderedDict
+from psycopg2 import extensions
+from metrics import metrics, InstrumentedCursor, InstrumentedAsyncCursor
+
+# server-side prepared statements: a statement of the registry is PREPAREd once per connection by its first execution
+# and EXECUTEd by name after that, so PostgreSQL doesn't parse and plan it on every call. After five executions
+# PostgreSQL may switch the statement to a generic plan, which isn't planned at all.
+# The registry is filled by database.py with the statements of small requests, where planning is a big part of
+# the time. They are switched off by [prepared_statements] enabled = no, e.g. behind a pooler in transaction mode
+PLACEHOLDER_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+class PreparedStatement:
+    def __init__(self, name: str, query: str):
+        self.name = name
+        # psycopg2 placeholders become $1, $2, ... in the order of their first use, a named parameter used
+        # several times is the same $n. parameters - keys of vars for them: indexes or names
+        self.parameters = []
+
+        def replace(match) -> str:
+            if match.group(0) == '%%':
+                return '%'
+            key = match.group(1) if match.group(1) is not None else len(self.parameters)
+            if key not in self.parameters:
+                self.parameters.append(key)
+            return '${}'.format(self.parameters.index(key) + 1)
+
+        self.prepare_query = "PREPARE {} AS {};".format(name, PLACEHOLDER_RE.sub(replace, query).rstrip().rstrip(';'))
+        self.execute_query = "EXECUTE {}{};".format(
+            name, " ({})".format(', '.join(['%s'] * len(self.parameters))) if self.parameters else '')
+        # both are timed under the name of the original statement
+        statement_name = metrics.statement_name(query)
+        metrics.register_statements({statement_name: self.execute_query,
+                                     'PREPARE ' + statement_name: self.prepare_query})
+
+    def execute_vars(self, vars) -> tuple:
+        return tuple(vars[key] for key in self.parameters)
+
+
+class StatementRegistry:
+    def __init__(self):
+        self._statements = {}  # SQL text -> PreparedStatement
+        self._counts = {}
+
+    def register(self, statements: dict):
+        # name -> SQL text of constant statements
+        for name, query in statements.items():
+            self._statements[query] = PreparedStatement(name.lower(), query)
+
+    def add(self, prefix: str, query: str):
+        # a statement built at runtime, e.g. PATCH for a set of fields. Variants of it are named prefix_1, prefix_2, ...
+        if query not in self._statements:
+            self._counts[prefix] = self._counts.get(prefix, 0) + 1
+            self._statements[query] = PreparedStatement('{}_{}'.format(prefix, self._counts[prefix]), query)
+
+    def get(self, query):
+        return self._statements.get(query) if isinstance(query, str) else None
+
+
+statements = StatementRegistry()
+
+
+def prepare_queries(prepared: OrderedDict, statement: PreparedStatement, max_statements: int) -> list:
+    # queries to execute before statement.execute_query on a connection with prepared statements (name -> True,
+    # the least recently used first): none if it's prepared, otherwise DEALLOCATE of the least recently used one,
+    # if there are max_statements of them, and PREPARE. The statement must be added to prepared after them
+    if statement.name in prepared:
+        prepared.move_to_end(statement.name)
+        return []
+    queries = []
+    if prepared and len(prepared) >= max_statements:
+        queries.append("DEALLOCATE {};".format(prepared.popitem(last=False)[0]))
+    queries.append(statement.prepare_query)
+    return queries
+
+
+class PreparingConnection(extensions.connection):
+    # connection_factory of psycopg2, the connection keeps max_statements statements prepared at most.
+    # Prepared statements aren't transactional, rollbacks keep them
+    def __init__(self, *args, max_statements: int = 100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_statements = max_statements
+        self.prepared = OrderedDict()
+
+
+class PreparingCursor(InstrumentedCursor):
+    # cursor_factory of PreparingConnection: statements of the registry are executed as prepared ones,
+    # server-side (named) cursors can't use them
+    def execute(self, query, vars=None):
+        statement = statements.get(query)
+        if statement is None or self.name is not None:
+            return super().execute(query, vars)
+
+        for prepare_query in prepare_queries(self.connection.prepared, statement, self.connection.max_statements):
+            super().execute(prepare_query)
+        self.connection.prepared[statement.name] = True
+        return super().execute(statement.execute_query, statement.execute_vars(vars))
+
+
+class PreparingAsyncCursor(InstrumentedAsyncCursor):
+    # the same for aiopg, prepared statements are kept by the aiopg connection
+    def __init__(self, cursor, conn, max_statements: int = 100):
+        super().__init__(cursor)
+        if not hasattr(conn, 'prepared'):
+            conn.prepared = OrderedDict()
+        self._prepared = conn.prepared
+        self._max_statements = max_statements
+
+    async def execute(self, operation, parameters=None):
+        statement = statements.get(operation)
+        if statement is None:
+            return await super().execute(operation, parameters)
+
+        for prepare_query in prepare_queries(self._prepared, statement, self._max_statements):
+            await super().execute(prepare_query)
+        self._prepared[statement.name] = True
+        return await super().execute(statement.execute_query, statement.execute_vars(parameters))
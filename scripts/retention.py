@@ -0,0 +1,21 @@
+import config
+from argparse import ArgumentParser
+from database import DBHelper
+
+# deletes imports older than max_age_days of the [retention] section by dropping their partitions,
+# it's meant to be run periodically, e.g. by cron or a systemd timer: python3 retention.py
+if __name__ == '__main__':
+    parser = ArgumentParser(description="delete imports older than max_age_days of the retention section of config.ini")
+    parser.add_argument('--max-age-days', help="overrides max_age_days of config.ini", type=int)
+    args = parser.parse_args()
+
+    max_age_days = args.max_age_days if args.max_age_days is not None else \
+        config.get_retention_settings()['max_age_days']
+    if max_age_days <= 0:
+        print("Retention is disabled: max_age_days is {}".format(max_age_days))
+    else:
+        db_helper = DBHelper(pool_settings=config.get_pool_settings(), cache_settings={'enabled': False},
+                             prepared_settings=config.get_prepared_settings(),
+                             **config.get_db_requisites())
+        import_ids = db_helper.delete_expired_imports(max_age_days)
+        print("Deleted imports: {}".format(', '.join(map(str, import_ids)) or 'none'))
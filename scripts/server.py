@@ -1,79 +1,290 @@
+import time
 import config
-from flask import Flask, request, Response, json
+from urllib.parse import urlencode
+from flask import Flask, request, Response, json, stream_with_context, g
 from database import DBHelper, DBHelperError
-from datetime import date, datetime
+from json_stream import iter_import_citizens
+from access_log import AccessLog
+from admission import Admission, AdmissionError, RequestTooLargeError
+from metrics import metrics
+from datetime import date
 
 app = Flask(__name__)
-db_helper = DBHelper(**config.get_db_requisites())
-logs_dir_path = config.get_logs_dir_path()
+import_settings = config.get_import_settings()
+read_settings = config.get_read_settings()
+import_jobs_settings = config.get_import_jobs_settings()
+db_helper = DBHelper(pool_settings=config.get_pool_settings(),
+                     import_method=import_settings['method'],
+                     import_batch_size=import_settings['batch_size'],
+                     stream_batch_size=read_settings['stream_batch_size'],
+                     cache_settings=config.get_cache_settings(),
+                     replica_settings=config.get_replica_settings(),
+                     snapshot_settings=config.get_snapshot_settings(),
+                     prepared_settings=config.get_prepared_settings(),
+                     **config.get_db_requisites())
+access_log_settings = config.get_access_log_settings()
+access_log = AccessLog(config.get_logs_dir_path(),
+                       log_format=access_log_settings['format'],
+                       flush_interval=access_log_settings['flush_interval'],
+                       queue_size=access_log_settings['queue_size'])
+metrics_settings = config.get_metrics_settings()
+metrics.configure(metrics_settings['dir'], metrics_settings['flush_interval'])
+metrics.add_collector(lambda: [('ybs_access_log_dropped_total', {}, access_log.stats()['dropped'])])
+admission_settings = config.get_admission_settings()
+admission = Admission(admission_settings['dir'], admission_settings['limits'],
+                      queue_size=admission_settings['queue_size'],
+                      queue_timeout=admission_settings['queue_timeout'],
+                      retry_after=admission_settings['retry_after'],
+                      max_import_bytes=admission_settings['max_import_bytes'],
+                      enabled=admission_settings['enabled'])
+
+
+def error_response(e: DBHelperError) -> Response:
+    # validation errors are listed in a JSON body, other errors are plain text
+    if e.errors:
+        return Response(response=json.dumps(e.as_dict()),
+                        status=400,
+                        mimetype='application/json')
+    return Response(response=str(e), status=400)
+
+
+def dump_data(data) -> str:
+    # serialization of responses is timed separately from DBHelper
+    with metrics.timer('ybs_json_dumps_duration_seconds', route=request.url_rule.rule):
+        return json.dumps({"data": data})
 
 
 @app.route('/imports', methods=['POST'])
 def import_data():
+    if import_jobs_settings['enabled']:
+        # the body is imported later, the client polls /imports/jobs/<job_id> for the import_id
+        job_id = db_helper.enqueue_import(request.get_data())
+        return Response(response=dump_data({"job_id": job_id}),
+                        status=202,
+                        headers={'Location': '/imports/jobs/{}'.format(job_id)},
+                        mimetype='application/json')
     try:
-        import_id = db_helper.import_citizens(request.json)
+        if import_settings['streaming']:
+            import_id = db_helper.import_citizens_stream(iter_import_citizens(request.stream))
+        else:
+            import_id = db_helper.import_citizens(request.json)
     except DBHelperError as e:
-        return Response(response=str(e), status=400)
+        return error_response(e)
     else:
-        return Response(response=json.dumps({"data": {"import_id": import_id}}),
+        return Response(response=dump_data({"import_id": import_id}),
                         status=201,
                         mimetype='application/json')
 
 
+@app.route('/imports/jobs/<int:job_id>', methods=['GET'])
+def get_import_job(job_id):
+    try:
+        job = db_helper.get_import_job(job_id)
+    except DBHelperError as e:
+        return error_response(e)
+    else:
+        return Response(response=dump_data(job),
+                        status=200,
+                        mimetype='application/json')
+
+
+@app.route('/imports/<int:import_id>', methods=['DELETE'])
+def delete_import(import_id):
+    try:
+        db_helper.delete_import(import_id)
+    except DBHelperError as e:
+        return error_response(e)
+    else:
+        return Response(response=dump_data({"import_id": import_id}),
+                        status=200,
+                        mimetype='application/json')
+
+
 @app.route('/imports/<int:import_id>/citizens/<int:citizen_id>', methods=['PATCH'])
 def change_citizen_data(import_id, citizen_id):
     try:
+        if read_settings['citizens_mode'] == 'pg_json':
+            return Response(response=db_helper.change_citizen(import_id, citizen_id, request.json, as_json=True),
+                            status=200,
+                            mimetype='application/json')
         citizen_data = db_helper.change_citizen(import_id, citizen_id, request.json)
     except DBHelperError as e:
-        return Response(response=str(e), status=400)
+        return error_response(e)
     else:
-        return Response(response=json.dumps({"data": citizen_data}),
+        return Response(response=dump_data(citizen_data),
                         status=200,
                         mimetype='application/json')
 
 
+def generate_json_list(key: str, items, items_per_chunk: int = 100):
+    # {"key": [item, item, ...]} produced by chunks of items_per_chunk items
+    yield '{{"{}": ['.format(key)
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(json.dumps(item))
+        if len(chunk) >= items_per_chunk:
+            yield ('' if first else ', ') + ', '.join(chunk)
+            chunk = []
+            first = False
+    if chunk:
+        yield ('' if first else ', ') + ', '.join(chunk)
+    yield ']}'
+
+
+def conditional_get(import_id: int, build_response, *etag_parts):
+    # strong ETag is the import revision, so If-None-Match is answered with 304 after one lookup of imports.
+    # build_response(revision) makes the full response otherwise
+    try:
+        revision = db_helper.get_import_revision(import_id)
+        etag = '-'.join(map(str, (import_id, revision) + etag_parts))
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = build_response(revision)
+    except DBHelperError as e:
+        return error_response(e)
+    response.set_etag(etag)
+    return response
+
+
 @app.route('/imports/<int:import_id>/citizens', methods=['GET'])
 def get_citizens_data(import_id):
     try:
-        citizens = db_helper.get_citizens(import_id)
+        page_query = db_helper.citizens_page_query(request.args, read_settings['max_page_size'])
     except DBHelperError as e:
-        return Response(response=str(e), status=400)
-    else:
-        return Response(response=json.dumps({"data": citizens}),
+        return error_response(e)
+
+    def build_response(revision):
+        if page_query is not None:
+            # a page or a projection is small, so it's returned at once in every citizens_mode
+            citizens, next_after = db_helper.get_citizens_page(import_id, revision, *page_query)
+            response = Response(response=dump_data(citizens),
+                                status=200,
+                                mimetype='application/json')
+            if next_after is not None:
+                next_args = {**request.args.to_dict(), 'after': next_after}
+                response.headers['Link'] = '<{}?{}>; rel="next"'.format(request.path, urlencode(next_args))
+            return response
+        admit()
+        if read_settings['citizens_mode'] == 'stream':
+            citizens = db_helper.get_citizens_stream(import_id, revision)
+            return Response(response=stream_with_context(generate_json_list('data', citizens)),
+                            status=200,
+                            mimetype='application/json')
+        if read_settings['citizens_mode'] == 'pg_json':
+            return Response(response=db_helper.get_citizens_json(import_id, revision),
+                            status=200,
+                            mimetype='application/json')
+        return Response(response=dump_data(db_helper.get_citizens(import_id, revision)),
                         status=200,
                         mimetype='application/json')
 
+    return conditional_get(import_id, build_response)
+
 
 @app.route('/imports/<int:import_id>/citizens/birthdays', methods=['GET'])
 def get_presents_num_per_month(import_id):
-    try:
-        presents_num_per_month = db_helper.get_presents_num_per_month(import_id)
-    except DBHelperError as e:
-        return Response(response=str(e), status=400)
-    else:
-        return Response(response=json.dumps({'data': presents_num_per_month}),
+    def build_response(revision):
+        admit()
+        return Response(response=dump_data(db_helper.get_presents_num_per_month(import_id, revision)),
                         status=200,
                         mimetype='application/json')
 
+    return conditional_get(import_id, build_response)
+
 
 @app.route('/imports/<int:import_id>/towns/stat/percentile/age', methods=['GET'])
 def get_town_stat(import_id):
-    try:
-        town_stat = db_helper.get_town_stat(import_id)
-    except DBHelperError as e:
-        return Response(response=str(e), status=400)
-    else:
-        return Response(response=json.dumps({'data': town_stat}),
+    def build_response(revision):
+        admit()
+        return Response(response=dump_data(db_helper.get_town_stat(import_id, revision)),
                         status=200,
                         mimetype='application/json')
 
+    # ages change with the date, so it's a part of the ETag too
+    return conditional_get(import_id, build_response, date.today().isoformat())
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    # statistics of this worker process
+    return Response(response=json.dumps({'data': {'pool': db_helper.pool_stats(),
+                                                  'cache': db_helper.cache_stats(),
+                                                  'access_log': access_log.stats()}}),
+                    status=200,
+                    mimetype='application/json')
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # metrics of all workers in Prometheus text format
+    return Response(response=metrics.render(),
+                    status=200,
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+    metrics.start_request()
+
+
+def admit():
+    # a slot of a heavy read is taken in build_response, after the ETag check, so 304 responses and pages
+    # don't wait for it. It's released by release_slot
+    g.admission_token = admission.acquire(request.endpoint)
+
+
+@app.before_request
+def admit_import():
+    # POST /imports over the limits is rejected before the body is read
+    if request.endpoint == 'import_data':
+        admission.check_import_size(request.content_length)
+        # bodies without Content-Length are cut by Werkzeug while they are read
+        request.max_content_length = admission.max_import_bytes or None
+        admit()
+
+
+@app.errorhandler(RequestTooLargeError)
+def request_too_large(e):
+    return Response(response=str(e), status=413)
+
+
+@app.errorhandler(AdmissionError)
+def server_busy(e):
+    return Response(response=str(e), status=503, headers={'Retry-After': str(e.retry_after)})
+
+
+@app.after_request
+def release_slot(response):
+    # the slot of a streamed response is held till it's sent
+    token = g.pop('admission_token', None)
+    if response.is_streamed:
+        response.call_on_close(lambda: admission.release(token))
+    else:
+        admission.release(token)
+    return response
+
+
+@app.teardown_request
+def release_request(exception):
+    # the view has failed, so after_request wasn't called
+    admission.release(g.pop('admission_token', None))
+
+
+@app.after_request
+def record_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    metrics.finish_request(request.method, route, response.status_code, time.perf_counter() - g.request_started,
+                           None if response.is_streamed else response.content_length)
+    return response
+
 
 @app.after_request
 def save_logs(response):
-    formatted_time = datetime.now().strftime('%H:%M:%S.%f')[:-3]
-    values_for_logging = tuple(map(str, (formatted_time, request.path, response.status_code)))
-    with open(logs_dir_path + date.today().strftime("%Y-%m-%d") + '.log', 'a') as log_file:
-        log_file.write("*".join(values_for_logging) + '\n')
+    # the record is only queued, it's written to the file by the access log thread
+    access_log.log(request.method, request.path, response.status_code, time.perf_counter() - g.request_started)
     return response
 
 
@@ -0,0 +1,89 @@
+from numpy import array, asarray, unique, searchsorted, bincount, cumsum, concatenate, repeat, arange, diff, \
+    argsort, full, int32, int64, intp
+
+
+class ImportSnapshot:
+    # columnar copy of the citizens of one import for the analytic endpoints. Citizens are in the order of
+    # their db ids, towns are codes of town_names. Relatives are a graph in CSR form: relatives of the citizen
+    # at position i are at positions relative_indexes[relative_offsets[i]:relative_offsets[i + 1]].
+    # A snapshot isn't changed after it's built, with_citizen returns a changed copy, so readers need no locks
+    def __init__(self, revision, citizen_ids, town_names: list, town_codes, birth_years, birth_month_days,
+                 relative_offsets, relative_indexes, citizen_id_order=None):
+        self.revision = revision
+        self.citizen_ids = citizen_ids
+        self.town_names = town_names
+        self.town_codes = town_codes
+        # birth_month_days - month * 100 + day, as for BaseDBHelper.calculate_ages
+        self.birth_years = birth_years
+        self.birth_month_days = birth_month_days
+        self.relative_offsets = relative_offsets
+        self.relative_indexes = relative_indexes
+        # positions of citizens ordered by citizen_id, for the lookups of PATCH
+        self._citizen_id_order = argsort(citizen_ids) if citizen_id_order is None else citizen_id_order
+
+    @classmethod
+    def from_rows(cls, revision, citizens_rows: list, relatives_rows: list):
+        # citizens_rows - (id, citizen_id, town, birth year, month * 100 + day) ordered by id,
+        # relatives_rows - (id1, id2) ordered by id1
+        if citizens_rows:
+            db_ids, citizen_ids, towns, birth_years, birth_month_days = zip(*citizens_rows)
+        else:
+            db_ids, citizen_ids, towns, birth_years, birth_month_days = (), (), (), (), ()
+        db_ids = array(db_ids, dtype=int64)
+        town_names, town_codes = unique(array(towns, dtype=object), return_inverse=True)
+
+        relatives = array(relatives_rows, dtype=int64).reshape(-1, 2)
+        sources = searchsorted(db_ids, relatives[:, 0])
+        relative_offsets = concatenate(([0], cumsum(bincount(sources, minlength=len(db_ids)))))
+        return cls(revision, array(citizen_ids, dtype=int64), town_names.tolist(), town_codes.astype(int32),
+                   array(birth_years, dtype=int32), array(birth_month_days, dtype=int32),
+                   relative_offsets.astype(intp), searchsorted(db_ids, relatives[:, 1]).astype(int32))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(values.nbytes for values in (self.citizen_ids, self.town_codes, self.birth_years,
+                                                self.birth_month_days, self.relative_offsets,
+                                                self.relative_indexes, self._citizen_id_order))
+
+    def relative_sources(self):
+        # position of the citizen for every item of relative_indexes
+        return repeat(arange(len(self.citizen_ids)), diff(self.relative_offsets))
+
+    def positions(self, citizen_ids: list):
+        return self._citizen_id_order[searchsorted(self.citizen_ids, asarray(citizen_ids, dtype=int64),
+                                                   sorter=self._citizen_id_order)]
+
+    def with_citizen(self, revision, citizen: dict):
+        # copy with the citizen changed by PATCH, citizen - the changed citizen as in the response,
+        # without relatives if they aren't changed
+        position = self.positions([citizen['citizen_id']])[0]
+        day, month, year = map(int, citizen['birth_date'].split('.'))
+        birth_years = self.birth_years.copy()
+        birth_years[position] = year
+        birth_month_days = self.birth_month_days.copy()
+        birth_month_days[position] = month * 100 + day
+
+        # a new town gets the next code, codes of towns without citizens are skipped by the statistics
+        town_names = self.town_names
+        town_codes = self.town_codes.copy()
+        if citizen['town'] in town_names:
+            town_codes[position] = town_names.index(citizen['town'])
+        else:
+            town_names = town_names + [citizen['town']]
+            town_codes[position] = len(town_names) - 1
+
+        if citizen.get('relatives') is None:
+            return ImportSnapshot(revision, self.citizen_ids, town_names, town_codes, birth_years, birth_month_days,
+                                  self.relative_offsets, self.relative_indexes, self._citizen_id_order)
+
+        # relations of the citizen are replaced in both directions, a relation to himself is stored once
+        sources, targets = self.relative_sources(), self.relative_indexes
+        kept = (sources != position) & (targets != position)
+        relatives = unique(self.positions(citizen['relatives'])).astype(int32)
+        others = relatives[relatives != position]
+        sources = concatenate((sources[kept], full(len(relatives), position), others))
+        targets = concatenate((targets[kept], relatives, full(len(others), position, dtype=int32)))
+        order = argsort(sources, kind='stable')
+        relative_offsets = concatenate(([0], cumsum(bincount(sources, minlength=len(self.citizen_ids)))))
+        return ImportSnapshot(revision, self.citizen_ids, town_names, town_codes, birth_years, birth_month_days,
+                              relative_offsets.astype(intp), targets[order].astype(int32), self._citizen_id_order)
@@ -0,0 +1,167 @@
+import re
+import datetime
+from collections import namedtuple, defaultdict
+from itertools import repeat
+
+# kind - 'schema' for structure, types and values, 'relatives' for broken relations;
+# index - position of the citizen in the import or None for the whole document
+ValidationError = namedtuple('ValidationError', ('kind', 'index', 'field', 'message'))
+
+
+class ImportValidator:
+    CITIZEN_FIELDS = frozenset(('citizen_id', 'town', 'street', 'building', 'apartment', 'name', 'birth_date',
+                                'gender', 'relatives'))
+    # max lengths are the same as in migrations/0001_create_tables.sql
+    STRING_FIELDS = (('town', 70), ('street', 70), ('building', 20), ('name', 50))
+    INTEGER_FIELDS = ('citizen_id', 'apartment')
+    # INT columns
+    MAX_INTEGER = 2 ** 31 - 1
+    GENDERS = frozenset(('male', 'female'))
+    DATE_RE = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{4})\Z')
+
+    def __init__(self, max_errors: int = 100, today: datetime.date = None):
+        self.max_errors = max_errors
+        self.today = today or datetime.date.today()
+        self.errors = []
+        self.count = 0
+        self._citizen_ids = set()
+        # citizen_id -> index of the citizen
+        self._citizen_indexes = dict()
+        # relative_id -> ids of already seen citizens, which declared relative_id and wait for the mirror relation
+        self._pending = defaultdict(set)
+
+    @property
+    def full(self) -> bool:
+        return len(self.errors) >= self.max_errors
+
+    def _error(self, kind: str, index, field, message: str):
+        if not self.full:
+            self.errors.append(ValidationError(kind, index, field, message))
+
+    @staticmethod
+    def _is_integer(value) -> bool:
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    @classmethod
+    def parse_date(cls, date: str):
+        match = cls.DATE_RE.match(date)
+        if match is None:
+            return None
+        day, month, year = match.groups()
+        try:
+            return datetime.date(int(year), int(month), int(day))
+        except ValueError:
+            return None
+
+    def check_values(self, index, citizen: dict):
+        # rules of the fields present in citizen, PATCH is checked by them too with index None
+        for field in self.INTEGER_FIELDS:
+            value = citizen.get(field)
+            if value is not None and (not self._is_integer(value) or not 0 <= value <= self.MAX_INTEGER):
+                self._error('schema', index, field, "must be an integer from 0 to {}".format(self.MAX_INTEGER))
+        for field, max_length in self.STRING_FIELDS:
+            value = citizen.get(field)
+            if value is not None and (not isinstance(value, str) or len(value) > max_length):
+                self._error('schema', index, field, "must be a string of at most {} characters".format(max_length))
+
+        gender = citizen.get('gender')
+        if gender is not None and (not isinstance(gender, str) or gender not in self.GENDERS):
+            self._error('schema', index, 'gender', "must be one of: male, female")
+
+        birth_date = citizen.get('birth_date')
+        if birth_date is not None:
+            parsed = self.parse_date(birth_date) if isinstance(birth_date, str) else None
+            if parsed is None:
+                self._error('schema', index, 'birth_date', "must be a date in DD.MM.YYYY format")
+            elif parsed > self.today:
+                self._error('schema', index, 'birth_date', "must not be in the future")
+
+    def check_relatives(self, index, relatives):
+        # set of relatives or None, if they are missing or wrong. Used by PATCH with index None too
+        if relatives is None:
+            return None
+        if not isinstance(relatives, list) or not all(type(relative_id) is int for relative_id in relatives):
+            self._error('schema', index, 'relatives', "must be an array of integers")
+            return None
+        relatives_set = set(relatives)
+        if len(relatives_set) != len(relatives):
+            self._error('schema', index, 'relatives', "must not contain duplicates")
+        return relatives_set
+
+    def feed(self, citizen) -> list:
+        # validate one citizen and return the relations (citizen_id, relative_id), whose both sides are seen now
+        index = self.count
+        self.count += 1
+        if self.full:
+            return []
+
+        if not isinstance(citizen, dict):
+            self._error('schema', index, None, "citizen must be an object")
+            return []
+
+        errors_num = len(self.errors)
+        keys = citizen.keys()
+        for field in self.CITIZEN_FIELDS - keys:
+            self._error('schema', index, field, "required field is missing")
+        for field in keys - self.CITIZEN_FIELDS:
+            self._error('schema', index, field, "unknown field")
+
+        self.check_values(index, citizen)
+
+        citizen_id = citizen.get('citizen_id')
+        if self._is_integer(citizen_id):
+            if citizen_id in self._citizen_ids:
+                self._error('schema', index, 'citizen_id', "duplicate citizen_id {}".format(citizen_id))
+            else:
+                self._citizen_ids.add(citizen_id)
+                self._citizen_indexes[citizen_id] = index
+
+        relatives_set = self.check_relatives(index, citizen.get('relatives'))
+
+        if len(self.errors) != errors_num:
+            return []
+
+        # check relatives symmetry with set operations only: relatives, which are already seen,
+        # must be exactly the citizens, who declared this one and wait for the mirror relation
+        pairs = []
+        if citizen_id in relatives_set:
+            relatives_set.discard(citizen_id)
+            pairs.append((citizen_id, citizen_id))
+        expected = self._pending.pop(citizen_id, set())
+        seen = relatives_set & self._citizen_ids
+        if seen != expected:
+            for relative_id in seen - expected:
+                self._error('relatives', index, 'relatives',
+                            "citizen {} is not a relative of citizen {}".format(citizen_id, relative_id))
+            for relative_id in expected - seen:
+                self._error('relatives', self._citizen_indexes[relative_id], 'relatives',
+                            "citizen {} is not a relative of citizen {}".format(relative_id, citizen_id))
+            return []
+
+        pairs.extend(zip(seen, repeat(citizen_id)))
+        for relative_id in relatives_set - seen:
+            self._pending[relative_id].add(citizen_id)
+        return pairs
+
+    def finish(self) -> list:
+        # relations, which are still pending, point to unknown citizens
+        for relative_id, citizen_ids in self._pending.items():
+            for citizen_id in citizen_ids:
+                self._error('relatives', self._citizen_indexes[citizen_id], 'relatives',
+                            "unknown relative {}".format(relative_id))
+        self._pending.clear()
+        return self.errors
+
+    def validate(self, data) -> list:
+        # validate the whole import document and return all relations
+        if not isinstance(data, dict) or data.keys() != {'citizens'} or not isinstance(data['citizens'], list):
+            self._error('schema', None, 'citizens', "import must be an object with the only field citizens (array)")
+            return []
+
+        pairs = []
+        for citizen in data['citizens']:
+            pairs.extend(self.feed(citizen))
+            if self.full:
+                break
+        self.finish()
+        return pairs
@@ -1,6 +1,12 @@
 DROP TABLE IF EXISTS imports CASCADE ;
+DROP TABLE IF EXISTS import_jobs CASCADE ;
+DROP TABLE IF EXISTS schema_version CASCADE ;
 DROP TABLE IF EXISTS citizens CASCADE ;
 DROP TABLE IF EXISTS relatives CASCADE ;
 
 DROP SEQUENCE IF EXISTS citizens_id_seq;
 DROP SEQUENCE IF EXISTS imports_import_id_seq;
+DROP SEQUENCE IF EXISTS import_jobs_job_id_seq;
+
+DROP FUNCTION IF EXISTS create_import_partitions(INT);
+DROP FUNCTION IF EXISTS attach_import_partitions(INT);
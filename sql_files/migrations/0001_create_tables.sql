@@ -0,0 +1,143 @@
+-- the schema before versioned migrations: every statement is idempotent, so the file also brings up to date
+-- databases created by previous versions, which have no schema_version yet
+
+CREATE TABLE IF NOT EXISTS imports
+(
+    import_id   SERIAL PRIMARY KEY,
+    import_time TIMESTAMP NOT NULL,
+    version     INT       NOT NULL DEFAULT 0
+);
+
+ALTER TABLE imports ADD COLUMN IF NOT EXISTS version INT NOT NULL DEFAULT 0;
+
+-- bodies of POST /imports accepted as jobs, they are imported by the processes of import_jobs.py.
+-- A job is queued until it's done or failed, a running job is locked by its process, see DBHelper.run_import_job
+CREATE TABLE IF NOT EXISTS import_jobs
+(
+    job_id        SERIAL PRIMARY KEY,
+    status        VARCHAR(6) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'done', 'failed')),
+    payload       BYTEA,
+    import_id     INT,
+    error         TEXT,
+    created_time  TIMESTAMP  NOT NULL,
+    started_time  TIMESTAMP,
+    finished_time TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS import_jobs_queued_idx ON import_jobs (job_id) WHERE status = 'queued';
+
+-- migration of relatives stored in one direction: the reverse rows are added and the primary key is built.
+-- Reads aren't blocked, writes wait for the index
+DO
+$$
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('relatives')) = 'r'
+            AND NOT EXISTS(SELECT 1 FROM pg_constraint WHERE conname = 'relatives_pk') THEN
+            INSERT INTO relatives (id1, id2)
+            SELECT r.id2, r.id1
+            FROM relatives r
+            WHERE r.id1 != r.id2
+              AND NOT EXISTS(SELECT 1 FROM relatives o WHERE o.id1 = r.id2 AND o.id2 = r.id1);
+            CREATE UNIQUE INDEX relatives_pk ON relatives (id1, id2);
+            ALTER TABLE relatives ADD CONSTRAINT relatives_pk PRIMARY KEY USING INDEX relatives_pk;
+            DROP INDEX IF EXISTS relatives_idx_1;
+        END IF;
+    END
+$$;
+
+-- migration of citizens and relatives without partitions: the tables are put aside here,
+-- their rows are moved to the partitions of their imports at the end of the file
+DO
+$$
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('citizens')) = 'r' THEN
+            ALTER TABLE relatives RENAME TO relatives_unpartitioned;
+            ALTER TABLE citizens RENAME TO citizens_unpartitioned;
+            ALTER SEQUENCE citizens_id_seq OWNED BY NONE;
+        END IF;
+    END
+$$;
+
+CREATE SEQUENCE IF NOT EXISTS citizens_id_seq;
+
+-- every import has its own partitions citizens_<import_id> and relatives_<import_id>: queries of an import
+-- read only its rows, and an import is deleted by dropping its partitions instead of deleting rows.
+-- Keys and indexes are defined on the partitions by create_import_partitions
+CREATE TABLE IF NOT EXISTS citizens
+(
+    id         INT         NOT NULL DEFAULT nextval('citizens_id_seq'),
+    import_id  INT         NOT NULL,
+    citizen_id INT         NOT NULL,
+    town       VARCHAR(70) NOT NULL,
+    street     VARCHAR(70) NOT NULL,
+    building   VARCHAR(20) NOT NULL,
+    apartment  INT         NOT NULL,
+    name       VARCHAR(50) NOT NULL,
+    birth_date DATE        NOT NULL,
+    gender     VARCHAR(6)  NOT NULL CHECK (gender IN ('male', 'female'))
+) PARTITION BY LIST (import_id);
+
+-- every relation is stored in both directions: (id1, id2) and (id2, id1), a citizen related to himself - once
+CREATE TABLE IF NOT EXISTS relatives
+(
+    import_id INT NOT NULL,
+    id1       INT NOT NULL,
+    id2       INT NOT NULL
+) PARTITION BY LIST (import_id);
+
+-- partitions of an import are created as separate tables, filled and attached by attach_import_partitions
+-- in the transaction of the import. Unlike CREATE TABLE ... PARTITION OF, ATTACH PARTITION doesn't block reads
+-- and writes of other imports, and CHECK (import_id = ...) spares it the scan of the partition
+CREATE OR REPLACE FUNCTION create_import_partitions(partition_import_id INT) RETURNS VOID AS
+$$
+BEGIN
+    EXECUTE format('CREATE TABLE citizens_%1$s (LIKE citizens INCLUDING DEFAULTS INCLUDING CONSTRAINTS, '
+                   'CONSTRAINT citizens_%1$s_pk PRIMARY KEY (id), '
+                   'CONSTRAINT citizens_%1$s_uk UNIQUE (citizen_id), '
+                   'CONSTRAINT citizens_%1$s_import_id CHECK (import_id = %1$s))', partition_import_id);
+    EXECUTE format('CREATE TABLE relatives_%1$s (LIKE relatives INCLUDING CONSTRAINTS, '
+                   'CONSTRAINT relatives_%1$s_pk PRIMARY KEY (id1, id2), '
+                   'CONSTRAINT relatives_%1$s_fk_id1 FOREIGN KEY (id1) REFERENCES citizens_%1$s (id), '
+                   'CONSTRAINT relatives_%1$s_fk_id2 FOREIGN KEY (id2) REFERENCES citizens_%1$s (id), '
+                   'CONSTRAINT relatives_%1$s_import_id CHECK (import_id = %1$s))', partition_import_id);
+    -- rows are copied to the partition without import_id
+    EXECUTE format('ALTER TABLE relatives_%1$s ALTER COLUMN import_id SET DEFAULT %1$s', partition_import_id);
+END
+$$ LANGUAGE plpgsql;
+
+-- new partitions have no statistics, until autovacuum collects them plans of queries to an import would be
+-- made for empty tables
+CREATE OR REPLACE FUNCTION attach_import_partitions(partition_import_id INT) RETURNS VOID AS
+$$
+BEGIN
+    EXECUTE format('ANALYZE citizens_%1$s, relatives_%1$s', partition_import_id);
+    EXECUTE format('ALTER TABLE citizens ATTACH PARTITION citizens_%1$s FOR VALUES IN (%1$s)', partition_import_id);
+    EXECUTE format('ALTER TABLE relatives ATTACH PARTITION relatives_%1$s FOR VALUES IN (%1$s)',
+                   partition_import_id);
+END
+$$ LANGUAGE plpgsql;
+
+-- rows of the tables without partitions are moved import by import, citizens keep their ids
+DO
+$$
+    DECLARE
+        partition_import_id INT;
+    BEGIN
+        IF to_regclass('citizens_unpartitioned') IS NOT NULL THEN
+            FOR partition_import_id IN SELECT import_id FROM imports ORDER BY import_id
+                LOOP
+                    PERFORM create_import_partitions(partition_import_id);
+                    EXECUTE format('INSERT INTO citizens_%1$s (id, import_id, citizen_id, town, street, building, '
+                                   'apartment, name, birth_date, gender) '
+                                   'SELECT id, import_id, citizen_id, town, street, building, apartment, name, '
+                                   'birth_date, gender FROM citizens_unpartitioned WHERE import_id = %1$s',
+                                   partition_import_id);
+                    EXECUTE format('INSERT INTO relatives_%1$s (id1, id2) SELECT r.id1, r.id2 '
+                                   'FROM citizens_unpartitioned c, relatives_unpartitioned r '
+                                   'WHERE c.import_id = %1$s AND r.id1 = c.id', partition_import_id);
+                    PERFORM attach_import_partitions(partition_import_id);
+                END LOOP;
+            DROP TABLE relatives_unpartitioned, citizens_unpartitioned;
+        END IF;
+    END
+$$;
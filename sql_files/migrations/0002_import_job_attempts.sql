@@ -0,0 +1,3 @@
+-- number of times a job was taken by an import process. It's committed before the import, so a job, which kills
+-- the process, isn't taken forever: after max_attempts of [import_jobs] it's failed, see DBHelper.run_import_job
+ALTER TABLE import_jobs ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0;